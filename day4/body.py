@@ -0,0 +1,296 @@
+"""
+Request bodies: Content-Length and chunked framing, client_max_body_size,
+Expect: 100-continue and spooling to disk.
+
+The connection reads through a SocketReader, so whatever arrives after one
+request (its body, the next pipelined request) stays buffered instead of
+being thrown away with the rest of a recv(). Handlers get request.body:
+
+    request.body.read(65536)    # the next chunk, b"" at the end
+    for chunk in request.body:  # streaming
+    request.body.read()         # all of it, in memory
+    request.body.spool()        # a file object, on disk above client_body_buffer_size
+
+"100 Continue" is only sent when the handler starts reading, and whatever
+it leaves unread is drained after the response so the next request on the
+connection starts at the right byte.
+"""
+import socket
+import tempfile
+import time
+
+from status_code import HttpResponseCode
+
+RECV_SIZE = 64 * 1024
+READ_SIZE = 64 * 1024
+MAX_CHUNK_LINE = 4 * 1024
+CONTINUE = b"HTTP/1.1 100 Continue\r\n\r\n"
+HEX_DIGITS = b"0123456789abcdefABCDEF"
+
+
+class RequestError(ValueError):
+    """The request can't be read, answered with `status` and the connection is closed."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class SocketReader:
+    """Buffered reads from the client socket, with an absolute deadline per request part."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        # time.monotonic() by which the current head or body has to be in, None while idle
+        self.deadline = None
+        # Since when we wait for the next request, connection.reap_idle() closes the oldest
+        self.idle_since = None
+        # time.perf_counter() of the current head's first byte, where its RequestTimer starts
+        self.head_started = None
+
+    def fill(self):
+        if self.deadline is not None:
+            # A fixed deadline, trickling a byte at a time doesn't extend it
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise RequestError(HttpResponseCode.HTTP_408_REQUEST_TIMEOUT, "Client too slow")
+            self.sock.settimeout(remaining)
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except socket.timeout:
+            if self.deadline is None:
+                raise
+            raise RequestError(HttpResponseCode.HTTP_408_REQUEST_TIMEOUT, "Client too slow")
+        self.buffer += data
+        return bool(data)
+
+    def read_head(self, idle_timeout, header_timeout, buffers):
+        """
+        The request line and headers up to the blank line, b"" if the client closed.
+
+        Waits up to `idle_timeout` for the first byte (socket.timeout after
+        that), then the whole head has to be in within `header_timeout`.
+        `buffers` is (count, size) like nginx's large_client_header_buffers:
+        the request line and every header line must fit in `size` bytes
+        (414 / 431) and the whole head in count * size (431).
+        """
+        count, size = buffers
+        # Tolerate the empty lines some clients send between pipelined requests
+        while self.buffer[:2] == b"\r\n":
+            del self.buffer[:2]
+        self.deadline = None
+        if self.buffer:
+            self.deadline = time.monotonic() + header_timeout
+            self.head_started = time.perf_counter()
+        else:
+            self.sock.settimeout(idle_timeout)
+            self.idle_since = time.monotonic()
+        start = 0
+        while True:
+            end = self.buffer.find(b"\r\n\r\n", start)
+            if end != -1:
+                head = bytes(self.buffer[: end + 4])
+                del self.buffer[: end + 4]
+                self.deadline = None
+                check_head(head, count, size)
+                return head
+            if len(self.buffer) > count * size:
+                raise RequestError(HttpResponseCode.HTTP_431_REQUEST_HEADER_FIELDS_TOO_LARGE, "Request head too large")
+            if len(self.buffer) > size and b"\n" not in self.buffer[:size]:
+                raise RequestError(HttpResponseCode.HTTP_414_URI_TOO_LONG, "Request line too long")
+            # Only search the new bytes (and the 3 before them) next time
+            start = max(0, len(self.buffer) - 3)
+            got_data = self.fill()
+            if self.deadline is None:
+                self.idle_since = None
+                self.deadline = time.monotonic() + header_timeout
+                self.head_started = time.perf_counter()
+            if not got_data:
+                if self.buffer:
+                    raise RequestError(HttpResponseCode.HTTP_400_BAD_REQUEST, "Connection closed mid request")
+                return b""
+
+    def read(self, size):
+        """Up to `size` bytes, b"" at the end of the stream."""
+        if not self.buffer and not self.fill():
+            return b""
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self, limit):
+        while True:
+            end = self.buffer.find(b"\n")
+            if end != -1:
+                line = bytes(self.buffer[: end + 1])
+                del self.buffer[: end + 1]
+                return line
+            if len(self.buffer) > limit:
+                raise RequestError(HttpResponseCode.HTTP_400_BAD_REQUEST, "Line too long")
+            if not self.fill():
+                raise RequestError(HttpResponseCode.HTTP_400_BAD_REQUEST, "Connection closed mid body")
+
+    def take_buffer(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+class ContentLengthSource:
+    def __init__(self, reader, length):
+        self.reader = reader
+        self.remaining = length
+
+    def read(self, size):
+        if not self.remaining:
+            return b""
+        data = self.reader.read(min(size, self.remaining))
+        if not data:
+            raise RequestError(HttpResponseCode.HTTP_400_BAD_REQUEST, "Body shorter than its Content-Length")
+        self.remaining -= len(data)
+        return data
+
+
+class ChunkedSource:
+    def __init__(self, reader):
+        self.reader = reader
+        self.chunk_left = 0
+        self.done = False
+
+    def read(self, size):
+        if self.done:
+            return b""
+        if not self.chunk_left:
+            # "1a2b;extension=value\r\n"
+            size_text = self.reader.readline(MAX_CHUNK_LINE).split(b";", 1)[0].strip()
+            if not size_text or size_text.strip(HEX_DIGITS):
+                raise RequestError(HttpResponseCode.HTTP_400_BAD_REQUEST, f"Bad chunk size {size_text[:20]!r}")
+            self.chunk_left = int(size_text, 16)
+            if not self.chunk_left:
+                # Last chunk, skip the trailers up to the blank line
+                while self.reader.readline(MAX_CHUNK_LINE).strip():
+                    pass
+                self.done = True
+                return b""
+        data = self.reader.read(min(size, self.chunk_left))
+        if not data:
+            raise RequestError(HttpResponseCode.HTTP_400_BAD_REQUEST, "Connection closed mid chunk")
+        self.chunk_left -= len(data)
+        if not self.chunk_left and self.reader.readline(MAX_CHUNK_LINE).strip():
+            raise RequestError(HttpResponseCode.HTTP_400_BAD_REQUEST, "Chunk longer than its size")
+        return data
+
+
+class RequestBody:
+    def __init__(self, source=None, length=0, max_size=0, buffer_size=0, temp_dir=None, continue_socket=None):
+        # Anything with read(size), b"" at the end
+        self.source = source
+        # From Content-Length, None when chunked
+        self.length = length
+        self.max_size = max_size
+        self.buffer_size = buffer_size
+        self.temp_dir = temp_dir
+        # Socket waiting for "100 Continue" before the client sends the body
+        self.continue_socket = continue_socket
+        self.received = 0
+        self.finished = source is None or length == 0
+        self._spooled = None
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(self)
+        if self.finished:
+            return b""
+        if self.continue_socket is not None:
+            self.continue_socket.sendall(CONTINUE)
+            self.continue_socket = None
+        data = self.source.read(size)
+        if not data:
+            self.finished = True
+            return b""
+        self.received += len(data)
+        if self.max_size and self.received > self.max_size:
+            raise RequestError(HttpResponseCode.HTTP_413_PAYLOAD_TOO_LARGE, "Request body too large")
+        return data
+
+    def __iter__(self):
+        while chunk := self.read(READ_SIZE):
+            yield chunk
+
+    def spool(self):
+        """The whole body as a file object at offset 0, on disk once it is bigger than buffer_size."""
+        if self._spooled is None:
+            spooled = tempfile.SpooledTemporaryFile(max_size=self.buffer_size, dir=self.temp_dir)
+            for chunk in self:
+                spooled.write(chunk)
+            spooled.seek(0)
+            self._spooled = spooled
+        return self._spooled
+
+    @property
+    def waiting_for_continue(self):
+        """The client hasn't sent the body yet, it waits for a "100 Continue" that never came."""
+        return self.continue_socket is not None and not self.finished
+
+    def drain(self):
+        for _ in self:
+            pass
+
+    def close(self):
+        if self._spooled is not None:
+            self._spooled.close()
+        if hasattr(self.source, "close"):
+            # HTTP/2 hands us its spooled file
+            self.source.close()
+
+
+def check_head(head, count, size):
+    if len(head) > count * size:
+        raise RequestError(HttpResponseCode.HTTP_431_REQUEST_HEADER_FIELDS_TOO_LARGE, "Request head too large")
+    request_line, _, headers = head.partition(b"\r\n")
+    if len(request_line) > size:
+        raise RequestError(HttpResponseCode.HTTP_414_URI_TOO_LONG, "Request line too long")
+    # Only a full scan when some line could be too long
+    if len(headers) > size and max(map(len, headers.split(b"\r\n"))) > size:
+        raise RequestError(HttpResponseCode.HTTP_431_REQUEST_HEADER_FIELDS_TOO_LARGE, "Header line too long")
+
+
+def open_body(headers, reader, sock, snapshot):
+    """The RequestBody for a request's headers, raises RequestError for bad framing or size."""
+    lowered = {name.lower(): value for name, value in headers.items()}
+    transfer_encoding = lowered.get("transfer-encoding")
+    content_length = lowered.get("content-length")
+    max_size = snapshot.CLIENT_MAX_BODY_SIZE
+
+    if transfer_encoding is not None:
+        if content_length is not None:
+            # Two framings is how requests get smuggled past proxies
+            raise RequestError(HttpResponseCode.HTTP_400_BAD_REQUEST, "Both Content-Length and Transfer-Encoding")
+        if transfer_encoding.strip().lower() != "chunked":
+            raise RequestError(
+                HttpResponseCode.HTTP_501_NOT_IMPLEMENTED, f"Unsupported Transfer-Encoding {transfer_encoding}"
+            )
+        source, length = ChunkedSource(reader), None
+    elif content_length is not None:
+        if not content_length.strip().isdigit():
+            raise RequestError(HttpResponseCode.HTTP_400_BAD_REQUEST, f"Bad Content-Length {content_length[:20]}")
+        length = int(content_length)
+        if max_size and length > max_size:
+            # Before any 100 Continue, the client doesn't even send it
+            raise RequestError(HttpResponseCode.HTTP_413_PAYLOAD_TOO_LARGE, "Request body too large")
+        source = ContentLengthSource(reader, length)
+    else:
+        return RequestBody()
+
+    # One deadline for the whole body, however it trickles in
+    reader.deadline = time.monotonic() + snapshot.CLIENT_BODY_TIMEOUT
+    expect_continue = lowered.get("expect", "").lower() == "100-continue"
+    return RequestBody(
+        source,
+        length,
+        max_size,
+        snapshot.CLIENT_BODY_BUFFER_SIZE,
+        snapshot.CLIENT_BODY_TEMP_PATH,
+        sock if expect_continue else None,
+    )
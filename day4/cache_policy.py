@@ -0,0 +1,169 @@
+"""
+Cache-Control / Expires for static files.
+
+    "cache_policy": {
+        "paths": {
+            "/index.html": "no-cache",
+            "/static/": {"max_age": "1h", "expires": true},
+            "/downloads/": {"no_store": true}
+        },
+        "extensions": {
+            ".css": {"max_age": "1d"},
+            ".png": {"max_age": "7d", "public": true},
+            ".html": {"no_cache": true}
+        },
+        "fingerprinted": {"max_age": "1y", "immutable": true}
+    }
+
+A policy is a Cache-Control string as is, or an object with max_age
+(seconds or "30s", "10m", "2h", "7d", "1y"), immutable, no_cache,
+no_store, public, private and expires (also send an Expires header,
+max_age from now, or 1970 with no_cache / no_store, like nginx's
+"expires"). Paths ending in "/" are directories, the others exact files.
+
+Names with a content hash in them ("app.3f9a1c.js", "vendor-8d2e5b7a.css")
+never change content, they get the "fingerprinted" policy (a year,
+immutable, on by default, false turns it off) so browsers stop
+revalidating them. "fingerprint_pattern" replaces the regex that spots
+them.
+
+The first match wins: the exact path, the deepest directory, a
+fingerprinted name, the extension, then the location's cache_control.
+Rules written for a path beat the guess from the name. Everything is
+compiled into dicts when the config is loaded, so a lookup is a handful
+of dict hits and one regex match however many rules there are.
+"""
+import email.utils
+import re
+import time
+
+# A dot or dash, then 6+ hex digits with at least one digit and one letter, then the extension
+FINGERPRINT_PATTERN = r"[.-](?=[0-9a-f]*[0-9])(?=[0-9a-f]*[a-f])[0-9a-f]{6,}\.[A-Za-z0-9]+$"
+FINGERPRINTED = {"max_age": "1y", "immutable": True}
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400, "y": 365 * 86400}
+FLAGS = ("immutable", "no_cache", "no_store", "public", "private")
+EPOCH = "Thu, 01 Jan 1970 00:00:01 GMT"
+
+
+def parse_duration(value):
+    # Seconds, or "30s", "10m", "2h", "7d", "1y"
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"expected seconds or a duration like \"7d\", got {value!r}")
+    if isinstance(value, str):
+        text = value.strip().lower()
+        unit = UNITS.get(text[-1:])
+        value = int(text[:-1]) * unit if unit else int(text)
+    value = int(value)
+    if value < 0:
+        raise ValueError("duration can't be negative")
+    return value
+
+
+class Policy:
+    __slots__ = ("cache_control", "max_age", "expires", "uncacheable", "_expires_at", "_expires_value")
+
+    def __init__(self, spec):
+        self.expires = False
+        self.max_age = None
+        self._expires_at = 0
+        self._expires_value = None
+        if isinstance(spec, str):
+            self.cache_control = spec
+            self.uncacheable = "no-cache" in spec or "no-store" in spec
+            return
+        if not isinstance(spec, dict):
+            raise ValueError(f"A cache policy is a Cache-Control string or an object, got {spec!r}")
+        unknown = spec.keys() - {"max_age", "expires", *FLAGS}
+        if unknown:
+            raise ValueError(f"Unknown cache policy settings: {', '.join(sorted(unknown))}")
+        parts = [name.replace("_", "-") for name in ("public", "private", "no_cache", "no_store") if spec.get(name)]
+        if spec.get("max_age") is not None:
+            self.max_age = parse_duration(spec["max_age"])
+            parts.append(f"max-age={self.max_age}")
+        if spec.get("immutable"):
+            parts.append("immutable")
+        self.cache_control = ", ".join(parts)
+        self.expires = bool(spec.get("expires"))
+        self.uncacheable = bool(spec.get("no_cache") or spec.get("no_store"))
+
+    def headers(self):
+        """Cache-Control and, when asked for, Expires."""
+        if not self.expires:
+            return {"Cache-Control": self.cache_control}
+        return {"Cache-Control": self.cache_control, "Expires": self.expires_value()}
+
+    def expires_value(self):
+        if self.uncacheable or not self.max_age:
+            return EPOCH
+        # Formatted once a second, a race only formats it twice
+        now = int(time.time())
+        if now != self._expires_at:
+            self._expires_value = email.utils.formatdate(now + self.max_age, usegmt=True)
+            self._expires_at = now
+        return self._expires_value
+
+
+class CachePolicies:
+    __slots__ = ("exact", "directories", "extensions", "fingerprinted", "fingerprint")
+
+    def __init__(self, config):
+        unknown = config.keys() - {"paths", "extensions", "fingerprinted", "fingerprint_pattern"}
+        if unknown:
+            raise ValueError(f"Unknown cache_policy settings: {', '.join(sorted(unknown))}")
+        self.exact = {}
+        self.directories = {}
+        for name in ("paths", "extensions"):
+            if not isinstance(config.get(name, {}), dict):
+                raise ValueError(f"cache_policy {name} has to be an object")
+        for path, spec in config.get("paths", {}).items():
+            if not path.startswith("/"):
+                raise ValueError(f"Cache policy path {path!r} has to start with /")
+            # "/static/" is kept as "/static" so the lookup can walk the parents
+            if path.endswith("/"):
+                self.directories[path.rstrip("/") or "/"] = Policy(spec)
+            else:
+                self.exact[path] = Policy(spec)
+        self.extensions = {
+            (ext if ext.startswith(".") else "." + ext).lower(): Policy(spec)
+            for ext, spec in config.get("extensions", {}).items()
+        }
+        fingerprinted = config.get("fingerprinted", FINGERPRINTED)
+        if fingerprinted is True:
+            fingerprinted = FINGERPRINTED
+        elif fingerprinted is not False and not isinstance(fingerprinted, (str, dict)):
+            raise ValueError(f"cache_policy fingerprinted is true, false or a policy, got {fingerprinted!r}")
+        self.fingerprinted = Policy(fingerprinted) if fingerprinted else None
+        pattern = config.get("fingerprint_pattern", FINGERPRINT_PATTERN)
+        if not isinstance(pattern, str):
+            raise ValueError(f"cache_policy fingerprint_pattern has to be a regex string, got {pattern!r}")
+        try:
+            self.fingerprint = re.compile(pattern)
+        except re.error as e:
+            raise ValueError(f"Bad cache_policy fingerprint_pattern {pattern!r}: {e}")
+
+    def lookup(self, path):
+        """The Policy for a request path, None when no rule matches."""
+        policy = self.exact.get(path)
+        if policy is not None:
+            return policy
+        if self.directories:
+            # As deep as the path, not as many as there are rules
+            end = path.rfind("/")
+            while end >= 0:
+                policy = self.directories.get(path[:end] or "/")
+                if policy is not None:
+                    return policy
+                end = path.rfind("/", 0, end)
+        if self.fingerprinted is not None and self.fingerprint.search(path):
+            return self.fingerprinted
+        if self.extensions:
+            dot = path.rfind(".")
+            if dot > path.rfind("/"):
+                return self.extensions.get(path[dot:].lower())
+        return None
+
+
+def compile_cache_policy(value):
+    if not isinstance(value, dict):
+        raise ValueError(f"expected an object, got {type(value).__name__}")
+    return CachePolicies(value)
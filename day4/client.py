@@ -1,23 +1,287 @@
-import concurrent.futures
+"""
+Load generator for the nginx clone (stdlib only).
+
+Unlike the old thread pool of `requests.get` calls this speaks raw HTTP/1.1
+over asyncio sockets, so it can reuse connections (keep-alive), pipeline
+several requests per write and run open-loop at a fixed request rate.
+In open-loop mode latency is measured from the time a request *should*
+have been sent, which avoids coordinated omission when the server stalls.
+
+    python client.py --scenario small --concurrency 50 --duration 10
+    python client.py --scenario all --rate 2000 --output result.json
+    python client.py --scenario time --baseline baseline.json
+    python client.py --fixtures /tmp/site    # small.html + large.bin to serve from ROOT=/tmp/site
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
 import time
-import requests
 
-url = "http://localhost:8000/time"
-start_time = time.time()
+# name -> (path, extra headers). Paths can be overridden from the command line.
+SCENARIOS = {
+    "small": ("{small}", {}),
+    "large": ("{large}", {}),
+    "range": ("{large}", {"Range": "bytes=0-16383"}),
+    "not_modified": ("{small}", {"If-None-Match": "{etag}"}),
+    "time": ("/time", {}),
+}
+
+# Files for the small / large scenarios, write them with --fixtures DIR and
+# serve DIR. Large is past sendfile_min_size (1m) so it takes the sendfile path.
+FIXTURES = {"small.html": 2 * 1024, "large.bin": 4 * 1024 * 1024}
+
+
+def write_fixtures(directory):
+    os.makedirs(directory, exist_ok=True)
+    for name, size in FIXTURES.items():
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(os.urandom(size))
+
+
+PERCENTILES = {"p50": 0.50, "p90": 0.90, "p99": 0.99, "p999": 0.999}
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+
+    def record(self, status, latency):
+        self.latencies.append(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+
+        def pick(q):
+            return round(latencies[min(count - 1, int(q * count))] * 1000, 3) if count else None
+
+        return {
+            "requests": count,
+            "errors": self.errors,
+            "duration_s": round(elapsed, 3),
+            "rps": round(count / elapsed, 1) if elapsed else 0.0,
+            "latency_ms": {
+                **{name: pick(q) for name, q in PERCENTILES.items()},
+                "mean": round(sum(latencies) / count * 1000, 3) if count else None,
+                "max": round(latencies[-1] * 1000, 3) if count else None,
+            },
+            "status": {str(k): v for k, v in sorted(self.statuses.items())},
+        }
+
+
+def build_request(args, path, headers):
+    lines = [
+        f"GET {path} HTTP/1.1",
+        f"Host: {args.host}:{args.port}",
+        f"Connection: {'keep-alive' if args.keep_alive else 'close'}",
+        *(f"{k}: {v}" for k, v in headers.items()),
+    ]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8")
+
+
+async def read_response(reader):
+    """Read one response, returns (status, headers). The body is read and dropped."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    # Interim responses (a 103 Early Hints) come before the real one, 101 is the last we get
+    while 100 <= status < 200 and status != 101:
+        head = await reader.readuntil(b"\r\n\r\n")
+        status = int(head.split(b" ", 2)[1])
+    _, *lines = head.decode("latin-1").split("\r\n")
+    headers = {}
+    for line in lines:
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+
+    if status in (101, 204, 304):
+        return status, headers
+    if "content-length" in headers:
+        await reader.readexactly(int(headers["content-length"]))
+    elif headers.get("connection", "").lower() == "close":
+        await reader.read()
+    return status, headers
 
-def hit(i):
+
+async def prime_etag(args, path):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
     try:
-        response = requests.get(url)
-        print(f"{i}: {response.json()}")
-    except Exception as e:
-        print("failed to get time")
-        raise e
+        writer.write(build_request(args, path, {}))
+        await writer.drain()
+        _, headers = await read_response(reader)
+        return headers.get("etag", "")
+    finally:
+        writer.close()
+
+
+async def produce(queue, rate, deadline):
+    """Open-loop schedule: one intended send time every 1/rate seconds."""
+    interval = 1.0 / rate
+    intended = time.perf_counter()
+    while intended < deadline:
+        queue.put_nowait(intended)
+        intended += interval
+        delay = intended - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def next_batch(args, queue, deadline):
+    if queue is None:
+        now = time.perf_counter()
+        return [now] * args.pipeline if now < deadline else []
+    try:
+        first = await asyncio.wait_for(queue.get(), deadline - time.perf_counter())
+    except (asyncio.TimeoutError, ValueError):
+        return []
+    batch = [first]
+    while len(batch) < args.pipeline and not queue.empty():
+        batch.append(queue.get_nowait())
+    return batch
+
+
+async def connection_worker(args, request, stats, queue, deadline):
+    reader = writer = None
+    while True:
+        batch = await next_batch(args, queue, deadline)
+        if not batch:
+            break
+        done = 0
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(args.host, args.port)
+            if queue is None:
+                # closed loop: latency starts when we actually send
+                batch = [time.perf_counter()] * len(batch)
+            writer.write(request * len(batch))
+            await writer.drain()
+            close = not args.keep_alive
+            for intended in batch:
+                status, headers = await asyncio.wait_for(read_response(reader), args.timeout)
+                stats.record(status, time.perf_counter() - intended)
+                done += 1
+                close = close or headers.get("connection", "").lower() == "close"
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            stats.errors += len(batch) - done
+            close = True
+        if close and writer is not None:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def run_scenario(args, name):
+    path, headers = SCENARIOS[name]
+    path = path.format(small=args.small_path, large=args.large_path)
+    if "{etag}" in headers.values():
+        etag = await prime_etag(args, path)
+        headers = {k: v.format(etag=etag) for k, v in headers.items()}
+    request = build_request(args, path, headers)
+
+    stats = Stats()
+    start = time.perf_counter()
+    deadline = start + args.duration
+    queue = None
+    tasks = []
+    if args.rate:
+        queue = asyncio.Queue()
+        tasks.append(asyncio.create_task(produce(queue, args.rate, deadline)))
+    tasks += [
+        asyncio.create_task(connection_worker(args, request, stats, queue, deadline))
+        for _ in range(args.concurrency)
+    ]
+    await asyncio.gather(*tasks)
+    result = stats.report(time.perf_counter() - start)
+    result["path"] = path
+    if queue is not None:
+        # requests that were due but never got a connection
+        result["backlog"] = queue.qsize()
+    return result
+
+
+def compare(results, baseline, threshold):
+    """Print the comparison and return the list of regressions."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        checks = [("rps", base["rps"], result["rps"], False)] + [
+            (f"latency {p}", base["latency_ms"][p], result["latency_ms"][p], True)
+            for p in ("p50", "p99")
+        ]
+        for metric, old, new, higher_is_worse in checks:
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = change > threshold if higher_is_worse else change < -threshold
+            flag = "REGRESSION" if worse else "ok"
+            print(f"{name:14} {metric:12} {old:>12} -> {new:<12} {change:+.1%} {flag}", file=sys.stderr)
+            if worse:
+                regressions.append(f"{name}: {metric}")
+    return regressions
+
+
+async def run(args):
+    names = list(SCENARIOS) if "all" in args.scenario else args.scenario
+    return {name: await run_scenario(args, name) for name in names}
 
 
 def main():
-    with concurrent.futures.ThreadPoolExecutor(max_workers=100) as executor:
-        for _ in executor.map(hit, range(100)):
-            ...
+    parser = argparse.ArgumentParser(description="Nginx Clone load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--scenario", action="append", choices=[*SCENARIOS, "all"],
+        help="Scenario to run, can be repeated (default: time)",
+    )
+    parser.add_argument("--concurrency", type=int, default=10, help="Number of connections")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per scenario")
+    parser.add_argument("--rate", type=float, help="Open-loop mode: total requests per second")
+    parser.add_argument("--pipeline", type=int, default=1, help="Requests in flight per connection")
+    parser.add_argument("--no-keep-alive", dest="keep_alive", action="store_false")
+    parser.add_argument("--timeout", type=float, default=5.0, help="Per response timeout")
+    parser.add_argument("--small-path", default="/small.html")
+    parser.add_argument("--large-path", default="/large.bin")
+    parser.add_argument("--fixtures", metavar="DIR", help="Write small.html and large.bin to DIR and exit")
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    parser.add_argument("--baseline", help="Compare against a previously saved result")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Allowed regression (0.10 = 10%%)")
+    args = parser.parse_args()
+    if args.fixtures:
+        write_fixtures(args.fixtures)
+        return
+    args.scenario = args.scenario or ["time"]
+
+    results = asyncio.run(run(args))
+    report = {
+        "config": {
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+            "rate": args.rate,
+            "pipeline": args.pipeline,
+            "keep_alive": args.keep_alive,
+        },
+        "scenarios": results,
+    }
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
 
-main()
-print(f"Took {time.time() - start_time}")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Load shedding: an adaptive limit on requests being dispatched at once, and
+per route bulkheads.
+
+    "adaptive_concurrency": true,
+    "concurrency_limit": [8, 64, 1024],    # min, initial, max
+    "concurrency_tolerance": 2              # latency growth taken as normal
+
+    @bind_handler("/report", max_concurrency=4)
+
+The limit follows latency like Netflix's gradient limiter: every finished
+request is compared with the no-load latency of its route (a handler, or
+the static path) and status, the smallest seen so far, slowly drifting up
+if the route got more expensive for good. Comparing per route keeps a mix
+of a fast file and a slow report from looking like congestion, and per
+status keeps a 404 or a 304, answered without reading the file, from
+setting the bar for the 200s. While the short term average of latency /
+baseline stays under `tolerance` the limit grows by about sqrt(limit)
+(only when requests actually use it), above it the limit shrinks in
+proportion. So when requests start to queue up for the CPU, a few of them
+pull the limit down and the ones above it get a 503 right away instead of
+waiting behind the rest.
+
+Only dispatch is measured (handler or static file lookup up to the
+response being ready), sending depends on the client, not on us.
+
+Off by default, the limits want tuning against the real traffic and a
+wrong one sheds requests we could have served.
+
+A bulkhead is a plain cap per handler: a route that's slow for its own
+reasons can't take more than `max_concurrency` of the capacity, whatever
+the adaptive limit is, and the static path keeps the rest.
+"""
+import math
+import threading
+import time
+
+# Weight of one sample in the short term average of the latency ratio
+SHORT_WEIGHT = 0.2
+# How fast a route's baseline follows latencies above it, so it still
+# catches up when the route really got more expensive
+BASELINE_DRIFT = 0.001
+
+
+class AdaptiveLimiter:
+    def __init__(self, min_limit, initial, max_limit, tolerance=2.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.limit = float(initial)
+        self.in_flight = 0
+        # Per (route, status) no-load latency, the route is the handler
+        # function, None for static files
+        self.baselines = {}
+        # Short term average of latency / baseline, 1 while nothing queues
+        self.ratio = 1.0
+        self.shed = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """True and counted as in flight, or False when the request has to be shed."""
+        with self.lock:
+            if self.in_flight >= int(self.limit):
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency, route=None, status=None):
+        key = (route, status)
+        with self.lock:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+            baseline = self.baselines.get(key)
+            if baseline is None or latency < baseline:
+                self.baselines[key] = baseline = latency
+            else:
+                self.baselines[key] = baseline + (latency - baseline) * BASELINE_DRIFT
+            self.ratio += (latency / baseline - self.ratio) * SHORT_WEIGHT if baseline else 0
+            gradient = max(0.5, min(1.0, self.tolerance / self.ratio))
+            # Don't grow the limit while we aren't even using half of it
+            headroom = math.sqrt(self.limit) if in_flight * 2 >= self.limit else 0
+            new_limit = self.limit * gradient + headroom
+            self.limit += (new_limit - self.limit) * SHORT_WEIGHT
+            self.limit = max(self.min_limit, min(self.max_limit, self.limit))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "shed": self.shed,
+                "latency_ratio": round(self.ratio, 2),
+            }
+
+
+class Bulkhead:
+    """At most `size` requests in a handler at once, the rest are shed."""
+
+    def __init__(self, size):
+        self.size = size
+        self.in_flight = 0
+        self.shed = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        with self.lock:
+            if self.in_flight >= self.size:
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+
+_lock = threading.Lock()
+_limiter = None
+_limiter_config = None
+
+
+def limiter_for(snapshot):
+    """The shared AdaptiveLimiter, None when adaptive_concurrency is off. Rebuilt when a reload changes it."""
+    global _limiter, _limiter_config
+    if not snapshot.ADAPTIVE_CONCURRENCY:
+        return None
+    config = (snapshot.CONCURRENCY_LIMIT, snapshot.CONCURRENCY_TOLERANCE)
+    if config != _limiter_config:
+        with _lock:
+            if config != _limiter_config:
+                _limiter = AdaptiveLimiter(*snapshot.CONCURRENCY_LIMIT, tolerance=snapshot.CONCURRENCY_TOLERANCE)
+                _limiter_config = config
+    return _limiter
+
+
+class Admission:
+    """
+    A dispatch that got past the bulkhead and the limiter, or `admitted`
+    False when it has to be shed. Used as a context manager around the
+    work, leaving it gives back whatever was taken. The work sets `status`
+    to its response's, the limiter compares latencies per route and status.
+    """
+
+    __slots__ = ("limiter", "bulkhead", "route", "start", "admitted", "status")
+
+    def __init__(self, limiter, bulkhead, route=None):
+        self.limiter = limiter
+        self.route = route
+        self.bulkhead = bulkhead
+        self.start = time.monotonic()
+        self.admitted = True
+        self.status = None
+        if bulkhead is not None and not bulkhead.try_acquire():
+            self.bulkhead = self.limiter = None
+            self.admitted = False
+        elif limiter is not None and not limiter.try_acquire():
+            self.limiter = None
+            self.admitted = False
+            if bulkhead is not None:
+                bulkhead.release()
+                self.bulkhead = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.bulkhead is not None:
+            self.bulkhead.release()
+        if self.limiter is not None:
+            self.limiter.release(time.monotonic() - self.start, self.route, self.status)
+
+
+def admit(snapshot, handler_function=None):
+    return Admission(limiter_for(snapshot), getattr(handler_function, "bulkhead", None), handler_function)
+
+
+def stats(snapshot):
+    limiter = limiter_for(snapshot)
+    return limiter.stats() if limiter else {}
@@ -1,61 +1,209 @@
 import socket
+import ssl
+import threading
 from pathlib import Path
 
+import concurrency
+import early_hints
+import http2
+import sockopts
+from body import RequestError, SocketReader, open_body
 from request import parse_request
-from response import http_response, static_file_response
+from response import canned_response, handler_response, send_deadline, static_file_response
 from settings import settings
 from status_code import HttpResponseCode
+from timing import RequestTimer
 
 logger = settings.logger
+slow_logger = settings.slow_logger
+
+
+# Readers of the open HTTP/1.1 connections, reap_idle() looks for idle ones among them
+readers = set()
+readers_lock = threading.Lock()
+
+
+def reap_idle(count=1):
+    """Close up to `count` connections idling between requests, longest idle first. Returns how many."""
+    with readers_lock:
+        idle = sorted((r for r in readers if r.idle_since is not None), key=lambda r: r.idle_since)
+    for reader in idle[:count]:
+        try:
+            # Their thread wakes up from recv() with b"" and closes the connection
+            reader.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    return len(idle[:count])
+
+
+# Set on graceful shutdown, keep-alive connections close after their current response
+draining = threading.Event()
+
+
+def drain_idle():
+    """
+    Graceful shutdown: close the keep-alive connections waiting for a request
+    and GOAWAY the HTTP/2 ones, busy HTTP/1.1 connections close after their
+    response. Called again while draining for the ones that went idle since.
+    Returns how many idle connections were closed.
+    """
+    draining.set()
+    http2.drain_all()
+    with readers_lock:
+        count = len(readers)
+    return reap_idle(count)
+
+
+def idle_count():
+    with readers_lock:
+        return sum(1 for r in readers if r.idle_since is not None)
+
+
+def log_timings(request, addr, response, timer: RequestTimer):
+    status = response.status.decode("ascii", errors="ignore")
+    line = f'{addr[0]} "{request.method} {request.path}" {status} {timer.summary()}'
+    logger.info(line)
+    if timer.total_ms >= request.settings.SLOW_REQUEST_MS:
+        slow_logger.warning(line)
+
+
+def dispatch(request):
+    """Run the handler or the static path, returns the response bytes or a (head, stream_function) tuple."""
+    timer = request.timer
+    snapshot = request.settings or settings.snapshot
+    # 103s only for GETs, a HEAD or a POST isn't a page being loaded
+    hinting = snapshot.EARLY_HINTS and request.early_hints is not None and request.method == "GET"
+    with concurrency.admit(snapshot, request.handler_function) as admission:
+        if not admission.admitted:
+            # Shed fast, queueing behind whatever is slow would only make it slower
+            timer.lap("shed")
+            return canned_response(HttpResponseCode.HTTP_503_SERVICE_UNAVAILABLE, extra=b"Retry-After: 1\r\n")
+        if request.handler_function:
+            if hinting:
+                send_early_hints(request, early_hints.for_handler(snapshot, request.path, request.handler_function))
+            response = handler_response(request)
+            if hinting:
+                early_hints.learn(snapshot, request.path, request.handler_function, response)
+            timer.lap("handler")
+        elif request.method in ("GET", "HEAD"):
+            path = (request.location.root / Path(request.path.lstrip("/"))).resolve()
+            if path.is_file():
+                if hinting:
+                    send_early_hints(request, early_hints.for_file(snapshot, request.path, path))
+                response = static_file_response(path, request, head_only=request.method == "HEAD")
+            else:
+                response = canned_response(HttpResponseCode.HTTP_404_NOT_FOUND)
+            timer.lap("static")
+
+        else:
+            response = canned_response(HttpResponseCode.HTTP_404_NOT_FOUND)
+        # A 404 or a 304 is cheaper than the 200s, each status gets its own baseline
+        admission.status = (response[0] if isinstance(response, tuple) else response).status
+    return response
+
+
+def send_early_hints(request, hints):
+    if hints is not None:
+        request.early_hints(hints)
+        request.timer.lap("early_hints")
 
 
 def handle_request(client_socket, addr):
+    # Buffered, bytes past the current request are kept for the next one
+    reader = SocketReader(client_socket)
+    # h2c is cleartext only (RFC 7540 3.2), and http2 reads and writes from two
+    # threads, which one SSLSocket can't take
+    cleartext = not isinstance(client_socket, ssl.SSLSocket)
+    with readers_lock:
+        readers.add(reader)
+    # A new connection gets client_header_timeout to send its first request
+    idle_timeout = settings.CLIENT_HEADER_TIMEOUT
     try:
-        client_socket.settimeout(0.5)
         while True:
-            req_data = client_socket.recv(8 * 1024)
+            timer = RequestTimer()
+            snapshot = settings.snapshot
+            req_data = reader.read_head(
+                idle_timeout, snapshot.CLIENT_HEADER_TIMEOUT, snapshot.LARGE_CLIENT_HEADER_BUFFERS
+            )
+            idle_timeout = snapshot.KEEPALIVE_TIMEOUT
+            if req_data:
+                # From the head's first byte, the client's idle time isn't ours
+                timer.restart(reader.head_started)
+            timer.lap("recv")
             print(req_data)
             if not req_data:
                 logger.info(f"Connection closed by {addr[0]}")
                 break
-            request = parse_request(req_data, addr)
-
-            if request.handler_function:
-                response = request.handler_function(request)
-            elif request.method in ("GET", "HEAD"):
-                path = (settings.ROOT / Path(request.path.lstrip("/"))).resolve()
-                if path.is_file():
-                    response = static_file_response(path, request, head_only=request.method == "HEAD")
-                else:
-                    response = http_response(
-                        HttpResponseCode.HTTP_RESPONSE_MESSAGES[
-                            HttpResponseCode.HTTP_404_NOT_FOUND
-                        ],
-                        HttpResponseCode.HTTP_404_NOT_FOUND,
-                        "text/plain",
-                    )
+            if req_data.startswith(http2.PREFACE[:14]):
+                # "PRI * HTTP/2.0", a client that knows we speak h2c
+                if not (snapshot.HTTP2 and cleartext):
+                    raise RequestError(HttpResponseCode.HTTP_400_BAD_REQUEST, "HTTP/2 preface without h2c")
+                with readers_lock:
+                    readers.discard(reader)
+                http2.serve(client_socket, addr, initial=req_data + reader.take_buffer())
+                break
+            # Config is read once per request, a SIGHUP reload applies to the next one
+            request = parse_request(req_data, addr, timer, snapshot)
+            request.body = open_body(request.headers, reader, client_socket, snapshot)
 
-            else:
-                response = http_response(
-                    HttpResponseCode.HTTP_RESPONSE_MESSAGES[
-                        HttpResponseCode.HTTP_404_NOT_FOUND
-                    ],
-                    HttpResponseCode.HTTP_404_NOT_FOUND,
-                    "text/plain",
-                )
+            if (
+                snapshot.HTTP2
+                and cleartext
+                and "h2c" in request.headers.get("Upgrade", "")
+                and "HTTP2-Settings" in request.headers
+                and request.body.finished
+            ):
+                # RFC 7540 3.2, answer this request as stream 1 of an HTTP/2 connection
+                client_socket.sendall(http2.UPGRADE_RESPONSE)
+                with readers_lock:
+                    readers.discard(reader)
+                http2.serve(client_socket, addr, upgrade=request)
+                break
 
+            if req_data.split(b"\r\n", 1)[0].endswith(b"HTTP/1.1"):
+                # Never to HTTP/1.0 clients, they don't know 1xx responses
+                request.early_hints = lambda hints: client_socket.sendall(hints.http1)
+            response = dispatch(request)
+
+            stream_function = None
             if isinstance(response, tuple):
-                head, stream_function = response
-                client_socket.sendall(head)
-                stream_function(client_socket)
+                response, stream_function = response
+            if snapshot.SERVER_TIMING:
+                response = response.add_header("Server-Timing", timer.server_timing())
+            if draining.is_set():
+                # Shutting down, the client should take its next request elsewhere
+                response = response.closing()
+            if stream_function:
+                # Corked, the head leaves in the same packet as the start of the body
+                with sockopts.corked(client_socket, snapshot):
+                    response.send(client_socket, send_deadline(snapshot, len(response)))
+                    # The stream function applies send_timeout / send_min_rate to the body itself
+                    stream_function(client_socket)
             else:
-                client_socket.sendall(response)
+                response.send(client_socket, send_deadline(snapshot, len(response)))
+            timer.lap("send")
+
+            log_timings(request, addr, response, timer)
 
-            logger.info(f"Response sent to {addr[0]}")
+            # The next request starts after this one's body, read what the handler left
+            if request.body.waiting_for_continue:
+                # The client never sent it, we can't tell where the next request starts
+                logger.info(f"Body not read, closing connection to {addr[0]}")
+                break
+            try:
+                request.body.drain()
+            except RequestError as e:
+                logger.info(f"Bad request body from {addr[0]}: {e}")
+                break
+            finally:
+                request.body.close()
 
             connection_header = request.headers.get("Connection", "")
 
-            if connection_header == "close":
+            if draining.is_set():
+                logger.info(f"Shutting down, closing connection to {addr[0]}")
+                break
+            elif connection_header == "close":
                 logger.info(f"Closing connection to {addr[0]}")
                 break
             elif connection_header != "keep-alive":
@@ -64,10 +212,26 @@ def handle_request(client_socket, addr):
 
             logger.info(f"Keeping connection alive for {addr[0]}")
 
+    except RequestError as e:
+        logger.info(f"Bad request from {addr[0]}: {e}")
+        try:
+            # Short timeout, the client may be the slow one
+            client_socket.settimeout(1)
+            canned_response(e.status, keep_open=False).send(client_socket)
+        except OSError:
+            pass
     except socket.timeout:
-        logger.warning(f"Request from {addr[0]} timed out")
-        logger.info(f"Connection closed after timeout for {addr[0]}")
+        if reader.idle_since is not None:
+            logger.info(f"Closing idle connection to {addr[0]}")
+        else:
+            logger.warning(f"Request from {addr[0]} timed out")
+            logger.info(f"Connection closed after timeout for {addr[0]}")
+    except (ConnectionResetError, BrokenPipeError) as e:
+        # The client went away mid response, nothing to answer and nobody to answer to
+        logger.info(f"Connection to {addr[0]} lost: {e}")
     finally:
+        with readers_lock:
+            readers.discard(reader)
         try:
             client_socket.close()
             logger.info(f"Connection to {addr[0]} closed")
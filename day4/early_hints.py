@@ -0,0 +1,243 @@
+"""
+103 Early Hints: tell the browser what a page needs before the page itself.
+
+    "early_hints": true,
+    "early_hints_auto": true,       # learn the links from the HTML
+    "early_hints_links": {
+        "/index.html": ["/index.css", "/file.jpg"],
+        "/report": ["</app.js>; rel=modulepreload", {"href": "/font.woff2", "as": "font"}]
+    }
+
+    @bind_handler("/dashboard", early_hints=["/dashboard.css"])
+
+A browser only finds a page's stylesheets, scripts and images once the
+HTML arrives and gets parsed. With "HTTP/1.1 103 Early Hints" and a
+"Link: </index.css>; rel=preload; as=style" sent as soon as the request is
+routed, it starts fetching them while we are still working on the page (a
+slow handler, a large HTML file on a slow link), instead of a round trip
+after. Clients that don't know 103 (HTTP/1.0 ones never get one) must skip
+it, but some HTTP/1.1 libraries (Python's http.client for one) don't, so
+it's off by default.
+
+A link is a path ("as" guessed from the extension), a whole Link value, or
+an object with href, as, type and crossorigin. Where hints come from, first
+match wins: early_hints_links for the exact path, the handler's
+early_hints, then with early_hints_auto the links found in the page. For a
+static .html file that is its <link rel=stylesheet/preload/modulepreload>,
+<script src> and non lazy <img src> in document order, up to MAX_LINKS, same
+origin only. It is parsed once and cached until its mtime/size (what the
+ETag is made of) change. A handler's HTML is parsed from its 200 responses
+when they carry an ETag (etag=True or version=) and used for its next
+requests, once per ETag too.
+"""
+import os
+import urllib.parse as urlparse
+from html.parser import HTMLParser
+
+MAX_LINKS = 8
+# Enough for the <head> and the top of the body of any sane page
+MAX_HTML_SIZE = 512 * 1024
+MAX_LEARNED = 4096
+HTML_SUFFIXES = (".html", ".htm")
+
+DESTINATIONS = {
+    ".css": "style",
+    ".js": "script", ".mjs": "script",
+    ".png": "image", ".jpg": "image", ".jpeg": "image", ".gif": "image",
+    ".webp": "image", ".avif": "image", ".svg": "image", ".ico": "image",
+    ".woff": "font", ".woff2": "font", ".ttf": "font", ".otf": "font",
+}
+
+H2_STATUS = (b":status", b"103")
+HTTP1_STATUS = b"HTTP/1.1 103 Early Hints\r\n"
+
+
+class Hints:
+    """Link values with the 103 already serialized for HTTP/1.1 and as an HTTP/2 header list."""
+
+    __slots__ = ("links", "http1", "h2")
+
+    def __init__(self, links):
+        self.links = tuple(links)
+        value = ", ".join(self.links).encode("latin-1")
+        self.http1 = HTTP1_STATUS + b"Link: " + value + b"\r\n\r\n"
+        self.h2 = [H2_STATUS, (b"link", value)]
+
+
+def format_link(link):
+    """A path, a ready Link value or {"href", "as", "type", "crossorigin"} -> Link value."""
+    if isinstance(link, str):
+        if link.startswith("<"):
+            return link
+        link = {"href": link}
+    if not isinstance(link, dict) or not link.get("href"):
+        raise ValueError(f"expected a path, a Link value or an object with href, got {link!r}")
+    unknown = link.keys() - {"href", "as", "type", "crossorigin", "rel"}
+    if unknown:
+        raise ValueError(f"Unknown early hint settings: {', '.join(sorted(unknown))}")
+    href = link["href"]
+    rel = link.get("rel", "preload")
+    parts = [f"<{href}>", f"rel={rel}"]
+    destination = link.get("as") or DESTINATIONS.get(os.path.splitext(urlparse.urlsplit(href).path)[1].lower())
+    if destination and rel == "preload":
+        parts.append(f"as={destination}")
+    if link.get("type"):
+        parts.append(f'type="{link["type"]}"')
+    # Fonts are always fetched in CORS mode, a preload without it is wasted
+    crossorigin = link.get("crossorigin", destination == "font")
+    if crossorigin:
+        parts.append("crossorigin" if crossorigin is True else f"crossorigin={crossorigin}")
+    return "; ".join(parts)
+
+
+def compile_links(links):
+    if not links:
+        return None
+    if isinstance(links, (str, dict)):
+        links = [links]
+    return Hints(format_link(link) for link in links)
+
+
+def compile_early_hint_links(value):
+    if not isinstance(value, dict):
+        raise ValueError(f"expected an object, got {type(value).__name__}")
+    compiled = {}
+    for path, links in value.items():
+        if not path.startswith("/"):
+            raise ValueError(f"Early hints path {path!r} has to start with /")
+        compiled[path] = compile_links(links)
+    return compiled
+
+
+class LinkFinder(HTMLParser):
+    """What a browser's preload scanner would fetch first, as Link values."""
+
+    def __init__(self, base):
+        super().__init__(convert_charrefs=True)
+        self.base = base
+        self.links = []
+        self.seen = set()
+
+    def handle_starttag(self, tag, attrs):
+        if len(self.links) >= MAX_LINKS:
+            return
+        attrs = dict(attrs)
+        if tag == "link":
+            rels = (attrs.get("rel") or "").lower().split()
+            if "stylesheet" in rels:
+                self.add(attrs.get("href"), "preload", "style")
+            elif "preload" in rels:
+                self.add(
+                    attrs.get("href"), "preload", attrs.get("as"), attrs.get("type"), attrs.get("crossorigin", False)
+                )
+            elif "modulepreload" in rels:
+                self.add(attrs.get("href"), "modulepreload")
+        elif tag == "script" and attrs.get("src"):
+            if (attrs.get("type") or "").lower() == "module":
+                self.add(attrs["src"], "modulepreload")
+            else:
+                self.add(attrs["src"], "preload", "script")
+        elif tag == "img" and (attrs.get("loading") or "").lower() != "lazy":
+            self.add(attrs.get("src"), "preload", "image")
+
+    def add(self, href, rel, destination=None, content_type=None, crossorigin=False):
+        if not href:
+            return
+        url = urlparse.urlsplit(href.strip())
+        # Same origin paths only, a preload for another host needs its own connection anyway
+        if url.scheme or url.netloc:
+            return
+        # Percent encoded, a Link header is latin-1
+        path = urlparse.quote(urlparse.urljoin(self.base, url.path), safe="/%:@!$&'()*+,;=~")
+        if not url.path or path in self.seen:
+            return
+        self.seen.add(path)
+        link = {"href": path + (f"?{url.query}" if url.query else ""), "rel": rel, "as": destination}
+        if content_type:
+            link["type"] = content_type
+        if crossorigin is not False:
+            # A bare crossorigin attribute comes as None
+            link["crossorigin"] = crossorigin or True
+        self.links.append(format_link(link))
+
+
+def find_links(html, base):
+    """Hints for the subresources of an HTML page served at `base`, None when it has none."""
+    finder = LinkFinder(base)
+    try:
+        finder.feed(html.decode("utf-8", errors="replace"))
+        finder.close()
+    except Exception:
+        # Garbage in, no hints out, the page is still served as usual
+        pass
+    return Hints(finder.links) if finder.links else None
+
+
+# (request path, file path or handler name) -> (validator, Hints or None),
+# the validator is the file's (mtime, size) or the handler's ETag
+learned = {}
+
+
+def remember(key, validator, hints):
+    if len(learned) >= MAX_LEARNED:
+        learned.clear()
+    learned[key] = (validator, hints)
+    return hints
+
+
+def for_file(snapshot, request_path, file_path):
+    """Hints to send before serving `file_path`, None when there are none."""
+    hints = snapshot.EARLY_HINTS_LINKS.get(request_path)
+    if hints is not None or not snapshot.EARLY_HINTS_AUTO or not file_path.name.lower().endswith(HTML_SUFFIXES):
+        return hints
+    try:
+        stats = file_path.stat()
+    except OSError:
+        return None
+    validator = (stats.st_mtime, stats.st_size)
+    key = (request_path, str(file_path))
+    cached = learned.get(key)
+    if cached is not None and cached[0] == validator:
+        return cached[1]
+    try:
+        with open(file_path, "rb") as f:
+            html = f.read(MAX_HTML_SIZE)
+    except OSError:
+        return None
+    return remember(key, validator, find_links(html, request_path))
+
+
+def for_handler(snapshot, request_path, handler_function):
+    hints = snapshot.EARLY_HINTS_LINKS.get(request_path)
+    if hints is None:
+        hints = getattr(handler_function, "early_hints", None)
+    if hints is None and snapshot.EARLY_HINTS_AUTO:
+        cached = learned.get((request_path, handler_function.__name__))
+        hints = cached[1] if cached else None
+    return hints
+
+
+def header_value(head, name):
+    """A header's value from a serialized response head, None when missing. `name` is lower case bytes."""
+    for line in head.split(b"\r\n")[1:]:
+        key, sep, value = line.partition(b":")
+        if sep and key.strip().lower() == name:
+            return value.strip()
+    return None
+
+
+def learn(snapshot, request_path, handler_function, response):
+    """Keep the links of a handler's HTML response for its next requests, parsed once per ETag."""
+    if not snapshot.EARLY_HINTS_AUTO or isinstance(response, tuple) or response.status != b"200":
+        return
+    etag = header_value(response.head, b"etag")
+    if etag is None:
+        return
+    key = (request_path, handler_function.__name__)
+    cached = learned.get(key)
+    if cached is not None and cached[0] == etag:
+        return
+    content_type = header_value(response.head, b"content-type") or b""
+    if not content_type.startswith(b"text/html"):
+        return
+    remember(key, etag, find_links(bytes(response.body[:MAX_HTML_SIZE]), request_path))
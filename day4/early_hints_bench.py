@@ -0,0 +1,189 @@
+"""
+Page load benchmark: 103 Early Hints on and off, over a simulated RTT.
+
+Generates a page with a stylesheet, a script and --images images, runs the
+server in-process behind h2_bench's DelayProxy (half of --rtt-ms each way)
+and loads it like an HTTP/1.1 browser with 6 connections per host: fetch
+the page, then its assets. With hints the browser opens the other
+connections and starts on the hinted assets as soon as the 103 is in,
+without them only once the HTML is. Two pages:
+
+    static    index.html from disk, the 103 goes out right before it
+    handler   /page rendered by a handler taking --think-ms (a template,
+              a database), the 103 goes out before it starts
+
+A page load ends when the last asset is in.
+
+    python early_hints_bench.py --rtt-ms 50 --think-ms 100 --runs 5
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from h2_bench import DelayProxy, connect, free_port
+from routes import bind_handler
+from settings import settings
+
+CONNECTIONS = 6
+LINK = re.compile(rb"<([^>]+)>")
+
+
+def make_site(directory, images, size):
+    names = ["site.css", "app.js"] + [f"image-{i:02}.jpg" for i in range(images)]
+    for name in names:
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(os.urandom(size))
+    with open(os.path.join(directory, "index.html"), "w") as f:
+        f.write('<html><head><link rel="stylesheet" href="site.css"><script src="app.js"></script></head><body>\n')
+        f.writelines(f'<img src="{name}">\n' for name in names[2:])
+        f.write("</body></html>\n")
+    return ["/" + name for name in names]
+
+
+def read_head(sock, buffer):
+    while b"\r\n\r\n" not in buffer:
+        data = sock.recv(64 * 1024)
+        if not data:
+            raise ConnectionError("closed")
+        buffer += data
+    head, _, rest = bytes(buffer).partition(b"\r\n\r\n")
+    buffer[:] = rest
+    return head
+
+
+def get(sock, buffer, path, on_hints=None):
+    """One request, 103s go to on_hints(paths) as they come. Returns (status, body)."""
+    sock.sendall(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: keep-alive\r\n\r\n".encode())
+    head = read_head(sock, buffer)
+    while head.startswith(b"HTTP/1.1 103"):
+        if on_hints:
+            on_hints([link.decode() for link in LINK.findall(head)])
+        head = read_head(sock, buffer)
+    length = 0
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    while len(buffer) < length:
+        buffer += sock.recv(64 * 1024)
+    body = bytes(buffer[:length])
+    del buffer[:length]
+    return head[9:12], body
+
+
+def page_load(port, page, assets):
+    todo = queue.Queue()
+    requested = set()
+    errors = []
+    threads = []
+
+    def want(paths):
+        for path in paths:
+            if path not in requested:
+                requested.add(path)
+                todo.put(path)
+
+    def worker(sock, buffer):
+        with sock:
+            while (path := todo.get()) is not None:
+                status, _ = get(sock, buffer, path)
+                if status != b"200":
+                    errors.append(path)
+
+    def open_connections(paths):
+        # Like a browser acting on the 103: more connections, fetching right away
+        want(paths)
+        if not threads:
+            threads.extend(
+                threading.Thread(target=lambda: worker(connect(port), bytearray())) for _ in range(CONNECTIONS - 1)
+            )
+            for thread in threads:
+                thread.start()
+
+    start = time.perf_counter()
+    first = connect(port)
+    buffer = bytearray()
+    status, body = get(first, buffer, page, on_hints=open_connections)
+    if status != b"200":
+        raise RuntimeError(f"{page} returned {status}")
+    # The HTML is in, parsing it finds the rest (all of it without hints)
+    open_connections([path for path in assets if path[1:].encode() in body])
+    threads.append(threading.Thread(target=worker, args=(first, buffer)))
+    threads[-1].start()
+    for _ in threads:
+        todo.put(None)
+    for thread in threads:
+        thread.join()
+    if errors or requested != set(assets):
+        raise RuntimeError(f"page load failed for {errors[:3] or sorted(set(assets) - requested)[:3]}")
+    return time.perf_counter() - start
+
+
+def summarize(times):
+    return {
+        "median_ms": round(statistics.median(times) * 1000, 2),
+        "min_ms": round(min(times) * 1000, 2),
+        "max_ms": round(max(times) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Page load time with and without 103 Early Hints")
+    parser.add_argument("--images", type=int, default=4)
+    parser.add_argument("--asset-size", type=int, default=32 * 1024, help="Bytes per asset")
+    parser.add_argument("--rtt-ms", type=float, default=50, help="Simulated round trip time")
+    parser.add_argument("--think-ms", type=float, default=100, help="Time the handler takes to render /page")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    sys.stdout, report_to = open(os.devnull, "w"), sys.stdout
+
+    results = {"rtt_ms": args.rtt_ms, "think_ms": args.think_ms, "assets": args.images + 2}
+    with tempfile.TemporaryDirectory() as directory:
+        assets = make_site(directory, args.images, args.asset_size)
+        with open(os.path.join(directory, "index.html"), "rb") as f:
+            html = f.read()
+        port = free_port()
+        settings.configure(HOST="127.0.0.1", PORT=port, ROOT=directory)
+        import server  # noqa: E402  (imports the handlers too)
+        from response import http_response  # noqa: E402
+
+        # With an ETag, so its links are learned from the first response
+        @bind_handler("/page", etag=True)
+        def page_handler(request):
+            time.sleep(args.think_ms / 1000)
+            return http_response(html, content_type="text/html")
+
+        threading.Thread(target=server.start_server, daemon=True).start()
+        time.sleep(0.5)
+        port = DelayProxy(port, args.rtt_ms / 2000).port
+
+        for name, page in (("static", "/index.html"), ("handler", "/page")):
+            results[name] = {}
+            for hints in (False, True):
+                settings.configure(EARLY_HINTS=hints)
+                page_load(port, page, assets)  # warm up, and the handler's links get learned
+                times = [page_load(port, page, assets) for _ in range(args.runs)]
+                results[name]["early_hints" if hints else "no_hints"] = summarize(times)
+            results[name]["saved_ms"] = round(
+                results[name]["no_hints"]["median_ms"] - results[name]["early_hints"]["median_ms"], 2
+            )
+
+    print(json.dumps(results, indent=4), file=report_to)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
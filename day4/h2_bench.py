@@ -0,0 +1,301 @@
+"""
+Page load benchmark: one HTML page and its assets over HTTP/1.1 on 6
+connections (what browsers open per host) vs HTTP/2 on a single connection.
+
+Generates a throwaway site with --assets files, runs the server in-process
+and puts a small proxy in front of it that delays every chunk by half of
+--rtt-ms each way, since on bare loopback there are no round trips to save.
+A page load is: fetch index.html, then every asset, on fresh connections.
+
+    python h2_bench.py --assets 50 --rtt-ms 20 --runs 5
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import socket
+import statistics
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+import http2
+from hpack_codec import Decoder, Encoder
+from settings import settings
+
+H1_CONNECTIONS = 6
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_site(directory, assets, size):
+    names = [f"asset-{i:03}.png" for i in range(assets)]
+    for name in names:
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(os.urandom(size))
+    with open(os.path.join(directory, "index.html"), "w") as f:
+        f.write("<html><body>\n")
+        f.writelines(f'<img src="/{name}">\n' for name in names)
+        f.write("</body></html>\n")
+    return ["/" + name for name in names]
+
+
+class DelayProxy:
+    """TCP proxy that delivers everything `delay` seconds late, in both directions."""
+
+    def __init__(self, upstream_port, delay):
+        self.upstream_port = upstream_port
+        self.delay = delay
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            client, _ = self.listener.accept()
+            upstream = socket.create_connection(("127.0.0.1", self.upstream_port))
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.pipe(client, upstream)
+            self.pipe(upstream, client)
+
+    def pipe(self, src, dst):
+        pending = queue.Queue()
+
+        def read():
+            while data := src.recv(256 * 1024):
+                pending.put((time.monotonic() + self.delay, data))
+            pending.put((0, b""))
+
+        def write():
+            while True:
+                due, data = pending.get()
+                if not data:
+                    try:
+                        dst.shutdown(socket.SHUT_WR)
+                    except OSError:
+                        pass
+                    return
+                time.sleep(max(0, due - time.monotonic()))
+                dst.sendall(data)
+
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=write, daemon=True).start()
+
+
+def connect(port):
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+# ------------------- HTTP/1.1 -------------------
+
+
+def h1_get(sock, buffer, path):
+    sock.sendall(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: keep-alive\r\n\r\n".encode())
+    while b"\r\n\r\n" not in buffer:
+        buffer += sock.recv(64 * 1024)
+    head, _, rest = bytes(buffer).partition(b"\r\n\r\n")
+    length = 0
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    buffer[:] = rest
+    while len(buffer) < length:
+        buffer += sock.recv(64 * 1024)
+    body = bytes(buffer[:length])
+    del buffer[:length]
+    return head[9:12], body
+
+
+def h1_page_load(port, assets):
+    todo = queue.Queue()
+    for path in assets:
+        todo.put(path)
+    errors = []
+
+    def worker(sock, buffer):
+        try:
+            while True:
+                try:
+                    path = todo.get_nowait()
+                except queue.Empty:
+                    return
+                status, _ = h1_get(sock, buffer, path)
+                if status != b"200":
+                    errors.append(path)
+        finally:
+            sock.close()
+
+    start = time.perf_counter()
+    first = connect(port)
+    buffer = bytearray()
+    h1_get(first, buffer, "/index.html")
+    threads = [threading.Thread(target=worker, args=(first, buffer))]
+    # The browser opens the other connections once it sees the assets
+    threads += [
+        threading.Thread(target=lambda: worker(connect(port), bytearray()))
+        for _ in range(H1_CONNECTIONS - 1)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise RuntimeError(f"HTTP/1.1 failed for {errors[:3]}")
+    return time.perf_counter() - start
+
+
+# ------------------- HTTP/2 -------------------
+
+
+class H2Client:
+    WINDOW = 16 * 1024 * 1024
+
+    def __init__(self, port):
+        self.sock = connect(port)
+        self.buffer = bytearray()
+        self.encoder = Encoder()
+        self.decoder = Decoder()
+        self.next_id = 1
+        self.consumed = 0
+        self.sock.sendall(
+            http2.PREFACE
+            + http2.frame(http2.SETTINGS, 0, 0, http2.settings_payload({
+                http2.ENABLE_PUSH: 0,
+                http2.INITIAL_WINDOW_SIZE: self.WINDOW,
+            }))
+            + http2.frame(http2.WINDOW_UPDATE, 0, 0, struct.pack(">I", self.WINDOW))
+        )
+
+    def request(self, paths):
+        """Send all the requests at once, returns {path: status} once every stream ended."""
+        out = []
+        streams = {}
+        for path in paths:
+            block = self.encoder.encode([
+                (b":method", b"GET"), (b":scheme", b"http"),
+                (b":authority", b"localhost"), (b":path", path.encode()),
+            ])
+            out.append(http2.frame(http2.HEADERS, http2.END_HEADERS | http2.END_STREAM, self.next_id, block))
+            streams[self.next_id] = path
+            self.next_id += 2
+        self.sock.sendall(b"".join(out))
+
+        statuses = {}
+        pending = set(streams)
+        while pending:
+            frame_type, flags, stream_id, payload = self.read_frame()
+            if frame_type == http2.HEADERS:
+                statuses[streams[stream_id]] = dict(self.decoder.decode(payload))[b":status"]
+            elif frame_type == http2.DATA:
+                self.consumed += len(payload)
+                if self.consumed > self.WINDOW // 2:
+                    self.sock.sendall(http2.frame(http2.WINDOW_UPDATE, 0, 0, struct.pack(">I", self.consumed)))
+                    self.consumed = 0
+            elif frame_type == http2.SETTINGS and not flags & http2.ACK:
+                self.sock.sendall(http2.frame(http2.SETTINGS, http2.ACK, 0))
+            elif frame_type == http2.PING and not flags & http2.ACK:
+                self.sock.sendall(http2.frame(http2.PING, http2.ACK, 0, payload))
+            elif frame_type in (http2.RST_STREAM, http2.GOAWAY):
+                raise RuntimeError(f"HTTP/2 stream {stream_id} failed")
+            if frame_type in (http2.HEADERS, http2.DATA) and flags & http2.END_STREAM:
+                pending.discard(stream_id)
+        return statuses
+
+    def read_frame(self):
+        while len(self.buffer) < 9:
+            self.recv()
+        length = int.from_bytes(self.buffer[:3], "big")
+        while len(self.buffer) < 9 + length:
+            self.recv()
+        frame_type, flags, stream_id = struct.unpack_from(">BBI", self.buffer, 3)
+        payload = bytes(self.buffer[9 : 9 + length])
+        del self.buffer[: 9 + length]
+        return frame_type, flags, stream_id, payload
+
+    def recv(self):
+        data = self.sock.recv(256 * 1024)
+        if not data:
+            raise RuntimeError("HTTP/2 connection closed")
+        self.buffer += data
+
+    def close(self):
+        self.sock.close()
+
+
+def h2_page_load(port, assets):
+    start = time.perf_counter()
+    client = H2Client(port)
+    try:
+        client.request(["/index.html"])
+        statuses = client.request(assets)
+    finally:
+        client.close()
+    failed = [path for path, status in statuses.items() if status != b"200"]
+    if failed:
+        raise RuntimeError(f"HTTP/2 failed for {failed[:3]}")
+    return time.perf_counter() - start
+
+
+def summarize(times):
+    return {
+        "median_ms": round(statistics.median(times) * 1000, 2),
+        "min_ms": round(min(times) * 1000, 2),
+        "max_ms": round(max(times) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Page load over HTTP/1.1 (6 connections) vs HTTP/2 (1)")
+    parser.add_argument("--assets", type=int, default=50)
+    parser.add_argument("--asset-size", type=int, default=8 * 1024, help="Bytes per asset")
+    parser.add_argument("--rtt-ms", type=float, default=20, help="Simulated round trip time, 0 for none")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    sys.stdout, report_to = open(os.devnull, "w"), sys.stdout
+
+    with tempfile.TemporaryDirectory() as directory:
+        assets = make_site(directory, args.assets, args.asset_size)
+        port = free_port()
+        settings.configure(HOST="127.0.0.1", PORT=port, ROOT=directory, HTTP2=True)
+        import server  # noqa: E402  (imports the handlers too)
+
+        threading.Thread(target=server.start_server, daemon=True).start()
+        time.sleep(0.5)
+        if args.rtt_ms:
+            port = DelayProxy(port, args.rtt_ms / 2000).port
+
+        h1_page_load(port, assets)  # warm up
+        h2_page_load(port, assets)
+        h1 = [h1_page_load(port, assets) for _ in range(args.runs)]
+        h2 = [h2_page_load(port, assets) for _ in range(args.runs)]
+
+    results = {
+        "assets": args.assets,
+        "asset_size": args.asset_size,
+        "rtt_ms": args.rtt_ms,
+        "http1": {"connections": H1_CONNECTIONS, **summarize(h1)},
+        "http2": {"connections": 1, **summarize(h2)},
+    }
+    results["speedup"] = round(results["http1"]["median_ms"] / results["http2"]["median_ms"], 2)
+    print(json.dumps(results, indent=4), file=report_to)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,35 @@
 import datetime
+import functools
+import hashlib
+
+import concurrency
+import mmap_cache
+import ratelimit
+import tls
+from profiler import profiler
 from request import Request
-from routes import bind_handler
+from routes import bind_handler, handlers
 from response import http_response
+from settings import settings
+from status_code import HttpResponseCode
+
+
+# Longest run /__admin/profile starts, the sampler runs next to every request meanwhile
+MAX_PROFILE_SECONDS = 300
+
+
+def admin_only(handler):
+    """/__admin/ handlers answer 404, as if they weren't there, unless admin_enabled is on."""
+    @functools.wraps(handler)
+    def guarded(req: Request):
+        if not settings.ADMIN_ENABLED:
+            return http_response(
+                HttpResponseCode.HTTP_RESPONSE_MESSAGES[HttpResponseCode.HTTP_404_NOT_FOUND],
+                HttpResponseCode.HTTP_404_NOT_FOUND,
+                "text/plain",
+            )
+        return handler(req)
+    return guarded
 
 
 @bind_handler("/hello")
@@ -13,7 +41,7 @@ def hello_handler(req: Request):
 def root_handler(req: Request):
     return http_response("Welcome to the nginx clone", 200, "text/plain")
 
-@bind_handler("/time")
+@bind_handler("/time", etag=True)
 def time_handler(req: Request):
     # Let's change the time handler to also return the query_params so we know if they are working
     return http_response(
@@ -23,4 +51,84 @@ def time_handler(req: Request):
         }
     )
 
-_ = ...  # placeholder for dummy import
\ No newline at end of file
+
+@bind_handler("/upload")
+def upload_handler(req: Request):
+    # Streams the body through the hash, a big upload never sits in memory
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in req.body:
+        digest.update(chunk)
+        size += len(chunk)
+    return http_response({"bytes": size, "sha256": digest.hexdigest()})
+
+
+@bind_handler("/__admin/profile")
+@admin_only
+def profile_handler(req: Request):
+    # /__admin/profile?seconds=10 starts the sampling profiler
+    try:
+        seconds = float(req.query_params.get("seconds", [settings.PROFILE_SECONDS])[0])
+    except ValueError:
+        seconds = None
+    if seconds is None or not 0 < seconds <= MAX_PROFILE_SECONDS:
+        return http_response(
+            {"error": f"seconds has to be a number between 0 and {MAX_PROFILE_SECONDS}"},
+            HttpResponseCode.HTTP_400_BAD_REQUEST,
+        )
+    output = profiler.start(seconds)
+    return http_response(
+        {"profiling": output is not None, "seconds": seconds, "output": str(output)}
+    )
+
+
+@bind_handler("/__admin/reload")
+@admin_only
+def reload_handler(req: Request):
+    # Same as kill -HUP, re-reads config.json and swaps it in
+    reloaded = settings.reload()
+    return http_response(
+        {"reloaded": reloaded, "generation": settings.snapshot.generation},
+        HttpResponseCode.HTTP_200_OK if reloaded else HttpResponseCode.HTTP_500_INTERNAL_SERVER_ERROR,
+    )
+
+
+@bind_handler("/__admin/tls")
+@admin_only
+def tls_handler(req: Request):
+    # OpenSSL session cache counters, "hits" are resumed handshakes
+    return http_response(tls.session_stats())
+
+
+@bind_handler("/__admin/bandwidth")
+@admin_only
+def bandwidth_handler(req: Request):
+    # Downloads being paced right now and the share of limit_rate_total each gets
+    total = settings.LIMIT_RATE_TOTAL
+    active = ratelimit.active
+    return http_response({
+        "active_downloads": active,
+        "limit_rate": settings.LIMIT_RATE,
+        "limit_rate_total": total,
+        "fair_share": total // active if total and active else None,
+    })
+
+@bind_handler("/__admin/mmap")
+@admin_only
+def mmap_handler(req: Request):
+    # Shared mappings of medium files, "hits" are responses served without reading the file
+    return http_response(mmap_cache.cache_stats())
+
+
+@bind_handler("/__admin/concurrency")
+@admin_only
+def concurrency_handler(req: Request):
+    # The adaptive limit right now, and the routes with a bulkhead
+    bulkheads = {
+        path: {"max_concurrency": bulkhead.size, "in_flight": bulkhead.in_flight, "shed": bulkhead.shed}
+        for path, route in handlers.items()
+        if (bulkhead := route.handler_function.bulkhead)
+    }
+    return http_response({"adaptive": concurrency.stats(settings.snapshot), "bulkheads": bulkheads})
+
+_ = ...  # placeholder for dummy import
@@ -0,0 +1,81 @@
+"""
+Pre-serialized bits of response heads.
+
+Most of a response head is the same bytes every time: the status line, the
+Content-Type and Connection lines, the Date (which only changes once a
+second). They are encoded once here and http_response just joins them.
+The tables are plain dicts so the hot path is a lookup, not a call.
+"""
+import email.utils
+import threading
+import time
+
+from status_code import HttpResponseCode
+
+CRLF = b"\r\n"
+CONNECTION = {True: b"Connection: keep-alive\r\n", False: b"Connection: close\r\n"}
+
+# 200 -> b"HTTP/1.1 200 OK\r\n"
+STATUS_LINES = {
+    code: f"HTTP/1.1 {code} {message}\r\n".encode("ascii")
+    for code, message in HttpResponseCode.HTTP_RESPONSE_MESSAGES.items()
+}
+# "text/html" -> b"Content-Type: text/html; charset=utf-8\r\n", filled as types show up
+CONTENT_TYPE_LINES = {}
+MAX_CONTENT_TYPES = 1024
+
+_date_lock = threading.Lock()
+_date = b""
+# time.time() from which _date is stale
+_date_expires = 0.0
+
+
+def status_line(status_code) -> bytes:
+    line = STATUS_LINES.get(status_code)
+    if line is None:
+        line = f"HTTP/1.1 {status_code} Unknown\r\n".encode("ascii")
+    return line
+
+
+def content_type_line(content_type) -> bytes:
+    line = CONTENT_TYPE_LINES.get(content_type)
+    if line is None:
+        value = f"{content_type}; charset=utf-8" if content_type.startswith("text") else content_type
+        line = f"Content-Type: {value}\r\n".encode("utf-8")
+        # Handlers could make up any number of types, only keep the first ones
+        if len(CONTENT_TYPE_LINES) < MAX_CONTENT_TYPES:
+            CONTENT_TYPE_LINES[content_type] = line
+    return line
+
+
+def date_line() -> bytes:
+    """The Date header, formatted at most once per second for all threads."""
+    global _date, _date_expires
+    now = time.time()
+    if now >= _date_expires:
+        with _date_lock:
+            if now >= _date_expires:
+                second = int(now)
+                _date = f"Date: {email.utils.formatdate(second, usegmt=True)}\r\n".encode("ascii")
+                _date_expires = second + 1
+    return _date
+
+
+# ("ETag", "abc") -> b"ETag: abc\r\n", a static file sends the same validators every time
+HEADER_LINES = {}
+MAX_HEADER_LINES = 4096
+
+
+def header_line(item) -> bytes:
+    line = HEADER_LINES.get(item)
+    if line is None:
+        line = ("%s: %s\r\n" % item).encode("utf-8")
+        if len(HEADER_LINES) >= MAX_HEADER_LINES:
+            # Unique values (Server-Timing, random ids) would grow it forever, start over
+            HEADER_LINES.clear()
+        HEADER_LINES[item] = line
+    return line
+
+
+def header_lines(headers) -> bytes:
+    return b"".join([header_line(item) for item in headers.items()])
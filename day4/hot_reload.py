@@ -1,5 +1,12 @@
 # Adding support for hot reloading the server when files change
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import select
 import signal
+import socket
+import struct
 import subprocess
 import sys
 import time
@@ -8,36 +15,214 @@ from pathlib import Path
 # Planning
 # We will store the last modified times of files we care about in a dict
 # When we detect a change, we will restart the server
+#
+# Scanning the whole tree every half second burns a core on big roots, so on
+# Linux we ask the kernel (inotify) to tell us what changed instead and only
+# fall back to polling elsewhere.
 
 EXTS = {".py", ".json", ".html"}
+IGNORE = ["__pycache__", ".git", ".*.swp", "*~", ".#*", "*.pyc"]
 
 
-def scan_files(root="."):
+def is_ignored(path: Path, ignore=IGNORE):
+    return any(fnmatch.fnmatch(part, pattern) for part in path.parts for pattern in ignore)
+
+
+def scan_files(root=".", ignore=IGNORE):
     mtimes = {}
     for path in Path(root).rglob("*"):
-        if path.suffix in EXTS and path.is_file():
+        if path.suffix in EXTS and not is_ignored(path, ignore) and path.is_file():
             mtimes[path] = path.stat().st_mtime
     return mtimes
 
 
-def reload_require(prev_mtimes):
-    current_mtimes = scan_files()
-    for path, mtime in current_mtimes.items():
-        if path in prev_mtimes and prev_mtimes[path] != mtime:
-            return True, current_mtimes
+def reload_require(prev_mtimes, root="."):
+    current_mtimes = scan_files(root)
+    # New files count as a change too
+    changed = {path for path, mtime in current_mtimes.items() if prev_mtimes.get(path) != mtime}
 
     # Handle for delete files too
-    for path in prev_mtimes:
-        if path not in current_mtimes:
-            return True, current_mtimes
+    changed.update(path for path in prev_mtimes if path not in current_mtimes)
+
+    if changed:
+        return changed, current_mtimes
+    return set(), prev_mtimes
+
+
+class PollingWatcher:
+    """Fallback watcher, rescans the tree every `wait` and returns the changed paths."""
+
+    def __init__(self, root="."):
+        self.root = root
+        self.mtimes = scan_files(root)
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        changed, self.mtimes = reload_require(self.mtimes, self.root)
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Event driven watcher using Linux inotify through ctypes.
+
+    Every directory under root gets a watch (new directories are picked up as
+    they are created). Events are debounced so an editor saving a file with
+    several writes/renames triggers a single restart.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    MASK = (
+        IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+        | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    )
+    EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+    def __init__(self, root=".", debounce=0.05, ignore=IGNORE):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.debounce = debounce
+        self.ignore = ignore
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}  # wd -> directory
+        self.add_tree(Path(root))
+
+    def add_watch(self, directory: Path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+        if wd < 0:
+            # Usually the directory vanished already or we hit max_user_watches
+            print(f"Can't watch {directory}: {os.strerror(ctypes.get_errno())}")
+            return
+        self.dirs[wd] = directory
+
+    def add_tree(self, root: Path):
+        for dirpath, dirnames, _ in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not is_ignored(Path(d), self.ignore)]
+            self.add_watch(Path(dirpath))
+
+    def read_events(self):
+        """Drain the inotify fd, returns the set of paths we care about that changed."""
+        changed = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                # Kernel dropped events, we don't know what changed
+                changed.add(Path("?"))
+                continue
+            if mask & self.IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            path = directory / name
+            if is_ignored(path, self.ignore):
+                continue
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    # Watch it and whatever got created inside before we did
+                    self.add_tree(path)
+                    changed.update(
+                        p for p in path.rglob("*") if p.suffix in EXTS and not is_ignored(p, self.ignore)
+                    )
+                continue
+            if path.suffix in EXTS or mask & self.IN_DELETE_SELF:
+                changed.add(path)
+        return changed
+
+    def wait(self, timeout):
+        """Block up to `timeout` seconds, returns the changed paths once they settled."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        changed = self.read_events() if ready else set()
+        if not changed:
+            return changed
+        # Debounce: keep draining until it has been quiet for a moment
+        while select.select([self.fd], [], [], self.debounce)[0]:
+            changed |= self.read_events()
+        return changed
 
-    return False, prev_mtimes
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(root="."):
+    try:
+        watcher = InotifyWatcher(root)
+        print("🦄 Watching for changes with inotify")
+        return watcher
+    except (OSError, AttributeError) as e:
+        print(f"🦄 inotify not available ({e}), falling back to polling")
+        return PollingWatcher(root)
 
 
 # Great we are almost done, now let's logic for this scripts to start a child process
+#
+# Zero downtime reloads: we (the supervisor) own the listening sockets and pass
+# them to every child through fd inheritance. On a change we start the new
+# generation first, wait until it says it's ready, and only then ask the old
+# one to drain (SIGTERM) - the sockets never close, so nothing gets refused.
+
+LISTEN_FD_ENV = "NGINX_CLONE_LISTEN_FD"
+READY_FD_ENV = "NGINX_CLONE_READY_FD"
+READY_TIMEOUT = 10  # seconds for a new child to start accepting
+DRAIN_GRACE = 60  # seconds an old child gets to finish before SIGKILL
+
 
+def open_listeners(listen=None):
+    """The listening sockets, --listen HOST:PORT or the "listen" entries of config.json."""
+    import listeners
+    import sockopts
+    from settings import settings
 
-def run_child(cmd):
+    if listen:
+        # Connections arriving while a new generation boots wait in the backlog
+        configured = [listeners.Listener({"address": listen, "backlog": socket.SOMAXCONN})]
+    else:
+        configured = listeners.configured(settings.snapshot)
+    sockets = []
+    for listener in configured:
+        sock = listener.open(lambda sock: sockopts.tune_listener(sock, settings.snapshot, listener.options))
+        sock.set_inheritable(True)
+        print(f"🦄 Listening on {listener.address}")
+        sockets.append(sock)
+    return sockets
+
+
+def run_child(cmd, sockets=()):
+    ready_r = ready_w = None
+    env = os.environ.copy()
+    pass_fds = ()
+    if sockets:
+        ready_r, ready_w = os.pipe()
+        env[LISTEN_FD_ENV] = ",".join(str(sock.fileno()) for sock in sockets)
+        env[READY_FD_ENV] = str(ready_w)
+        pass_fds = (*(sock.fileno() for sock in sockets), ready_w)
     try:
         proc = subprocess.Popen(
             [
@@ -45,60 +230,116 @@ def run_child(cmd):
                 *cmd,
             ],
             stdin=subprocess.PIPE,  # Allow sending input to child process
+            env=env,
+            pass_fds=pass_fds,
         )
         print(f"Child process running on {proc.pid}")
-        return proc
     except Exception as e:
         print(f"failed to start child process: {e}")
+        proc = None
+    finally:
+        if ready_w is not None:
+            os.close(ready_w)
+
+    if proc and ready_r is not None:
+        try:
+            if not wait_ready(proc, ready_r):
+                print(f"Child process {proc.pid} never became ready")
+                proc.kill()
+                proc.wait()
+                proc = None
+        finally:
+            os.close(ready_r)
+    return proc
+
+
+def wait_ready(proc, ready_r):
+    """The child writes a byte to the ready pipe once it accepts connections."""
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        ready, _, _ = select.select([ready_r], [], [], 0.1)
+        if ready:
+            # EOF without a byte means the child died before getting there
+            return os.read(ready_r, 1) == b"1"
+        if proc.poll() is not None:
+            return False
+    return False
+
+
+def reap(retiring):
+    """Forget old generations that finished draining, kill the ones that overstay."""
+    for proc, deadline in list(retiring):
+        if proc.poll() is not None:
+            print(f"🦄 Old child {proc.pid} drained and exited")
+            retiring.remove((proc, deadline))
+        elif time.monotonic() > deadline:
+            print(f"🦄 Old child {proc.pid} still busy after {DRAIN_GRACE}s, killing it")
+            proc.kill()
+
+
+def parse_args(argv):
+    """hot_reload.py [--listen HOST:PORT] <script.py> [args...]"""
+    listen = None
+    if argv and argv[0] == "--listen":
+        listen, argv = argv[1], argv[2:]
+    return listen, argv
 
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python3 hot_reload.py <script.py>")
+    listen, cmd = parse_args(sys.argv[1:])
+    if not cmd:
+        print("Usage: python3 hot_reload.py [--listen HOST:PORT] <script.py>")
         return
 
-    child = None
-    while True:
-        command = " ".join(sys.argv[1:])
-        print(f"🦄 Starting {command}")
-        child = run_child(sys.argv[1:])
-        if not child:
-            print(f"Failed to start {command}")
-            sys.exit(1)
+    sockets = open_listeners(listen)
 
-        mtimes = scan_files()
+    command = " ".join(cmd)
+    print(f"🦄 Starting {command}")
+    child = run_child(cmd, sockets)
+    if not child:
+        print(f"Failed to start {command}")
+        sys.exit(1)
 
-        try:
-            while True:
-                time.sleep(0.5)  # Buffer for half second
-                # Check if child process has existed
-                if child.poll():
-                    print(
-                        f"Child process with pid {child.pid} existed with errorcode {child.returncode}"
-                    )
-                    sys.exit(child.returncode)
-
-                # check if restart needed
-                restart, mtimes = reload_require(mtimes)
-
-                if restart:
-                    print(f"🦄 Restart: {command}")
-
-                    # Kill the existing process
-                    child.send_signal(signal.SIGTERM)
-                    # wait for 2 second
-                    try:
-                        child.wait(2)
-                    except subprocess.TimeoutExpired:
-                        child.kill()
-                    break
-        except KeyboardInterrupt:
-            print("🦄 Termiating the hot reload script")
-            # kill the child process too
-            if child:
-                child.kill()
-                child.wait()
-            sys.exit(0)  # Success
+    watcher = make_watcher()
+    retiring = []
+    try:
+        while True:
+            # Wait up to half a second for a change, then check on the children
+            changed = watcher.wait(0.5)
+            reap(retiring)
+            # Check if child process has existed
+            if child.poll():
+                print(
+                    f"Child process with pid {child.pid} existed with errorcode {child.returncode}"
+                )
+                sys.exit(child.returncode)
+
+            if changed and all(path.suffix == ".json" for path in changed):
+                # Config only change, the server reloads it in-process on SIGHUP
+                print(f"🦄 Config changed, reloading {child.pid}")
+                child.send_signal(signal.SIGHUP)
+            elif changed:
+                print(f"🦄 Restart: {command}")
+                new_child = run_child(cmd, sockets)
+                if not new_child:
+                    # Broken code or config, keep serving with what we have
+                    print(f"🦄 New generation failed to start, keeping {child.pid}")
+                    continue
+
+                # Ask the old generation to stop accepting and drain
+                child.send_signal(signal.SIGTERM)
+                retiring.append((child, time.monotonic() + DRAIN_GRACE))
+                child = new_child
+    except KeyboardInterrupt:
+        print("🦄 Termiating the hot reload script")
+        watcher.close()
+        # kill the child processes too
+        for proc in [child, *(proc for proc, _ in retiring)]:
+            proc.kill()
+            proc.wait()
+        for sock in sockets:
+            sock.close()
+        sys.exit(0)  # Success
 
 
 if __name__ == "__main__":
@@ -0,0 +1,360 @@
+"""
+HPACK header compression for HTTP/2 (RFC 7541), stdlib only.
+
+The Decoder understands everything a client may send: indexed fields,
+literals with and without indexing, Huffman coded strings and dynamic table
+size updates. The Encoder indexes every field it sends, so repeated headers
+(content-type, server, cache-control...) shrink to a single byte on later
+responses, and Huffman codes a string when that makes it shorter.
+
+Both sides keep their own dynamic table, one Encoder and one Decoder per
+connection, and header blocks have to be encoded in the order they are sent.
+"""
+
+STATIC_TABLE = (
+    (b":authority", b""),
+    (b":method", b"GET"),
+    (b":method", b"POST"),
+    (b":path", b"/"),
+    (b":path", b"/index.html"),
+    (b":scheme", b"http"),
+    (b":scheme", b"https"),
+    (b":status", b"200"),
+    (b":status", b"204"),
+    (b":status", b"206"),
+    (b":status", b"304"),
+    (b":status", b"400"),
+    (b":status", b"404"),
+    (b":status", b"500"),
+    (b"accept-charset", b""),
+    (b"accept-encoding", b"gzip, deflate"),
+    (b"accept-language", b""),
+    (b"accept-ranges", b""),
+    (b"accept", b""),
+    (b"access-control-allow-origin", b""),
+    (b"age", b""),
+    (b"allow", b""),
+    (b"authorization", b""),
+    (b"cache-control", b""),
+    (b"content-disposition", b""),
+    (b"content-encoding", b""),
+    (b"content-language", b""),
+    (b"content-length", b""),
+    (b"content-location", b""),
+    (b"content-range", b""),
+    (b"content-type", b""),
+    (b"cookie", b""),
+    (b"date", b""),
+    (b"etag", b""),
+    (b"expect", b""),
+    (b"expires", b""),
+    (b"from", b""),
+    (b"host", b""),
+    (b"if-match", b""),
+    (b"if-modified-since", b""),
+    (b"if-none-match", b""),
+    (b"if-range", b""),
+    (b"if-unmodified-since", b""),
+    (b"last-modified", b""),
+    (b"link", b""),
+    (b"location", b""),
+    (b"max-forwards", b""),
+    (b"proxy-authenticate", b""),
+    (b"proxy-authorization", b""),
+    (b"range", b""),
+    (b"referer", b""),
+    (b"refresh", b""),
+    (b"retry-after", b""),
+    (b"server", b""),
+    (b"set-cookie", b""),
+    (b"strict-transport-security", b""),
+    (b"transfer-encoding", b""),
+    (b"user-agent", b""),
+    (b"vary", b""),
+    (b"via", b""),
+    (b"www-authenticate", b""),
+)
+# (name, value) -> index and name -> first index, for the encoder
+STATIC_FIELDS = {}
+STATIC_NAMES = {}
+for _index, (_name, _value) in enumerate(STATIC_TABLE, 1):
+    STATIC_FIELDS.setdefault((_name, _value), _index)
+    STATIC_NAMES.setdefault(_name, _index)
+
+DEFAULT_TABLE_SIZE = 4096
+# Per entry overhead counted against the table size
+ENTRY_OVERHEAD = 32
+# Values we never put in the dynamic table, they change on every response
+NEVER_INDEX = {b"date", b"content-length", b"etag", b"last-modified", b"content-range", b"server-timing"}
+
+# (code, bit length) for symbols 0-255 and EOS (256), RFC 7541 Appendix B
+HUFFMAN_CODES = [
+    (0x1ff8, 13), (0x7fffd8, 23), (0xfffffe2, 28), (0xfffffe3, 28), (0xfffffe4, 28), (0xfffffe5, 28),
+    (0xfffffe6, 28), (0xfffffe7, 28), (0xfffffe8, 28), (0xffffea, 24), (0x3ffffffc, 30), (0xfffffe9, 28),
+    (0xfffffea, 28), (0x3ffffffd, 30), (0xfffffeb, 28), (0xfffffec, 28), (0xfffffed, 28), (0xfffffee, 28),
+    (0xfffffef, 28), (0xffffff0, 28), (0xffffff1, 28), (0xffffff2, 28), (0x3ffffffe, 30), (0xffffff3, 28),
+    (0xffffff4, 28), (0xffffff5, 28), (0xffffff6, 28), (0xffffff7, 28), (0xffffff8, 28), (0xffffff9, 28),
+    (0xffffffa, 28), (0xffffffb, 28), (0x14, 6), (0x3f8, 10), (0x3f9, 10), (0xffa, 12),
+    (0x1ff9, 13), (0x15, 6), (0xf8, 8), (0x7fa, 11), (0x3fa, 10), (0x3fb, 10),
+    (0xf9, 8), (0x7fb, 11), (0xfa, 8), (0x16, 6), (0x17, 6), (0x18, 6),
+    (0x0, 5), (0x1, 5), (0x2, 5), (0x19, 6), (0x1a, 6), (0x1b, 6),
+    (0x1c, 6), (0x1d, 6), (0x1e, 6), (0x1f, 6), (0x5c, 7), (0xfb, 8),
+    (0x7ffc, 15), (0x20, 6), (0xffb, 12), (0x3fc, 10), (0x1ffa, 13), (0x21, 6),
+    (0x5d, 7), (0x5e, 7), (0x5f, 7), (0x60, 7), (0x61, 7), (0x62, 7),
+    (0x63, 7), (0x64, 7), (0x65, 7), (0x66, 7), (0x67, 7), (0x68, 7),
+    (0x69, 7), (0x6a, 7), (0x6b, 7), (0x6c, 7), (0x6d, 7), (0x6e, 7),
+    (0x6f, 7), (0x70, 7), (0x71, 7), (0x72, 7), (0xfc, 8), (0x73, 7),
+    (0xfd, 8), (0x1ffb, 13), (0x7fff0, 19), (0x1ffc, 13), (0x3ffc, 14), (0x22, 6),
+    (0x7ffd, 15), (0x3, 5), (0x23, 6), (0x4, 5), (0x24, 6), (0x5, 5),
+    (0x25, 6), (0x26, 6), (0x27, 6), (0x6, 5), (0x74, 7), (0x75, 7),
+    (0x28, 6), (0x29, 6), (0x2a, 6), (0x7, 5), (0x2b, 6), (0x76, 7),
+    (0x2c, 6), (0x8, 5), (0x9, 5), (0x2d, 6), (0x77, 7), (0x78, 7),
+    (0x79, 7), (0x7a, 7), (0x7b, 7), (0x7ffe, 15), (0x7fc, 11), (0x3ffd, 14),
+    (0x1ffd, 13), (0xffffffc, 28), (0xfffe6, 20), (0x3fffd2, 22), (0xfffe7, 20), (0xfffe8, 20),
+    (0x3fffd3, 22), (0x3fffd4, 22), (0x3fffd5, 22), (0x7fffd9, 23), (0x3fffd6, 22), (0x7fffda, 23),
+    (0x7fffdb, 23), (0x7fffdc, 23), (0x7fffdd, 23), (0x7fffde, 23), (0xffffeb, 24), (0x7fffdf, 23),
+    (0xffffec, 24), (0xffffed, 24), (0x3fffd7, 22), (0x7fffe0, 23), (0xffffee, 24), (0x7fffe1, 23),
+    (0x7fffe2, 23), (0x7fffe3, 23), (0x7fffe4, 23), (0x1fffdc, 21), (0x3fffd8, 22), (0x7fffe5, 23),
+    (0x3fffd9, 22), (0x7fffe6, 23), (0x7fffe7, 23), (0xffffef, 24), (0x3fffda, 22), (0x1fffdd, 21),
+    (0xfffe9, 20), (0x3fffdb, 22), (0x3fffdc, 22), (0x7fffe8, 23), (0x7fffe9, 23), (0x1fffde, 21),
+    (0x7fffea, 23), (0x3fffdd, 22), (0x3fffde, 22), (0xfffff0, 24), (0x1fffdf, 21), (0x3fffdf, 22),
+    (0x7fffeb, 23), (0x7fffec, 23), (0x1fffe0, 21), (0x1fffe1, 21), (0x3fffe0, 22), (0x1fffe2, 21),
+    (0x7fffed, 23), (0x3fffe1, 22), (0x7fffee, 23), (0x7fffef, 23), (0xfffea, 20), (0x3fffe2, 22),
+    (0x3fffe3, 22), (0x3fffe4, 22), (0x7ffff0, 23), (0x3fffe5, 22), (0x3fffe6, 22), (0x7ffff1, 23),
+    (0x3ffffe0, 26), (0x3ffffe1, 26), (0xfffeb, 20), (0x7fff1, 19), (0x3fffe7, 22), (0x7ffff2, 23),
+    (0x3fffe8, 22), (0x1ffffec, 25), (0x3ffffe2, 26), (0x3ffffe3, 26), (0x3ffffe4, 26), (0x7ffffde, 27),
+    (0x7ffffdf, 27), (0x3ffffe5, 26), (0xfffff1, 24), (0x1ffffed, 25), (0x7fff2, 19), (0x1fffe3, 21),
+    (0x3ffffe6, 26), (0x7ffffe0, 27), (0x7ffffe1, 27), (0x3ffffe7, 26), (0x7ffffe2, 27), (0xfffff2, 24),
+    (0x1fffe4, 21), (0x1fffe5, 21), (0x3ffffe8, 26), (0x3ffffe9, 26), (0xffffffd, 28), (0x7ffffe3, 27),
+    (0x7ffffe4, 27), (0x7ffffe5, 27), (0xfffec, 20), (0xfffff3, 24), (0xfffed, 20), (0x1fffe6, 21),
+    (0x3fffe9, 22), (0x1fffe7, 21), (0x1fffe8, 21), (0x7ffff3, 23), (0x3fffea, 22), (0x3fffeb, 22),
+    (0x1ffffee, 25), (0x1ffffef, 25), (0xfffff4, 24), (0xfffff5, 24), (0x3ffffea, 26), (0x7ffff4, 23),
+    (0x3ffffeb, 26), (0x7ffffe6, 27), (0x3ffffec, 26), (0x3ffffed, 26), (0x7ffffe7, 27), (0x7ffffe8, 27),
+    (0x7ffffe9, 27), (0x7ffffea, 27), (0x7ffffeb, 27), (0xffffffe, 28), (0x7ffffec, 27), (0x7ffffed, 27),
+    (0x7ffffee, 27), (0x7ffffef, 27), (0x7fffff0, 27), (0x3ffffee, 26), (0x3fffffff, 30),
+]
+
+# (bit length, code) -> symbol, walked bit by bit when decoding
+HUFFMAN_DECODE = {(length, code): symbol for symbol, (code, length) in enumerate(HUFFMAN_CODES)}
+HUFFMAN_MIN_LENGTH = min(length for _, length in HUFFMAN_CODES)
+EOS = 256
+
+
+class HPACKError(ValueError):
+    """The peer sent a header block we can't decode, a COMPRESSION_ERROR in HTTP/2."""
+
+
+def encode_integer(value, prefix_bits, first_byte=0):
+    """RFC 7541 5.1, `first_byte` carries the flag bits above the prefix."""
+    limit = (1 << prefix_bits) - 1
+    if value < limit:
+        return bytes([first_byte | value])
+    out = bytearray([first_byte | limit])
+    value -= limit
+    while value >= 128:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_integer(data, pos, prefix_bits):
+    """Returns (value, position after it)."""
+    limit = (1 << prefix_bits) - 1
+    if pos >= len(data):
+        raise HPACKError("Truncated integer")
+    value = data[pos] & limit
+    pos += 1
+    if value < limit:
+        return value, pos
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise HPACKError("Truncated integer")
+        byte = data[pos]
+        pos += 1
+        value += (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+        if shift > 28:
+            raise HPACKError("Integer too large")
+
+
+def huffman_encode(data):
+    bits = 0
+    bit_count = 0
+    for byte in data:
+        code, length = HUFFMAN_CODES[byte]
+        bits = (bits << length) | code
+        bit_count += length
+    # Pad with the most significant bits of EOS (all ones)
+    padding = -bit_count % 8
+    bits = (bits << padding) | ((1 << padding) - 1)
+    return bits.to_bytes((bit_count + padding) // 8, "big")
+
+
+def huffman_decode(data):
+    out = bytearray()
+    code = 0
+    length = 0
+    for byte in data:
+        for shift in range(7, -1, -1):
+            code = (code << 1) | ((byte >> shift) & 1)
+            length += 1
+            if length < HUFFMAN_MIN_LENGTH:
+                continue
+            symbol = HUFFMAN_DECODE.get((length, code))
+            if symbol is not None:
+                if symbol == EOS:
+                    raise HPACKError("EOS in Huffman string")
+                out.append(symbol)
+                code = 0
+                length = 0
+            elif length > 30:
+                raise HPACKError("Invalid Huffman code")
+    # Whatever is left has to be padding: fewer than 8 bits, all ones
+    if length > 7 or code != (1 << length) - 1:
+        raise HPACKError("Invalid Huffman padding")
+    return bytes(out)
+
+
+def encode_string(value):
+    encoded = huffman_encode(value)
+    if len(encoded) < len(value):
+        return encode_integer(len(encoded), 7, 0x80) + encoded
+    return encode_integer(len(value), 7) + value
+
+
+def decode_string(data, pos):
+    huffman = data[pos] & 0x80 if pos < len(data) else 0
+    length, pos = decode_integer(data, pos, 7)
+    end = pos + length
+    if end > len(data):
+        raise HPACKError("Truncated string")
+    value = bytes(data[pos:end])
+    return (huffman_decode(value) if huffman else value), end
+
+
+class DynamicTable:
+    def __init__(self, max_size=DEFAULT_TABLE_SIZE):
+        # Newest entry first, index 62 is entries[0]
+        self.entries = []
+        self.size = 0
+        self.max_size = max_size
+
+    def add(self, name, value):
+        self.entries.insert(0, (name, value))
+        self.size += len(name) + len(value) + ENTRY_OVERHEAD
+        self.evict()
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self.evict()
+
+    def evict(self):
+        while self.size > self.max_size:
+            name, value = self.entries.pop()
+            self.size -= len(name) + len(value) + ENTRY_OVERHEAD
+
+    def get(self, index):
+        if 0 < index <= len(STATIC_TABLE):
+            return STATIC_TABLE[index - 1]
+        index -= len(STATIC_TABLE) + 1
+        if 0 <= index < len(self.entries):
+            return self.entries[index]
+        raise HPACKError(f"Invalid table index {index + len(STATIC_TABLE) + 1}")
+
+
+class Decoder:
+    def __init__(self, max_table_size=DEFAULT_TABLE_SIZE):
+        self.table = DynamicTable(max_table_size)
+        # What we advertised in SETTINGS_HEADER_TABLE_SIZE
+        self.max_allowed_size = max_table_size
+
+    def decode(self, block):
+        """Header block -> list of (name, value) bytes pairs."""
+        headers = []
+        pos = 0
+        data = memoryview(block)
+        while pos < len(data):
+            byte = data[pos]
+            if byte & 0x80:
+                # Indexed field
+                index, pos = decode_integer(data, pos, 7)
+                if index == 0:
+                    raise HPACKError("Index 0")
+                headers.append(self.table.get(index))
+            elif byte & 0x40:
+                # Literal with incremental indexing
+                name, value, pos = self._literal(data, pos, 6)
+                self.table.add(name, value)
+                headers.append((name, value))
+            elif byte & 0x20:
+                # Dynamic table size update
+                size, pos = decode_integer(data, pos, 5)
+                if size > self.max_allowed_size:
+                    raise HPACKError(f"Table size {size} above the advertised {self.max_allowed_size}")
+                self.table.resize(size)
+            else:
+                # Literal without indexing (0000) or never indexed (0001)
+                name, value, pos = self._literal(data, pos, 4)
+                headers.append((name, value))
+        return headers
+
+    def _literal(self, data, pos, prefix_bits):
+        index, pos = decode_integer(data, pos, prefix_bits)
+        if index:
+            name = self.table.get(index)[0]
+        else:
+            name, pos = decode_string(data, pos)
+        value, pos = decode_string(data, pos)
+        return name, value, pos
+
+
+class Encoder:
+    def __init__(self):
+        self.table = DynamicTable()
+        # Set when the peer changes SETTINGS_HEADER_TABLE_SIZE, announced in the next block
+        self.pending_size = None
+
+    def resize(self, max_size):
+        self.pending_size = min(max_size, DEFAULT_TABLE_SIZE)
+
+    def _find(self, name, value):
+        """(index of name+value or 0, index of the name or 0)"""
+        index = STATIC_FIELDS.get((name, value))
+        if index:
+            return index, index
+        name_index = STATIC_NAMES.get(name, 0)
+        for position, entry in enumerate(self.table.entries, len(STATIC_TABLE) + 1):
+            if entry[0] == name:
+                if entry[1] == value:
+                    return position, position
+                name_index = name_index or position
+        return 0, name_index
+
+    def encode(self, headers):
+        """List of (name, value) str or bytes pairs -> header block. Names must be lower case."""
+        out = bytearray()
+        if self.pending_size is not None:
+            self.table.resize(self.pending_size)
+            out += encode_integer(self.pending_size, 5, 0x20)
+            self.pending_size = None
+        for name, value in headers:
+            name = name.encode("ascii") if isinstance(name, str) else name
+            value = value.encode("latin-1") if isinstance(value, str) else value
+            index, name_index = self._find(name, value)
+            if index:
+                out += encode_integer(index, 7, 0x80)
+                continue
+            if name in NEVER_INDEX:
+                # Literal without indexing, no point filling the table with it
+                out += encode_integer(name_index, 4)
+            else:
+                out += encode_integer(name_index, 6, 0x40)
+                self.table.add(name, value)
+            if not name_index:
+                out += encode_string(name)
+            out += encode_string(value)
+        return bytes(out)
@@ -0,0 +1,839 @@
+"""
+HTTP/2 over cleartext TCP (h2c, RFC 7540), stdlib only.
+
+    "http2": true
+
+Off by default, it's a whole second protocol with its own threads per
+connection and per stream, so a deployment opts in. TLS listeners never
+speak it, h2c is cleartext only.
+
+A client gets here either with prior knowledge (the connection starts with
+the "PRI * HTTP/2.0" preface) or by sending an HTTP/1.1 request with
+"Upgrade: h2c", which is then answered as stream 1.
+
+Each connection has:
+  - a reader (the connection's thread) that parses frames, keeps the HPACK
+    decoder and starts one worker thread per request stream
+  - a writer thread that owns the socket's send side and the HPACK encoder.
+    Workers queue HEADERS and DATA, the writer picks which stream to send
+    next: streams whose dependency (PRIORITY) still has data wait, then the
+    lowest "priority: u=N" urgency (RFC 9218), then the stream that got the
+    least bytes for its weight so far.
+  - flow control both ways: DATA only goes out within the connection and
+    stream windows the client gave us, and a worker blocks once its stream
+    has STREAM_BUFFER bytes queued.
+
+Requests go through the same routing and dispatch as HTTP/1.1
+(request.build_request and connection.dispatch), the HTTP/1.1 response they
+produce is turned into frames: the head becomes a HEADERS frame and the
+body, or the stream function of the static path, becomes DATA frames.
+"""
+import base64
+import collections
+import functools
+import socket
+import struct
+import tempfile
+import threading
+import urllib.parse as urlparse
+
+import connection  # for dispatch(), connection.py imports this module too
+from body import RequestBody
+from hpack_codec import Decoder, Encoder, HPACKError
+from request import build_request
+from response import CHUNK_SIZE, canned_response
+from settings import settings
+from status_code import HttpResponseCode
+from timing import RequestTimer
+
+logger = settings.logger
+
+PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+UPGRADE_RESPONSE = b"HTTP/1.1 101 Switching Protocols\r\nConnection: Upgrade\r\nUpgrade: h2c\r\n\r\n"
+
+# Frame types
+DATA, HEADERS, PRIORITY, RST_STREAM, SETTINGS, PUSH_PROMISE, PING, GOAWAY, WINDOW_UPDATE, CONTINUATION = range(10)
+# Flags
+END_STREAM = 0x1
+ACK = 0x1
+END_HEADERS = 0x4
+PADDED = 0x8
+PRIORITY_FLAG = 0x20
+# SETTINGS parameters
+HEADER_TABLE_SIZE, ENABLE_PUSH, MAX_CONCURRENT_STREAMS, INITIAL_WINDOW_SIZE, MAX_FRAME_SIZE, MAX_HEADER_LIST_SIZE = range(1, 7)
+# Error codes
+NO_ERROR = 0x0
+PROTOCOL_ERROR = 0x1
+INTERNAL_ERROR = 0x2
+FLOW_CONTROL_ERROR = 0x3
+STREAM_CLOSED = 0x5
+FRAME_SIZE_ERROR = 0x6
+REFUSED_STREAM = 0x7
+CANCEL = 0x8
+COMPRESSION_ERROR = 0x9
+ENHANCE_YOUR_CALM = 0xB
+
+DEFAULT_WINDOW = 65535
+MAX_WINDOW = 2**31 - 1
+FRAME_SIZE = 16384  # what we accept, the RFC default
+MAX_STREAMS = 100
+# Connection receive window, bigger than the default so uploads don't stall on it
+CONNECTION_WINDOW = 16 * 1024 * 1024
+MAX_HEADER_BLOCK = 64 * 1024
+# Bytes a stream can have queued before its worker waits for the writer
+STREAM_BUFFER = 256 * 1024
+# Bytes the writer collects before a sendall()
+WRITE_BATCH = 64 * 1024
+# Seconds a connection without open streams is kept
+IDLE_TIMEOUT = 10
+DEFAULT_WEIGHT = 16
+DEFAULT_URGENCY = 3
+# Connection specific headers that are not allowed in HTTP/2
+HOP_BY_HOP = {b"connection", b"keep-alive", b"proxy-connection", b"transfer-encoding", b"upgrade"}
+
+# Open connections, drain_all() sends each a GOAWAY on shutdown
+connections = set()
+connections_lock = threading.Lock()
+
+
+class H2Error(Exception):
+    """Connection error, answered with GOAWAY."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class StreamReset(Exception):
+    """The stream was reset (by the client or us), its worker should stop."""
+
+
+def frame(frame_type, flags, stream_id, payload=b""):
+    return len(payload).to_bytes(3, "big") + struct.pack(">BBI", frame_type, flags, stream_id) + payload
+
+
+def settings_payload(values):
+    return b"".join(struct.pack(">HI", key, value) for key, value in values.items())
+
+
+@functools.lru_cache(maxsize=256)
+def canonical_name(name: bytes):
+    # "if-none-match" -> "If-None-Match", how the HTTP/1.1 parser stores them
+    return "-".join(part.capitalize() for part in name.decode("ascii", errors="ignore").split("-"))
+
+
+def parse_urgency(value):
+    # RFC 9218 "priority: u=1, i"
+    for item in value.split(","):
+        key, _, number = item.strip().partition("=")
+        if key == "u" and number.isdigit():
+            return min(int(number), 7)
+    return DEFAULT_URGENCY
+
+
+def response_headers(head: bytes):
+    """Serialized HTTP/1.1 response head -> (status, [(name, value)]) for a HEADERS frame."""
+    lines = head.split(b"\r\n")
+    headers = [(b":status", lines[0][9:12])]
+    for line in lines[1:]:
+        name, sep, value = line.partition(b":")
+        name = name.strip().lower()
+        if sep and name not in HOP_BY_HOP:
+            headers.append((name, value.strip()))
+    return headers
+
+
+class Stream:
+    __slots__ = (
+        "id", "window", "weight", "urgency", "depends_on",
+        "header_block", "request_headers", "body", "recv_consumed",
+        "queue", "queued", "end_queued", "headers_sent", "sent", "closed", "reset", "answered_early",
+    )
+
+    def __init__(self, stream_id, window):
+        self.id = stream_id
+        self.window = window  # send window, what the client lets us send
+        self.weight = DEFAULT_WEIGHT
+        self.urgency = DEFAULT_URGENCY
+        self.depends_on = 0
+        self.header_block = bytearray()
+        self.request_headers = None
+        self.body = None  # SpooledTemporaryFile once DATA arrives
+        self.recv_consumed = 0
+        self.queue = collections.deque()  # memoryviews waiting for the writer
+        self.queued = 0
+        self.end_queued = False
+        self.headers_sent = False
+        self.sent = 0
+        self.closed = False
+        self.reset = False
+        self.answered_early = False  # responded before the client finished sending
+
+
+class StreamSink:
+    """Socket lookalike handed to the static path's stream functions."""
+
+    def __init__(self, conn, stream):
+        self.conn = conn
+        self.stream = stream
+
+    def sendall(self, data):
+        self.conn.send_data(self.stream, data)
+
+    def sendfile(self, f):
+        while chunk := f.read(CHUNK_SIZE):
+            self.conn.send_data(self.stream, chunk)
+
+    def gettimeout(self):
+        return None
+
+    def settimeout(self, timeout):
+        pass
+
+
+class H2Connection:
+    def __init__(self, sock, addr, initial=b""):
+        self.sock = sock
+        self.addr = addr
+        self.buffer = bytearray(initial)
+        self.decoder = Decoder()
+        self.encoder = Encoder()
+        self.cond = threading.Condition()
+        self.streams = {}
+        self.last_stream_id = 0
+        self.window = DEFAULT_WINDOW  # connection send window
+        self.recv_consumed = 0
+        self.peer_window = DEFAULT_WINDOW  # SETTINGS_INITIAL_WINDOW_SIZE of the client
+        self.peer_frame_size = FRAME_SIZE
+        # Frames that go out before any stream data (SETTINGS, PING acks, HEADERS...)
+        self.control = collections.deque()
+        # Streams with DATA queued or an END_STREAM to send
+        self.active = set()
+        # PRIORITY frames for streams that aren't open yet
+        self.pending_priority = {}
+        # (stream, END_STREAM flag) while a header block waits for CONTINUATION frames
+        self.continuation = None
+        self.goaway_received = False
+        # We sent a GOAWAY for a graceful shutdown, streams above last_stream_id are refused
+        self.draining = False
+        self.closing = False
+        self.dead = False
+        # Seconds a stream's worker waits for the client to take more data
+        self.send_timeout = settings.snapshot.SEND_TIMEOUT or None
+
+    # ------------------- reading -------------------
+
+    def fill(self):
+        while True:
+            try:
+                data = self.sock.recv(64 * 1024)
+            except socket.timeout:
+                if self.streams:
+                    continue
+                raise
+            if not data:
+                raise EOFError()
+            self.buffer += data
+            return
+
+    def read_frame(self):
+        while len(self.buffer) < 9:
+            self.fill()
+        length = int.from_bytes(self.buffer[:3], "big")
+        frame_type, flags, stream_id = struct.unpack_from(">BBI", self.buffer, 3)
+        if length > FRAME_SIZE:
+            raise H2Error(FRAME_SIZE_ERROR, f"Frame of {length} bytes")
+        while len(self.buffer) < 9 + length:
+            self.fill()
+        payload = bytes(self.buffer[9 : 9 + length])
+        del self.buffer[: 9 + length]
+        return frame_type, flags, stream_id & 0x7FFFFFFF, payload
+
+    def read_preface(self):
+        while len(self.buffer) < len(PREFACE):
+            self.fill()
+        if not self.buffer.startswith(PREFACE):
+            raise H2Error(PROTOCOL_ERROR, "Bad connection preface")
+        del self.buffer[: len(PREFACE)]
+
+    def run(self, upgrade=None):
+        self.sock.settimeout(IDLE_TIMEOUT)
+        if self.sock.family in (socket.AF_INET, socket.AF_INET6):
+            # The writer batches frames itself, Nagle would only hold small responses back
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.queue_control(frame(SETTINGS, 0, 0, settings_payload({
+            MAX_CONCURRENT_STREAMS: MAX_STREAMS,
+            MAX_HEADER_LIST_SIZE: MAX_HEADER_BLOCK,
+        })))
+        self.queue_control(frame(WINDOW_UPDATE, 0, 0, struct.pack(">I", CONNECTION_WINDOW - DEFAULT_WINDOW)))
+        writer = threading.Thread(target=self.write_loop, daemon=True)
+        writer.start()
+
+        error = NO_ERROR
+        try:
+            if upgrade is not None:
+                self.start_upgraded(upgrade)
+            # Only now, a GOAWAY mustn't go out before our SETTINGS
+            with connections_lock:
+                connections.add(self)
+            self.read_preface()
+            # The first frame has to be the client's SETTINGS
+            frame_type, flags, stream_id, payload = self.read_frame()
+            if frame_type != SETTINGS or flags & ACK:
+                raise H2Error(PROTOCOL_ERROR, "Expected SETTINGS after the preface")
+            self.handle_frame(frame_type, flags, stream_id, payload)
+            while not ((self.goaway_received or self.draining) and not self.streams):
+                self.handle_frame(*self.read_frame())
+        except H2Error as e:
+            logger.info(f"HTTP/2 connection error from {self.addr[0]}: {e}")
+            error = e.code
+        except HPACKError as e:
+            logger.info(f"HTTP/2 header compression error from {self.addr[0]}: {e}")
+            error = COMPRESSION_ERROR
+        except socket.timeout:
+            logger.info(f"HTTP/2 connection to {self.addr[0]} idle for {IDLE_TIMEOUT}s")
+        except (EOFError, OSError):
+            # Unless drain() woke us up, then the writer still has a GOAWAY to send
+            if not self.draining:
+                with self.cond:
+                    self.dead = True
+                    self.cond.notify_all()
+        finally:
+            with connections_lock:
+                connections.discard(self)
+        self.close(error)
+        writer.join()
+
+    def start_upgraded(self, request):
+        # The HTTP/1.1 request becomes stream 1, half closed since it was sent already
+        try:
+            payload = base64.urlsafe_b64decode(request.headers["HTTP2-Settings"] + "==")
+        except ValueError:
+            raise H2Error(PROTOCOL_ERROR, "Bad HTTP2-Settings header")
+        self.apply_settings(payload)
+        stream = Stream(1, self.peer_window)
+        self.streams[1] = stream
+        self.last_stream_id = 1
+        self.start_worker(stream, request)
+
+    def handle_frame(self, frame_type, flags, stream_id, payload):
+        if self.continuation and (frame_type != CONTINUATION or stream_id != self.continuation[0].id):
+            raise H2Error(PROTOCOL_ERROR, "Expected CONTINUATION")
+        if frame_type == DATA:
+            self.on_data(flags, stream_id, payload)
+        elif frame_type == HEADERS:
+            self.on_headers(flags, stream_id, payload)
+        elif frame_type == CONTINUATION:
+            self.on_continuation(flags, stream_id, payload)
+        elif frame_type == PRIORITY:
+            if not stream_id:
+                raise H2Error(PROTOCOL_ERROR, "PRIORITY on stream 0")
+            if len(payload) != 5:
+                raise H2Error(FRAME_SIZE_ERROR, "PRIORITY frame size")
+            self.set_priority(stream_id, payload)
+        elif frame_type == RST_STREAM:
+            if not stream_id:
+                raise H2Error(PROTOCOL_ERROR, "RST_STREAM on stream 0")
+            if len(payload) != 4:
+                raise H2Error(FRAME_SIZE_ERROR, "RST_STREAM frame size")
+            stream = self.streams.get(stream_id)
+            if stream:
+                self.reset_stream(stream, None)
+        elif frame_type == SETTINGS:
+            if stream_id:
+                raise H2Error(PROTOCOL_ERROR, "SETTINGS on a stream")
+            if flags & ACK:
+                if payload:
+                    raise H2Error(FRAME_SIZE_ERROR, "SETTINGS ack with a payload")
+                return
+            self.apply_settings(payload)
+            self.queue_control(frame(SETTINGS, ACK, 0))
+        elif frame_type == PING:
+            if stream_id:
+                raise H2Error(PROTOCOL_ERROR, "PING on a stream")
+            if len(payload) != 8:
+                raise H2Error(FRAME_SIZE_ERROR, "PING frame size")
+            if not flags & ACK:
+                self.queue_control(frame(PING, ACK, 0, payload))
+        elif frame_type == GOAWAY:
+            # Finish what was started, no new streams
+            self.goaway_received = True
+        elif frame_type == WINDOW_UPDATE:
+            self.on_window_update(stream_id, payload)
+        elif frame_type == PUSH_PROMISE:
+            raise H2Error(PROTOCOL_ERROR, "Clients can't push")
+        # Unknown frame types are ignored (RFC 7540 4.1)
+
+    def on_headers(self, flags, stream_id, payload):
+        if not stream_id:
+            raise H2Error(PROTOCOL_ERROR, "HEADERS on stream 0")
+        payload = self.strip_padding(flags, payload)
+        priority = None
+        if flags & PRIORITY_FLAG:
+            priority, payload = payload[:5], payload[5:]
+
+        stream = self.streams.get(stream_id)
+        if stream is not None:
+            # Trailers, they end the request body
+            if not flags & END_STREAM:
+                raise H2Error(PROTOCOL_ERROR, "Trailers without END_STREAM")
+            self.decode_block(payload, flags)
+            self.request_complete(stream)
+            return
+        if stream_id % 2 == 0 or stream_id <= self.last_stream_id:
+            raise H2Error(PROTOCOL_ERROR, f"Unexpected stream id {stream_id}")
+        self.last_stream_id = stream_id
+
+        stream = Stream(stream_id, self.peer_window)
+        if stream_id in self.pending_priority:
+            self.set_priority(stream_id, self.pending_priority.pop(stream_id), stream)
+        if priority:
+            self.set_priority(stream_id, priority, stream)
+        if self.goaway_received or self.draining or len(self.streams) >= MAX_STREAMS:
+            # Still have to decode it, the HPACK tables must stay in sync
+            self.decode_block(payload, flags)
+            self.queue_control(frame(RST_STREAM, 0, stream_id, struct.pack(">I", REFUSED_STREAM)))
+            return
+        self.streams[stream_id] = stream
+        stream.header_block += payload
+        if flags & END_HEADERS:
+            self.headers_complete(stream, flags & END_STREAM)
+        else:
+            # END_STREAM counts once the CONTINUATIONs are in
+            self.continuation = (stream, flags & END_STREAM)
+
+    def on_continuation(self, flags, stream_id, payload):
+        if not self.continuation:
+            raise H2Error(PROTOCOL_ERROR, "Unexpected CONTINUATION")
+        stream, end_stream = self.continuation
+        stream.header_block += payload
+        if len(stream.header_block) > MAX_HEADER_BLOCK:
+            raise H2Error(ENHANCE_YOUR_CALM, "Header block too large")
+        if flags & END_HEADERS:
+            self.continuation = None
+            self.headers_complete(stream, end_stream)
+
+    def decode_block(self, block, flags):
+        if not flags & END_HEADERS:
+            # Only trailers and refused streams get here, not worth supporting split blocks
+            raise H2Error(PROTOCOL_ERROR, "Split header block on a closed stream")
+        return self.decoder.decode(block)
+
+    def headers_complete(self, stream, end_stream):
+        stream.request_headers = self.decoder.decode(bytes(stream.header_block))
+        stream.header_block = None
+        if end_stream:
+            self.request_complete(stream)
+            return
+        max_size = settings.snapshot.CLIENT_MAX_BODY_SIZE
+        for name, value in stream.request_headers:
+            if name == b"content-length" and value.isdigit() and max_size and int(value) > max_size:
+                self.reject_body(stream)
+                return
+
+    def on_data(self, flags, stream_id, payload):
+        if not stream_id:
+            raise H2Error(PROTOCOL_ERROR, "DATA on stream 0")
+        size = len(payload)
+        payload = self.strip_padding(flags, payload)
+        # Padding counts against flow control too
+        self.recv_consumed += size
+        if self.recv_consumed >= CONNECTION_WINDOW // 2:
+            self.queue_control(frame(WINDOW_UPDATE, 0, 0, struct.pack(">I", self.recv_consumed)))
+            self.recv_consumed = 0
+
+        stream = self.streams.get(stream_id)
+        if stream_id > self.last_stream_id:
+            raise H2Error(PROTOCOL_ERROR, f"DATA on idle stream {stream_id}")
+        if stream is None or stream.closed:
+            # Reset, or answered already, what was in flight is dropped
+            return
+        if stream.request_headers is None:
+            raise H2Error(PROTOCOL_ERROR, "DATA before the end of the headers")
+        snapshot = settings.snapshot
+        if stream.body is None:
+            stream.body = tempfile.SpooledTemporaryFile(
+                max_size=snapshot.CLIENT_BODY_BUFFER_SIZE, dir=snapshot.CLIENT_BODY_TEMP_PATH
+            )
+        stream.body.write(payload)
+        if snapshot.CLIENT_MAX_BODY_SIZE and stream.body.tell() > snapshot.CLIENT_MAX_BODY_SIZE:
+            self.reject_body(stream)
+            return
+        if flags & END_STREAM:
+            self.request_complete(stream)
+            return
+        stream.recv_consumed += size
+        if stream.recv_consumed >= DEFAULT_WINDOW // 2:
+            self.queue_control(frame(WINDOW_UPDATE, 0, stream_id, struct.pack(">I", stream.recv_consumed)))
+            stream.recv_consumed = 0
+
+    def on_window_update(self, stream_id, payload):
+        if len(payload) != 4:
+            raise H2Error(FRAME_SIZE_ERROR, "WINDOW_UPDATE frame size")
+        increment = struct.unpack(">I", payload)[0] & 0x7FFFFFFF
+        with self.cond:
+            if not stream_id:
+                if not increment:
+                    raise H2Error(PROTOCOL_ERROR, "WINDOW_UPDATE of 0")
+                self.window += increment
+                if self.window > MAX_WINDOW:
+                    raise H2Error(FLOW_CONTROL_ERROR, "Connection window overflow")
+            else:
+                stream = self.streams.get(stream_id)
+                if stream is None:
+                    return
+                if not increment or stream.window + increment > MAX_WINDOW:
+                    self.reset_stream(stream, PROTOCOL_ERROR if not increment else FLOW_CONTROL_ERROR)
+                    return
+                stream.window += increment
+            self.cond.notify_all()
+
+    def apply_settings(self, payload):
+        if len(payload) % 6:
+            raise H2Error(FRAME_SIZE_ERROR, "SETTINGS frame size")
+        with self.cond:
+            for offset in range(0, len(payload), 6):
+                key, value = struct.unpack_from(">HI", payload, offset)
+                if key == HEADER_TABLE_SIZE:
+                    self.encoder.resize(value)
+                elif key == ENABLE_PUSH and value > 1:
+                    raise H2Error(PROTOCOL_ERROR, "ENABLE_PUSH must be 0 or 1")
+                elif key == INITIAL_WINDOW_SIZE:
+                    if value > MAX_WINDOW:
+                        raise H2Error(FLOW_CONTROL_ERROR, "INITIAL_WINDOW_SIZE too large")
+                    # Applies to the open streams too, can even make their window negative
+                    delta = value - self.peer_window
+                    self.peer_window = value
+                    for stream in self.streams.values():
+                        stream.window += delta
+                elif key == MAX_FRAME_SIZE:
+                    if not FRAME_SIZE <= value <= 2**24 - 1:
+                        raise H2Error(PROTOCOL_ERROR, f"Invalid MAX_FRAME_SIZE {value}")
+                    self.peer_frame_size = value
+            self.cond.notify_all()
+
+    def set_priority(self, stream_id, payload, stream=None):
+        dependency, weight = struct.unpack(">IB", payload)
+        dependency &= 0x7FFFFFFF
+        if dependency == stream_id:
+            raise H2Error(PROTOCOL_ERROR, "Stream depends on itself")
+        stream = stream or self.streams.get(stream_id)
+        if stream is None:
+            # For a stream that isn't open yet, keep a bounded number of them
+            if len(self.pending_priority) < MAX_STREAMS:
+                self.pending_priority[stream_id] = payload
+            return
+        with self.cond:
+            stream.depends_on = dependency
+            stream.weight = weight + 1
+
+    @staticmethod
+    def strip_padding(flags, payload):
+        if not flags & PADDED:
+            return payload
+        if not payload or payload[0] >= len(payload):
+            raise H2Error(PROTOCOL_ERROR, "Padding longer than the frame")
+        return payload[1 : len(payload) - payload[0]]
+
+    # ------------------- requests -------------------
+
+    def request_complete(self, stream):
+        if stream.closed:
+            return
+        request = self.make_request(stream)
+        if request is None:
+            return
+        snapshot = request.settings
+        if stream.body is not None:
+            size = stream.body.tell()
+            stream.body.seek(0)
+            request.body = RequestBody(
+                stream.body, size, snapshot.CLIENT_MAX_BODY_SIZE,
+                snapshot.CLIENT_BODY_BUFFER_SIZE, snapshot.CLIENT_BODY_TEMP_PATH,
+            )
+        self.start_worker(stream, request)
+
+    def reject_body(self, stream):
+        """413 right away, without waiting for the rest of the upload."""
+        if stream.body is not None:
+            stream.body.close()
+            stream.body = None
+        request = self.make_request(stream)
+        if request:
+            stream.answered_early = True
+            self.start_worker(stream, request, canned_response(HttpResponseCode.HTTP_413_PAYLOAD_TOO_LARGE))
+
+    def make_request(self, stream):
+        """Build the Request from the stream's headers, None if they are invalid."""
+        stream.closed = True  # half closed (remote), nothing more from the client
+        timer = RequestTimer()
+        timer.lap("recv")
+        pseudo, headers = {}, {}
+        for name, value in stream.request_headers:
+            value = value.decode("utf-8", errors="ignore")
+            if name.startswith(b":"):
+                pseudo[name] = value
+                continue
+            key = canonical_name(name)
+            if key in headers:
+                headers[key] += ("; " if key == "Cookie" else ", ") + value
+            else:
+                headers[key] = value
+        if b":method" not in pseudo or b":path" not in pseudo:
+            self.reset_stream(stream, PROTOCOL_ERROR)
+            return None
+        if "Host" not in headers and b":authority" in pseudo:
+            headers["Host"] = pseudo[b":authority"]
+        if "Priority" in headers:
+            stream.urgency = parse_urgency(headers["Priority"])
+
+        path, _, query = pseudo[b":path"].partition("?")
+        timer.lap("parse")
+        request = build_request(
+            pseudo[b":method"], path, urlparse.parse_qs(query), headers, self.addr, timer, settings.snapshot
+        )
+        request.body = RequestBody()
+        return request
+
+    def start_worker(self, stream, request, response=None):
+        # A 103 is a HEADERS frame without END_STREAM ahead of the response's own
+        request.early_hints = lambda hints: self.send_headers(stream, hints.h2, end_stream=False)
+        threading.Thread(target=self.run_stream, args=(stream, request, response), daemon=True).start()
+
+    def run_stream(self, stream, request, response=None):
+        try:
+            if response is None:
+                response = connection.dispatch(request)
+            if isinstance(response, tuple):
+                response, body = response
+            else:
+                body = response.body
+            if request.settings.SERVER_TIMING:
+                response = response.add_header("Server-Timing", request.timer.server_timing())
+            if request.method == "HEAD":
+                body = b""
+
+            if callable(body):
+                self.send_headers(stream, response_headers(response.head), end_stream=False)
+                body(StreamSink(self, stream))
+                self.send_data(stream, b"", end_stream=True)
+            else:
+                self.send_headers(stream, response_headers(response.head), end_stream=not body)
+                if body:
+                    self.send_data(stream, body, end_stream=True)
+            request.timer.lap("send")
+            connection.log_timings(request, self.addr, response, request.timer)
+        except StreamReset:
+            logger.info(f"HTTP/2 stream {stream.id} from {self.addr[0]} reset")
+        except Exception:
+            logger.exception(f"HTTP/2 stream {stream.id} from {self.addr[0]} failed")
+            self.reset_stream(stream, INTERNAL_ERROR)
+        finally:
+            request.body.close()
+
+    # ------------------- writing -------------------
+
+    def queue_control(self, data):
+        with self.cond:
+            self.control.append(data)
+            self.cond.notify_all()
+
+    def send_headers(self, stream, headers, end_stream):
+        with self.cond:
+            if stream.reset or self.dead:
+                raise StreamReset()
+            # Encoded by the writer, HPACK state depends on the order blocks go out
+            self.control.append((stream, headers, end_stream))
+            self.cond.notify_all()
+
+    def send_data(self, stream, data, end_stream=False):
+        with self.cond:
+            # Backpressure, don't read a whole file into the queue
+            while stream.queued >= STREAM_BUFFER and not (stream.reset or self.dead):
+                # A client that stops sending WINDOW_UPDATE would hold this worker forever
+                if not self.cond.wait(self.send_timeout) and stream.queued >= STREAM_BUFFER:
+                    logger.info(f"HTTP/2 stream {stream.id} of {self.addr[0]} stalled, resetting")
+                    self.reset_stream(stream, CANCEL)
+            if stream.reset or self.dead:
+                raise StreamReset()
+            if data:
+                stream.queue.append(memoryview(data))
+                stream.queued += len(data)
+            stream.end_queued = end_stream
+            self.active.add(stream)
+            self.cond.notify_all()
+
+    def reset_stream(self, stream, error_code):
+        """Error code None means the client reset it."""
+        with self.cond:
+            if error_code is not None and not stream.reset:
+                self.control.append(frame(RST_STREAM, 0, stream.id, struct.pack(">I", error_code)))
+            stream.reset = True
+            stream.queue.clear()
+            self.active.discard(stream)
+            self.streams.pop(stream.id, None)
+            self.cond.notify_all()
+            self.wake_if_drained()
+
+    def finish_stream(self, stream):
+        # We sent END_STREAM, the client finished before the worker started
+        if stream.answered_early:
+            # RFC 9113 8.1, tell the client it can stop sending the body
+            self.control.append(frame(RST_STREAM, 0, stream.id, struct.pack(">I", NO_ERROR)))
+        self.active.discard(stream)
+        self.streams.pop(stream.id, None)
+        self.cond.notify_all()
+        self.wake_if_drained()
+
+    def drain(self):
+        """Graceful shutdown: GOAWAY now, finish the open streams, then close."""
+        with self.cond:
+            if self.draining or self.closing:
+                return
+            self.draining = True
+            self.control.append(frame(GOAWAY, 0, 0, struct.pack(">II", self.last_stream_id, NO_ERROR)))
+            self.cond.notify_all()
+            self.wake_if_drained()
+
+    def wake_if_drained(self):
+        # The reader sits in recv(), get it out once the last stream is done. Called with the lock held
+        if self.draining and not self.streams:
+            try:
+                self.sock.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+
+    def next_stream(self):
+        """The stream to send DATA for next, or None. Called with the lock held."""
+        ready = [
+            s for s in self.active
+            if s.headers_sent and ((s.queue and s.window > 0 and self.window > 0) or (not s.queue and s.end_queued))
+        ]
+        if not ready:
+            return None
+        if len(ready) > 1:
+            # A stream waits while a stream it depends on still has data to send
+            ready_ids = {s.id for s in ready}
+            independent = [s for s in ready if not self.waits_on(s, ready_ids)]
+            ready = independent or ready
+        return min(ready, key=lambda s: (s.urgency, s.sent / s.weight))
+
+    def waits_on(self, stream, ready_ids):
+        parent = stream.depends_on
+        for _ in range(MAX_STREAMS):
+            if not parent:
+                return False
+            if parent in ready_ids:
+                return True
+            parent_stream = self.streams.get(parent)
+            parent = parent_stream.depends_on if parent_stream else 0
+        return False
+
+    def take_data(self, stream):
+        """Next DATA frame for this stream. Called with the lock held."""
+        size = 0
+        chunk = b""
+        if stream.queue:
+            size = min(len(stream.queue[0]), stream.window, self.window, self.peer_frame_size)
+            head = stream.queue[0]
+            chunk = head[:size]
+            if size == len(head):
+                stream.queue.popleft()
+            else:
+                stream.queue[0] = head[size:]
+            stream.queued -= size
+            stream.window -= size
+            self.window -= size
+            stream.sent += size
+        flags = 0
+        if not stream.queue and stream.end_queued:
+            flags = END_STREAM
+            self.finish_stream(stream)
+        elif not stream.queue:
+            self.active.discard(stream)
+        # The worker may be waiting for room in the buffer
+        self.cond.notify_all()
+        return frame(DATA, flags, stream.id, bytes(chunk))
+
+    def encode_headers(self, stream, headers, end_stream):
+        block = self.encoder.encode(headers)
+        flags = END_STREAM if end_stream else 0
+        frames = []
+        first = True
+        while True:
+            piece, block = block[: self.peer_frame_size], block[self.peer_frame_size :]
+            last = END_HEADERS if not block else 0
+            frames.append(frame(HEADERS if first else CONTINUATION, (flags if first else 0) | last, stream.id, piece))
+            first = False
+            if not block:
+                break
+        stream.headers_sent = True
+        if end_stream:
+            self.finish_stream(stream)
+        return b"".join(frames)
+
+    def write_loop(self):
+        try:
+            while True:
+                out = []
+                size = 0
+                with self.cond:
+                    while True:
+                        while size < WRITE_BATCH:
+                            if self.control:
+                                item = self.control.popleft()
+                                if isinstance(item, tuple):
+                                    stream, headers, end_stream = item
+                                    if stream.reset:
+                                        continue
+                                    item = self.encode_headers(stream, headers, end_stream)
+                            else:
+                                stream = self.next_stream()
+                                if stream is None:
+                                    break
+                                item = self.take_data(stream)
+                            out.append(item)
+                            size += len(item)
+                        if out or self.dead:
+                            break
+                        if self.closing:
+                            return
+                        self.cond.wait()
+                if self.dead:
+                    return
+                self.sock.sendall(b"".join(out))
+        except OSError:
+            with self.cond:
+                self.dead = True
+                self.cond.notify_all()
+            try:
+                # Wake the reader up
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self, error_code):
+        with self.cond:
+            if error_code == NO_ERROR:
+                # Let the streams that are still running finish
+                self.cond.wait_for(lambda: self.dead or not self.streams, timeout=IDLE_TIMEOUT)
+            else:
+                for stream in self.streams.values():
+                    stream.reset = True
+                self.active.clear()
+            self.control.append(frame(GOAWAY, 0, 0, struct.pack(">II", self.last_stream_id, error_code)))
+            self.closing = True
+            self.cond.notify_all()
+
+
+def drain_all():
+    with connections_lock:
+        open_connections = list(connections)
+    for conn in open_connections:
+        conn.drain()
+
+
+def serve(sock, addr, initial=b"", upgrade=None):
+    """Serve an HTTP/2 connection until it closes, `initial` is what was already read from it."""
+    logger.info(f"HTTP/2 connection from {addr[0]}")
+    H2Connection(sock, addr, initial).run(upgrade)
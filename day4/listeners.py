@@ -0,0 +1,133 @@
+"""
+Listening sockets, like nginx's listen directive.
+
+    "listen": [
+        "8000",
+        {"address": "[::]:8000", "ipv6only": false},
+        {"address": "unix:/run/nginx_clone.sock", "mode": "0660", "backlog": 4096},
+        {"address": "127.0.0.1:8001", "backlog": 1024, "deferred_accept": 5, "fastopen": 256, "rcvbuf": "256k"}
+    ]
+
+An address is "port", "host:port", "[ipv6]:port" or "unix:/path". A plain
+string uses the defaults: backlog 511 and, for IPv6, ipv6only on (so
+"[::]:8000" and "8000" can both be listed). Set ipv6only to false to get
+a single dual stack socket instead. "mode" chmods a Unix socket, and
+deferred_accept, fastopen, rcvbuf, sndbuf and so_keepalive override the
+global TCP options (sockopts.py) for that listener.
+
+Without "listen" the server listens on host:port as it always did. All
+listeners feed the same accept loop and connection handling.
+"""
+import os
+import socket
+import stat
+from types import MappingProxyType
+
+from vhosts import parse_size
+
+DEFAULT_BACKLOG = 511
+
+
+def parse_keepalive(value):
+    # nginx's so_keepalive: false, true (OS defaults) or "idle:interval:count" in seconds, parts may be empty
+    if value is None or value is False or value == "off":
+        return None
+    if value is True or value == "on":
+        return (None, None, None)
+    parts = str(value).split(":")
+    if len(parts) != 3:
+        raise ValueError(f"expected idle:interval:count, got {value!r}")
+    return tuple(int(part) if part else None for part in parts)
+
+
+# Per listener overrides of the sockopts.py settings
+OPTIONS = {
+    "deferred_accept": float,
+    "fastopen": int,
+    "rcvbuf": parse_size,
+    "sndbuf": parse_size,
+    "so_keepalive": parse_keepalive,
+}
+
+
+def parse_address(address):
+    """(family, sockaddr) for "8000", "host:port", "[::1]:port" or "unix:/path"."""
+    address = str(address)
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if not path:
+            raise ValueError("unix: needs a path")
+        return socket.AF_UNIX, path
+    if address.startswith("["):
+        host, _, port = address[1:].partition("]:")
+        return socket.AF_INET6, (host, int(port))
+    host, _, port = address.rpartition(":")
+    if host in ("", "*"):
+        host = "0.0.0.0"
+    return socket.AF_INET, (host, int(port))
+
+
+class Listener:
+    __slots__ = ("address", "family", "sockaddr", "backlog", "mode", "ipv6only", "options")
+
+    def __init__(self, spec):
+        if not isinstance(spec, dict):
+            spec = {"address": spec}
+        unknown = spec.keys() - {"address", "backlog", "mode", "ipv6only", *OPTIONS}
+        if unknown:
+            raise ValueError(f"Unknown listen settings: {', '.join(sorted(unknown))}")
+        self.address = str(spec["address"])
+        self.family, self.sockaddr = parse_address(self.address)
+        self.backlog = int(spec.get("backlog", DEFAULT_BACKLOG))
+        mode = spec.get("mode")
+        # "0660" in JSON, an int from configure()
+        self.mode = int(mode, 8) if isinstance(mode, str) else mode
+        self.ipv6only = bool(spec.get("ipv6only", True))
+        # Upper case like the settings they override
+        self.options = MappingProxyType(
+            {name.upper(): convert(spec[name]) for name, convert in OPTIONS.items() if name in spec}
+        )
+
+    def __repr__(self):
+        return f"Listener({self.address!r})"
+
+    def open(self, tune=None):
+        """A listening socket, `tune(sock)` sets the socket options before bind() and listen()."""
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        try:
+            if self.family == socket.AF_UNIX:
+                remove_stale_socket(self.sockaddr)
+            else:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, int(self.ipv6only))
+            if tune:
+                tune(sock)
+            sock.bind(self.sockaddr)
+            if self.family == socket.AF_UNIX and self.mode is not None:
+                os.chmod(self.sockaddr, self.mode)
+            sock.listen(self.backlog)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+
+def remove_stale_socket(path):
+    # Left behind by a previous run, bind() would fail with EADDRINUSE. Never a regular file
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def parse_listen(value):
+    if isinstance(value, (str, int, dict)):
+        value = [value]
+    return tuple(Listener(spec) for spec in value)
+
+
+def configured(snapshot):
+    """The snapshot's listeners, host:port when "listen" isn't set."""
+    return snapshot.LISTEN or (Listener(f"{snapshot.HOST}:{snapshot.PORT}"),)
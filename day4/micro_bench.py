@@ -0,0 +1,196 @@
+"""
+Micro-benchmarks for the pure functions on the request path.
+
+    python micro_bench.py                          # run and print
+    python micro_bench.py --output before.json     # save the results
+    python micro_bench.py --compare before.json    # fail on regressions
+
+For every function we report the median ns/op over several repeats, the
+spread between repeats and, measured with tracemalloc outside of the timed
+loop, the peak bytes allocated by a single call and the allocations per
+call: memory blocks a call leaves allocated (its result and whatever it
+caches), counted from a snapshot diff. Temporaries freed before the call
+returns don't show up in that count, only in the peak bytes.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import timeit
+import tracemalloc
+from pathlib import Path
+
+from handlers import _  # registers the routes used by get_handler
+from request import Request, gzip_if_needed, parse_range, parse_request
+from response import canned_response, http_response, may_by_handle_range, not_modified_response
+from routes import get_handler
+from serve_files import make_etag, parse_last_modified_since
+from settings import settings
+
+RAW_REQUEST = (
+    b"GET /time?tz=utc&format=iso HTTP/1.1\r\n"
+    b"Host: localhost:8000\r\n"
+    b"User-Agent: Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/128.0\r\n"
+    b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+    b"Accept-Encoding: gzip, deflate, br\r\n"
+    b"Accept-Language: en-US,en;q=0.5\r\n"
+    b"If-None-Match: 67b5bdaade47f28dcefd09d4fb37abb8\r\n"
+    b"Connection: keep-alive\r\n\r\n"
+)
+ADDR = ("127.0.0.1", 50000)
+TEXT_BODY = (b"<p>The quick brown fox jumps over the lazy dog.</p>\n" * 80)  # ~4 KB
+FILE_STATS = os.stat(__file__)
+STATIC_HEADERS = {
+    "ETag": "67b5bdaade47f28dcefd09d4fb37abb8",
+    "Last-Modified": "Thu, 24 Jul 2025 14:38:58 GMT",
+    "Content-Length": str(len(TEXT_BODY)),
+}
+# A Range past the end of this file, answered with the prebuilt 416
+UNSATISFIABLE = Request("GET", "/micro_bench.py", headers={"Range": "bytes=999999999-"}, settings=settings.snapshot)
+
+BENCHMARKS = {
+    "request.parse_request": lambda: parse_request(RAW_REQUEST, ADDR),
+    "request.parse_range": lambda: parse_range("bytes=500-999", 1_000_000),
+    "request.gzip_if_needed": lambda: gzip_if_needed(TEXT_BODY, "text/html", "gzip, deflate"),
+    "response.http_response": lambda: http_response(
+        TEXT_BODY, 200, "text/html", extra_headers=STATIC_HEADERS
+    ),
+    "response.canned_response": lambda: canned_response(404),
+    "response.canned_response_416": lambda: canned_response(
+        416, extra=b"Content-Range: bytes */1000000\r\nAccept-Ranges: bytes\r\n"
+    ),
+    "response.may_by_handle_range_416": lambda: may_by_handle_range(Path(__file__), UNSATISFIABLE),
+    "response.not_modified_response": lambda: not_modified_response(
+        {"ETag": STATIC_HEADERS["ETag"], "Last-Modified": STATIC_HEADERS["Last-Modified"]}
+    ),
+    "serve_files.make_etag": lambda: make_etag(FILE_STATS),
+    "serve_files.parse_last_modified_since": lambda: parse_last_modified_since(
+        "Thu, 24 Jul 2025 14:38:58 GMT"
+    ),
+    "routes.get_handler": lambda: get_handler("/time"),
+}
+
+
+def peak_allocation(fn, calls=20):
+    """Smallest peak of traced memory over a few single calls, in bytes."""
+    fn()  # warm up caches (regex compiles, interned strings...)
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(calls):
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - base)
+    finally:
+        tracemalloc.stop()
+    return min(peaks)
+
+
+def allocations(fn, calls=100):
+    """Blocks allocated per call that are still alive when it returns, results kept."""
+    fn()  # warm up caches (regex compiles, interned strings...)
+    # Sized up front, storing a result doesn't allocate
+    results = [None] * calls
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for i in range(calls):
+            results[i] = fn()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    # tracemalloc's own bookkeeping and the snapshot taken before aren't the function's
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+    diff = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), "filename")
+    count = sum(stat.count_diff for stat in diff if stat.count_diff > 0)
+    return round(count / calls, 2)
+
+
+def run_benchmark(fn, repeat, min_time):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    runs = [t / number * 1e9 for t in timer.repeat(repeat=repeat, number=number)]
+    median = statistics.median(runs)
+    stdev = statistics.stdev(runs) if len(runs) > 1 else 0.0
+    return {
+        "ns_per_op": round(median, 1),
+        "min_ns": round(min(runs), 1),
+        "stdev_ns": round(stdev, 1),
+        "cv": round(stdev / median, 4) if median else 0.0,
+        "loops": number,
+        "repeats": repeat,
+        "peak_alloc_bytes": peak_allocation(fn),
+        "allocs_per_op": allocations(fn),
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get("results", {}).get(name)
+        if not old:
+            continue
+        change = (result["ns_per_op"] - old["ns_per_op"]) / old["ns_per_op"]
+        # Don't call noise a regression: the change has to beat the spread too
+        noise = max(result["cv"], old["cv"])
+        regressed = change > max(threshold, 2 * noise)
+        flag = "REGRESSION" if regressed else ("faster" if change < -threshold else "ok")
+        print(
+            f"{name:40} {old['ns_per_op']:>10.1f} -> {result['ns_per_op']:<10.1f} ns/op "
+            f"{change:+7.1%}  alloc {old['peak_alloc_bytes']} -> {result['peak_alloc_bytes']} B, "
+            f"{old.get('allocs_per_op', '?')} -> {result['allocs_per_op']} allocs  {flag}"
+        )
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nginx Clone micro-benchmarks")
+    parser.add_argument("--filter", help="Only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--min-time", type=float, default=0.1, help="Seconds per repeat")
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    parser.add_argument("--compare", help="Compare against a previously saved result")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Allowed slowdown (0.10 = 10%%)")
+    args = parser.parse_args()
+
+    # parse_request logs every request and parse_range every bad header, keep
+    # the logging cost but not the noise
+    logging.disable(logging.ERROR)
+
+    results = {}
+    for name, fn in BENCHMARKS.items():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = run_benchmark(fn, args.repeat, args.min_time)
+        r = results[name]
+        print(
+            f"{name:40} {r['ns_per_op']:>10.1f} ns/op  ±{r['cv']:.1%}  "
+            f"{r['peak_alloc_bytes']:>7} B peak  {r['allocs_per_op']:>6} allocs/op",
+            file=sys.stderr,
+        )
+
+    report = {"python": platform.python_version(), "machine": platform.machine(), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
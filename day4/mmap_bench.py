@@ -0,0 +1,141 @@
+"""
+Static file strategies benchmark: read() per request vs the shared mmap
+tier vs sendfile, at several file sizes.
+
+Runs the server in-process and switches the strategy through the
+mmap_min_size / sendfile_min_size settings between runs. For every size
+and strategy --clients keep-alive connections fetch the whole file
+--requests times each, then the same for a 4 KB range in the middle.
+
+    python mmap_bench.py --sizes 16k 128k 512k 900k --requests 300
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from settings import settings
+from vhosts import parse_size
+
+STRATEGIES = {
+    "read": {"MMAP_MIN_SIZE": 0, "SENDFILE_MIN_SIZE": "1g"},
+    "mmap": {"MMAP_MIN_SIZE": 1, "SENDFILE_MIN_SIZE": "1g"},
+    "sendfile": {"MMAP_MIN_SIZE": 0, "SENDFILE_MIN_SIZE": 1},
+}
+RANGE_SIZE = 4096
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def get(sock, buffer, request):
+    """Send one request, returns (status, body length) once the whole response is in."""
+    sock.sendall(request)
+    while b"\r\n\r\n" not in buffer:
+        buffer += sock.recv(256 * 1024)
+    head, _, rest = bytes(buffer).partition(b"\r\n\r\n")
+    length = 0
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    buffer[:] = rest
+    while len(buffer) < length:
+        buffer += sock.recv(256 * 1024)
+    del buffer[:length]
+    return head[9:12], length
+
+
+def run(port, request, clients, requests):
+    latencies = []
+    errors = []
+
+    def client():
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buffer = bytearray()
+        mine = []
+        try:
+            for _ in range(requests):
+                start = time.perf_counter()
+                status, _ = get(sock, buffer, request)
+                mine.append(time.perf_counter() - start)
+                if status not in (b"200", b"206"):
+                    errors.append(status)
+        finally:
+            sock.close()
+        latencies.extend(mine)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        raise RuntimeError(f"Got {errors[:3]}")
+    latencies.sort()
+    return {
+        "requests_per_s": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p99_ms": round(latencies[int(0.99 * (len(latencies) - 1))] * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="read() vs mmap vs sendfile for static files")
+    parser.add_argument("--sizes", nargs="+", default=["16k", "128k", "512k", "900k"])
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=300, help="Per client, per run")
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    sys.stdout, report_to = open(os.devnull, "w"), sys.stdout
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            with open(os.path.join(directory, f"{size}.bin"), "wb") as f:
+                f.write(os.urandom(parse_size(size)))
+        port = free_port()
+        settings.configure(HOST="127.0.0.1", PORT=port, ROOT=directory)
+        import server  # noqa: E402  (imports the handlers too)
+
+        threading.Thread(target=server.start_server, daemon=True).start()
+        time.sleep(0.5)
+
+        for size in args.sizes:
+            middle = parse_size(size) // 2
+            full = f"GET /{size}.bin HTTP/1.1\r\nHost: localhost\r\nConnection: keep-alive\r\n\r\n".encode()
+            ranged = (
+                f"GET /{size}.bin HTTP/1.1\r\nHost: localhost\r\nConnection: keep-alive\r\n"
+                f"Range: bytes={middle}-{middle + RANGE_SIZE - 1}\r\n\r\n"
+            ).encode()
+            results[size] = {}
+            for name, overrides in STRATEGIES.items():
+                settings.configure(**overrides)
+                run(port, full, 1, 20)  # warm up (and map the file)
+                results[size][name] = {
+                    "full": run(port, full, args.clients, args.requests),
+                    "range_4k": run(port, ranged, args.clients, args.requests),
+                }
+
+    print(json.dumps(results, indent=4), file=report_to)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Shared read-only mmaps for medium sized static files.
+
+Files between mmap_min_size and sendfile_min_size are mapped once and the
+mapping is shared by every request and thread: a response body is a
+memoryview of it, a range is a slice of that memoryview, so nothing is
+read or copied per request. The page cache backs the mapping, the kernel
+copies straight from it when the response is written.
+
+Mappings are keyed by path, inode, size and mtime, so a changed file gets
+a fresh one, and kept in LRU order up to mmap_cache_size bytes. Evicted
+mappings are dropped, not closed: a response still sending from one keeps
+it alive until it is done.
+
+Like nginx's open_file_cache this assumes files are replaced (new inode)
+rather than truncated in place, reading a page past the new end of a
+truncated file that's still mapped kills the process with SIGBUS.
+"""
+import collections
+import mmap
+import threading
+
+from settings import settings
+
+logger = settings.logger
+
+_lock = threading.Lock()
+# (path, st_ino, st_size, st_mtime_ns) -> memoryview of the mapping
+_maps = collections.OrderedDict()
+_mapped_bytes = 0
+stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def mapped_view(path, file_stats, max_bytes):
+    """A read-only memoryview of the whole file, mapped on first use."""
+    global _mapped_bytes
+    key = (str(path), file_stats.st_ino, file_stats.st_size, file_stats.st_mtime_ns)
+    with _lock:
+        view = _maps.get(key)
+        if view is not None:
+            _maps.move_to_end(key)
+            stats["hits"] += 1
+            return view
+        stats["misses"] += 1
+
+    # Mapping outside the lock, two threads racing just both map it once
+    with open(path, "rb") as f:
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    with _lock:
+        if key not in _maps:
+            _maps[key] = view
+            _mapped_bytes += len(view)
+        while _mapped_bytes > max_bytes and len(_maps) > 1:
+            _, evicted = _maps.popitem(last=False)
+            _mapped_bytes -= len(evicted)
+            stats["evictions"] += 1
+    return view
+
+
+def cache_stats():
+    with _lock:
+        return {**stats, "files": len(_maps), "mapped_bytes": _mapped_bytes}
@@ -0,0 +1,119 @@
+"""
+limit_rate for downloads streamed from disk, nginx style.
+
+    "limit_rate": "1m",           # bytes/s per download (locations can override)
+    "limit_rate_after": "4m",     # the first 4 MB go out at full speed
+    "limit_rate_total": "50m"     # what all paced downloads share
+
+Each download gets a Pacer. The stream function calls pacer.pace(n) after
+sending n bytes, which sleeps until the token buckets allow the next chunk,
+so a throttled download holds its thread in time.sleep(), never spinning.
+
+limit_rate_total is a single bucket that every paced download reserves its
+chunks from. A reservation that can't be covered becomes debt the next
+caller waits out, so the downloads take turns chunk by chunk and each ends
+up with an equal share of the total. One limited below its share by its
+own limit_rate takes fewer turns and leaves the rest to the others.
+"""
+import threading
+import time
+
+CHUNK_SIZE = 64 * 1024
+# Smallest chunk a paced download sends, so pacing at 1k/s still makes progress
+MIN_CHUNK = 1024
+# Chunks per second at the configured rate, smaller chunks pace smoother
+CHUNKS_PER_SECOND = 8
+
+
+class TokenBucket:
+    """`rate` bytes/s, at most `burst` saved up while nobody sends."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, n):
+        """Take `n` bytes worth of tokens, returns how many seconds to wait before sending them."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Going negative is fine, the debt is what the next caller waits for
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+_lock = threading.Lock()
+_total = None
+# Downloads currently paced, for the stats
+active = 0
+
+
+def total_bucket(rate):
+    """The bucket all downloads share, rebuilt when limit_rate_total changes on a reload."""
+    global _total
+    if not rate:
+        return None
+    if _total is None or _total.rate != rate:
+        with _lock:
+            if _total is None or _total.rate != rate:
+                _total = TokenBucket(rate, chunk_size(rate))
+    return _total
+
+
+def chunk_size(rate):
+    return max(MIN_CHUNK, min(CHUNK_SIZE, rate // CHUNKS_PER_SECOND))
+
+
+class Pacer:
+    def __init__(self, rate, after, total):
+        self.after = after
+        self.bucket = TokenBucket(rate, chunk_size(rate)) if rate else None
+        self.total = total
+        self.chunk_size = chunk_size(min(r for r in (rate, total and total.rate) if r))
+        self.sent = 0
+
+    def __enter__(self):
+        global active
+        with _lock:
+            active += 1
+        return self
+
+    def __exit__(self, *exc):
+        global active
+        with _lock:
+            active -= 1
+
+    def pace(self, n):
+        """Account for `n` bytes just sent, sleeps as long as the limits require. Returns the seconds slept."""
+        self.sent += n
+        # Only what's past limit_rate_after counts
+        n = min(n, self.sent - self.after)
+        if n <= 0:
+            return 0.0
+        delay = 0.0
+        if self.bucket:
+            delay = self.bucket.reserve(n)
+        if self.total:
+            delay = max(delay, self.total.reserve(n))
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+def pacer_for(snapshot, location):
+    """A Pacer for one download with the location's limits, None when nothing limits it."""
+    rate = snapshot.LIMIT_RATE
+    after = snapshot.LIMIT_RATE_AFTER
+    if location is not None:
+        if location.limit_rate is not None:
+            rate = location.limit_rate
+        if location.limit_rate_after is not None:
+            after = location.limit_rate_after
+    total = total_bucket(snapshot.LIMIT_RATE_TOTAL)
+    if not rate and total is None:
+        return None
+    return Pacer(rate, after, total)
@@ -3,7 +3,10 @@ import logging
 
 import urllib.parse as urlparse
 from dataclasses import dataclass
-from routes import get_handler
+from body import RequestError
+from routes import get_handler, handlers_by_name
+from settings import settings
+from status_code import HttpResponseCode
 
 logger = logging.getLogger(__name__)
 
@@ -15,13 +18,26 @@ class Request:
     query_params: dict = None
     handler_function: callable = None
     headers: dict = None
+    timer: object = None
+    # Config snapshot the request is served with, a reload mid-request doesn't affect it
+    settings: object = None
+    # vhosts.Location picked by Host + path, carries the root/gzip/cache settings
+    location: object = None
+    # body.RequestBody, read it with request.body.read() / iterate / spool()
+    body: object = None
+    # Sends an early_hints.Hints as a 103, set by the connection when the client can take one
+    early_hints: callable = None
 
 
-def parse_request(data: bytes, addr):
+def parse_request(data: bytes, addr, timer=None, snapshot=None):
     # Adding support for parsing the request data for query parameters
     data = data.decode("utf-8", errors="ignore")
     request_line, *rest = data.split("\n")
-    method, path, _ = request_line.split(maxsplit=2)
+    parts = request_line.split()
+    # "GET /path HTTP/1.1", a target that isn't a path has no location to go to
+    if len(parts) != 3 or not parts[1].startswith("/") or not parts[2].startswith("HTTP/"):
+        raise RequestError(HttpResponseCode.HTTP_400_BAD_REQUEST, f"Bad request line {request_line[:100]!r}")
+    method, path, _ = parts
     # path will contains the query parameters seperated by ?
     path, _, query = path.partition("?")
     query_params = urlparse.parse_qs(query)
@@ -29,14 +45,29 @@ def parse_request(data: bytes, addr):
     headers = {}
     for line in rest:
         if ":" in line:
-            k, v = line.split(": ", 1)
+            # The space after the colon is optional
+            k, v = line.split(":", 1)
             headers[k.strip()] = v.strip()
 
-    handler_fn = get_handler(path)
+    if timer:
+        timer.lap("parse")
+    return build_request(method, path, query_params, headers, addr, timer, snapshot)
+
+
+def build_request(method, path, query_params, headers, addr, timer=None, snapshot=None):
+    """Route an already parsed request, shared by HTTP/1.1 and HTTP/2."""
+    snapshot = snapshot or settings.snapshot
+    location = snapshot.VHOSTS.match(headers.get("Host")).match(path)
+    if location.handler:
+        handler_fn = handlers_by_name.get(location.handler)
+    else:
+        handler_fn = get_handler(path, snapshot.ROUTES)
+    if timer:
+        timer.lap("route")
     logger.info(f"[{addr[0]}] {method} {path}")
 
     # Enough changes for the request parsing
-    return Request(method, path, query_params, handler_fn, headers)
+    return Request(method, path, query_params, handler_fn, headers, timer, snapshot, location)
 
 def parse_range(range_header: str, file_size: int):
     """
@@ -1,8 +1,16 @@
+import contextlib
+import hashlib
 import json
-import mimetypes
 import os
+import select
+import socket
+import ssl
+import time
 from pathlib import Path
 
+import header_cache
+import mmap_cache
+import ratelimit
 from request import Request, gzip_if_needed, parse_range
 from serve_files import make_etag, parse_last_modified_since
 from settings import settings
@@ -12,6 +20,67 @@ logger = settings.logger
 CHUNK_SIZE = 64 * 1024  # 64 KB
 
 
+class Response:
+    """
+    A serialized response head and its body, kept apart.
+
+    Prepending the head to the body would copy the whole body once more per
+    response, send() hands both buffers to the kernel in one sendmsg()
+    (writev) call instead and continues from a memoryview after partial writes.
+    """
+
+    __slots__ = ("head", "body")
+
+    def __init__(self, head: bytes, body=b""):
+        self.head = head
+        # bytes or anything else with the buffer protocol (memoryview, mmap slice...)
+        self.body = body
+
+    def __len__(self):
+        return len(self.head) + len(self.body)
+
+    def __bytes__(self):
+        return self.head + bytes(self.body)
+
+    @property
+    def status(self) -> bytes:
+        # Right after "HTTP/1.1 " in the status line
+        return self.head[9:12]
+
+    def add_header(self, name, value):
+        """A copy with an extra header, only the head is rebuilt."""
+        return Response(self.head[:-2] + f"{name}: {value}\r\n\r\n".encode("utf-8"), self.body)
+
+    def closing(self):
+        """A copy that tells the client this connection closes after it."""
+        if header_cache.CONNECTION[True] not in self.head:
+            return self
+        return Response(self.head.replace(header_cache.CONNECTION[True], header_cache.CONNECTION[False], 1), self.body)
+
+    def send(self, sock, deadline=None):
+        """Write head and body, gives up with socket.timeout at `deadline`."""
+        if not hasattr(sock, "sendmsg") or isinstance(sock, ssl.SSLSocket):
+            # SSLSocket has no sendmsg(), every send is its own TLS record anyway
+            sendall_until(sock, self.head, deadline)
+            if self.body:
+                sendall_until(sock, self.body, deadline)
+            return
+        buffers = [memoryview(self.head)]
+        if self.body:
+            buffers.append(memoryview(self.body))
+        while buffers:
+            if deadline is not None:
+                sock.settimeout(time_left(deadline))
+            sent = sock.sendmsg(buffers)
+            # Drop what went out, a partial write leaves the rest of a buffer
+            while sent:
+                if sent >= len(buffers[0]):
+                    sent -= len(buffers.pop(0))
+                else:
+                    buffers[0] = buffers[0][sent:]
+                    sent = 0
+
+
 def http_response(
     body,
     status_code=HttpResponseCode.HTTP_200_OK,
@@ -25,52 +94,173 @@ def http_response(
     elif isinstance(body, str):
         body = body.encode("utf-8")
 
-    if keep_open:
-        connection = "keep-alive"
-    else:
-        connection = "close"
-
+    # Everything but the extra headers comes pre-encoded from header_cache.py
+    head = [
+        header_cache.STATUS_LINES.get(status_code) or header_cache.status_line(status_code),
+        header_cache.CONTENT_TYPE_LINES.get(content_type) or header_cache.content_type_line(content_type),
+        header_cache.CONNECTION[keep_open],
+        header_cache.date_line(),
+    ]
+    if extra_headers:
+        head.extend([header_cache.header_line(item) for item in extra_headers.items()])
     # Let content length be determined by the body size
     # or by the caller
-    if content_type.startswith("text"):
-        final_content_type = f"{content_type}; charset=utf-8"
+    if (not extra_headers or "Content-Length" not in extra_headers) and status_code != HttpResponseCode.HTTP_304_NOT_MODIFIED:
+        # Without it keep-alive clients can't tell where the body ends
+        head.append(b"Content-Length: %d\r\n" % len(body))
+    head.append(header_cache.CRLF)
+    return Response(b"".join(head), body)
+
+
+# (status, keep_open) -> (head up to the Date, head after it, body)
+_canned = {}
+
+
+def canned_response(status_code, keep_open=True, extra=b""):
+    """
+    Plain text error response with the status message as body, prebuilt once.
+
+    Per call only the cached Date and `extra` (already serialized header
+    lines, like a 416's Content-Range) are put in between the template parts.
+    """
+    template = _canned.get((status_code, keep_open))
+    if template is None:
+        body = HttpResponseCode.HTTP_RESPONSE_MESSAGES[status_code].encode("utf-8")
+        template = (
+            header_cache.status_line(status_code)
+            + header_cache.content_type_line("text/plain")
+            + header_cache.CONNECTION[keep_open],
+            b"Content-Length: %d\r\n\r\n" % len(body),
+            body,
+        )
+        _canned[(status_code, keep_open)] = template
+    before, after, body = template
+    return Response(b"".join((before, header_cache.date_line(), extra, after)), body)
+
+
+NOT_MODIFIED_HEAD = (
+    header_cache.status_line(HttpResponseCode.HTTP_304_NOT_MODIFIED)
+    + header_cache.content_type_line("text/plain")
+    + header_cache.CONNECTION[True]
+)
+
+
+def not_modified_response(validators, accept_ranges=True):
+    """304 for a static file or handler, `validators` are its ETag / Last-Modified / Cache-Control."""
+    return Response(b"".join((
+        NOT_MODIFIED_HEAD,
+        header_cache.date_line(),
+        header_cache.header_lines(validators),
+        b"Accept-Ranges: bytes\r\n\r\n" if accept_ranges else header_cache.CRLF,
+    )))
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match check, weak comparison like RFC 9110 asks for."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    etag = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def handler_response(request):
+    """
+    Run the request's handler, with validators if it was bound with etag=True or version=.
+
+    With `version` the ETag comes from version(request) before the handler
+    runs, so a matching If-None-Match is answered with a 304 without
+    rendering anything. With `etag=True` the handler runs and the ETag is a
+    hash of the body, which still saves sending it.
+    """
+    handler = request.handler_function
+    version = getattr(handler, "version", None)
+    conditional = request.method in ("GET", "HEAD")
+    if version is not None:
+        etag = f'"{version(request)}"'
+        if conditional and etag_matches(request.headers.get("If-None-Match"), etag):
+            return not_modified_response({"ETag": etag}, accept_ranges=False)
+        response = handler(request)
+    elif getattr(handler, "etag", False):
+        response = handler(request)
+        # Streamed and error responses go out as they are
+        if isinstance(response, tuple) or response.status != b"200":
+            return response
+        etag = f'"{hashlib.blake2b(response.body, digest_size=12).hexdigest()}"'
+        if conditional and etag_matches(request.headers.get("If-None-Match"), etag):
+            return not_modified_response({"ETag": etag}, accept_ranges=False)
     else:
-        final_content_type = content_type
+        return handler(request)
+    if isinstance(response, tuple):
+        return response[0].add_header("ETag", etag), response[1]
+    return response.add_header("ETag", etag)
 
-    response_header = [
-        f"HTTP/1.1 {status_code} {HttpResponseCode.HTTP_RESPONSE_MESSAGES.get(status_code, 'Unknown')}",
-        f"Content-Type: {final_content_type}",
-        f"Connection: {connection}",
-    ]
-    if extra_headers:
-        for k, v in extra_headers.items():
-            response_header.append(f"{k}: {v}")
 
-    headers_response = ("\r\n".join(response_header) + "\r\n\r\n").encode("utf-8")
-    return headers_response + body
+def send_deadline(snapshot, size):
+    """time.monotonic() by which `size` bytes have to be sent, None when send_timeout is off."""
+    if not snapshot.SEND_TIMEOUT:
+        return None
+    rate = snapshot.SEND_MIN_RATE
+    return time.monotonic() + snapshot.SEND_TIMEOUT + (size / rate if rate else 0)
+
+
+def time_left(deadline):
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise socket.timeout("Client too slow to read the response")
+    return remaining
+
+
+def sendall_until(sock, data, deadline):
+    """sendall() that gives up at `deadline`, a client reading a byte at a time can't hold us."""
+    if not isinstance(sock, socket.socket):
+        # HTTP/2 stream, the connection applies send_timeout itself
+        sock.sendall(data)
+        return
+    # sendall's timeout is for the whole call, not per send()
+    sock.settimeout(time_left(deadline))
+    sock.sendall(data)
+
+
+def wait_writable(sock, deadline):
+    _, writable, _ = select.select([], [sock], [], time_left(deadline))
+    if not writable:
+        raise socket.timeout("Client too slow to read the response")
+
+
+def send_file_part(sock, f, length, deadline, pacer=None):
+    """Send `length` bytes from f's current position with read() + sendall()."""
+    chunk_size = pacer.chunk_size if pacer else CHUNK_SIZE
+    while length > 0:
+        chunk = f.read(min(chunk_size, length))
+        if not chunk:
+            break
+        sendall_until(sock, chunk, deadline)
+        length -= len(chunk)
+        if pacer:
+            # Time spent throttled doesn't count against send_timeout
+            slept = pacer.pace(len(chunk))
+            if deadline is not None:
+                deadline += slept
 
 
 def static_file_response(file_path, request: Request, head_only=False):
+    snapshot = request.settings or settings.snapshot
+    location = request.location
+    root = location.root if location else snapshot.ROOT
     # check if file exists first
     path = Path(file_path).resolve()
     if not path.exists():
-        return http_response(
-            HttpResponseCode.HTTP_RESPONSE_MESSAGES[
-                HttpResponseCode.HTTP_404_NOT_FOUND
-            ],
-            HttpResponseCode.HTTP_404_NOT_FOUND,
-            "text/plain",
-        )
-    elif not path.is_relative_to(settings.ROOT):
+        return canned_response(HttpResponseCode.HTTP_404_NOT_FOUND)
+    elif not path.is_relative_to(root):
         # if trying to access a file whose permission not granted
-        return http_response(
-            HttpResponseCode.HTTP_RESPONSE_MESSAGES[
-                HttpResponseCode.HTTP_403_FORBIDDEN
-            ],
-            HttpResponseCode.HTTP_403_FORBIDDEN,
-            "text/plain",
-        )
+        return canned_response(HttpResponseCode.HTTP_403_FORBIDDEN)
     file_stats = path.stat()
+    if request.timer:
+        request.timer.lap("stat")
     etag, lm = make_etag(file_stats)
 
     inm = request.headers.get("If-None-Match")
@@ -88,34 +278,43 @@ def static_file_response(file_path, request: Request, head_only=False):
             not_modified = False
 
     common_headers = {"ETag": etag, "Last-Modified": lm}
+    # cache_policy rules first, the location's cache_control when none matches
+    policy = snapshot.CACHE_POLICY.lookup(request.path)
+    if policy is not None:
+        common_headers.update(policy.headers())
+    elif location and location.cache_control:
+        common_headers["Cache-Control"] = location.cache_control
 
     if not_modified:
         # No need to server file if not modified
-        return http_response(
-            b"",
-            HttpResponseCode.HTTP_304_NOT_MODIFIED,
-            content_type="text/plain",
-            extra_headers={
-                **common_headers,
-                "Accept-Ranges": "bytes",
-            },
-        )
+        return not_modified_response(common_headers)
 
     # guess the mime type
-    mime, _ = mimetypes.guess_type(file_path)
-    if not mime:
-        mime = "application/octet-stream"
+    mime = snapshot.mime_type(path)
+
+    # Medium files are served from a shared mmap, see mmap_cache.py. Not when
+    # limit_rate applies, a view goes out in one send and the pacer never sees
+    # it, those are streamed like the large ones
+    size = file_stats.st_size
+    view = None
+    medium = snapshot.MMAP_MIN_SIZE and snapshot.MMAP_MIN_SIZE <= size < snapshot.SENDFILE_MIN_SIZE
+    paced = medium and ratelimit.pacer_for(snapshot, location) is not None
+    if medium and not paced:
+        view = mmap_cache.mapped_view(path, file_stats, snapshot.MMAP_CACHE_SIZE)
 
     # ------------------- Range Handling -------------------
-    resp = may_by_handle_range(path, request, common_headers=common_headers, head_only=head_only)
+    resp = may_by_handle_range(path, request, common_headers=common_headers, head_only=head_only, view=view)
     if resp:
         return resp
 
-    # --------- Large VS Small File Handling ---------
-    if file_stats.st_size > 1_000_000:  # 1 MB
+    # --------- Large VS Medium VS Small File Handling ---------
+    if size >= snapshot.SENDFILE_MIN_SIZE or paced:
         return stream_large_file(path, request, common_headers=common_headers, head_only=head_only)
-    else:
-        return serve_small_files(path, mime, headers=common_headers)
+    # Only compress where the location asked for it
+    accept_encoding = request.headers.get("Accept-Encoding", "") if location and location.gzip else ""
+    if view is not None:
+        return serve_mapped_file(view, mime, headers=common_headers, accept_encoding=accept_encoding)
+    return serve_small_files(path, mime, headers=common_headers, accept_encoding=accept_encoding)
 
 
 def http_text_response(file_path):
@@ -123,7 +322,7 @@ def http_text_response(file_path):
         return http_response(f.read(), HttpResponseCode.HTTP_200_OK, "text/plain")
 
 
-def may_by_handle_range(file_path: Path, request: Request, common_headers=None, head_only=False):
+def may_by_handle_range(file_path: Path, request: Request, common_headers=None, head_only=False, view=None):
     size = file_path.stat().st_size
     range_header = request.headers.get("Range")
 
@@ -131,25 +330,16 @@ def may_by_handle_range(file_path: Path, request: Request, common_headers=None,
         # If no range header, serve the whole file
         return None
 
-    try:
-        start, end = parse_range(range_header, size)
-    except ValueError as e:
-        logger.error(f"Invalid Range Header: {range_header} - {e}")
-        return http_response(
-            HttpResponseCode.HTTP_RESPONSE_MESSAGES[
-                HttpResponseCode.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
-            ],
+    # parse_range logs a bad header and gives (None, None)
+    start, end = parse_range(range_header, size)
+    if start is None:
+        return canned_response(
             HttpResponseCode.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
-            "text/plain",
-            extra_headers={
-                "Content-Range": f"bytes */{size}",
-                "Accept-Ranges": "bytes",
-            }
-        ), None
+            extra=b"Content-Range: bytes */%d\r\nAccept-Ranges: bytes\r\n" % size,
+        )
 
     content_length = end - start + 1
-    mime, _ = mimetypes.guess_type(file_path)
-    mime = mime or "application/octet-stream"
+    mime = (request.settings or settings.snapshot).mime_type(file_path)
 
     headers = {
         **(common_headers or {}),
@@ -165,19 +355,18 @@ def may_by_handle_range(file_path: Path, request: Request, common_headers=None,
     if head_only:
         return head
 
+    if view is not None:
+        # A slice of the shared mapping, nothing is read or copied
+        return Response(head.head, view[start : end + 1])
+
+    snapshot = request.settings or settings.snapshot
+    pacer = ratelimit.pacer_for(snapshot, request.location)
+
     def send_range_content(sock):
-        with file_path.open("rb") as f:
+        deadline = send_deadline(snapshot, content_length)
+        with file_path.open("rb") as f, pacer or contextlib.nullcontext():
             f.seek(start)
-            remaining = content_length
-            prev_timeout = sock.gettimeout()
-            sock.settimeout(None)
-            while remaining > 0:
-                chunk = f.read(min(CHUNK_SIZE, remaining))
-                if not chunk:
-                    break
-                sock.sendall(chunk)
-                remaining -= len(chunk)
-            sock.settimeout(prev_timeout)
+            send_file_part(sock, f, content_length, deadline, pacer)
 
     return head, send_range_content
 
@@ -198,54 +387,81 @@ def stream_large_file(
     head = http_response(
         b"",
         HttpResponseCode.HTTP_200_OK,
-        mimetypes.guess_type(path)[0] or "application/octet-stream",
+        (request.settings or settings.snapshot).mime_type(path),
         extra_headers=headers,
     )
 
     if head_only:
         return head
 
+    snapshot = request.settings or settings.snapshot
+    pacer = ratelimit.pacer_for(snapshot, request.location)
+
     if hasattr(os, "sendfile"):
 
         def sendfile(sock):
-            with path.open("rb") as f:
+            deadline = send_deadline(snapshot, size)
+            if isinstance(sock, ssl.SSLSocket) or not isinstance(sock, socket.socket):
+                # Plain os.sendfile would skip the encryption. SSLSocket.sendfile
+                # still uses it when kTLS is active and falls back to send() otherwise.
+                # HTTP/2 streams aren't sockets at all, they frame what we hand them
+                with path.open("rb") as f:
+                    if pacer is None:
+                        sock.settimeout(time_left(deadline))
+                        sock.sendfile(f)
+                        return
+                    with pacer:
+                        # Chunk by chunk so the pacer gets a say between them
+                        send_file_part(sock, f, size, deadline, pacer)
+                return
+            # A socket with a timeout is non blocking underneath, so os.sendfile
+            # returns EAGAIN once the send buffer is full and we wait for room
+            sock.settimeout(time_left(deadline))
+            chunk_size = pacer.chunk_size if pacer else CHUNK_SIZE
+            with path.open("rb") as f, pacer or contextlib.nullcontext():
                 offset = 0
-                size = path.stat().st_size
                 while offset < size:
-                    sent = os.sendfile(sock.fileno(), f.fileno(), offset, CHUNK_SIZE)
+                    try:
+                        sent = os.sendfile(sock.fileno(), f.fileno(), offset, chunk_size)
+                    except BlockingIOError:
+                        wait_writable(sock, deadline)
+                        continue
                     if sent == 0:
                         break
                     offset += sent
+                    if pacer:
+                        # Sleeping, not polling, until the next chunk is due
+                        slept = pacer.pace(sent)
+                        if deadline is not None:
+                            deadline += slept
     else:
 
         def sendfile(sock):
-            # run socket in blocking mode else we will get exception is buffer is full
-            prev_timeout = sock.gettimeout()
-            sock.settimeout(None)
-            with path.open("rb") as f:
-                while chunk := f.read(CHUNK_SIZE):
-                    sock.sendall(chunk)
-            sock.settimeout(prev_timeout)
+            deadline = send_deadline(snapshot, size)
+            with path.open("rb") as f, pacer or contextlib.nullcontext():
+                send_file_part(sock, f, size, deadline, pacer)
 
     return head, sendfile
 
 
-def serve_small_files(path, mime_type, headers=None):
+def serve_mapped_file(view, mime_type, headers=None, accept_encoding=""):
+    """Serve a file from its shared mmap, the memoryview is the response body."""
+    body, gzip_headers = gzip_if_needed(view, mime_type, accept_encoding)
+    headers = {**(headers or {}), **gzip_headers}
+    return http_response(body, HttpResponseCode.HTTP_200_OK, mime_type, extra_headers=headers)
+
+
+def serve_small_files(path, mime_type, headers=None, accept_encoding=""):
     """
     Serve small files directly by reading them into memory.
     """
-    mime, _ = mimetypes.guess_type(path)
-    mime = mime or "application/octet-stream"
-
     with path.open("rb") as f:
         content = f.read()
 
-    body, gzip_headers = gzip_if_needed(
-        content, mime_type, headers.get("Accept-Encoding", "") if headers else ""
-    )
+    body, gzip_headers = gzip_if_needed(content, mime_type, accept_encoding)
 
-    headers.update(gzip_headers)
+    headers = {**(headers or {}), **gzip_headers}
 
     return http_response(
-        content, HttpResponseCode.HTTP_200_OK, mime, extra_headers=headers
+        body, HttpResponseCode.HTTP_200_OK, mime_type, extra_headers=headers
     )
@@ -1,18 +1,53 @@
 from collections import namedtuple
 
+from concurrency import Bulkhead
+from early_hints import compile_links
+
 Route = namedtuple("Route", ["path", "handler_function"])
 
 handlers = {}
+# function name -> handler, so config.json can point paths at handlers by name
+handlers_by_name = {}
+
+def bind_handler(path, etag=False, version=None, max_concurrency=None, early_hints=None):
+    """
+    Register a handler for `path`.
 
-def bind_handler(path):
+    etag=True gives its 200 responses an ETag from a hash of the body, and
+    clients revalidating with If-None-Match get a 304 instead of the body.
+    version=fn(request) returns a cheap key (a row's updated_at, a counter...)
+    used as the ETag instead, on a match the handler isn't even called.
+    max_concurrency=n is a bulkhead: more than n requests in the handler at
+    once and the rest get a 503 right away, see concurrency.py.
+    early_hints=["/app.css", ...] are preloaded with a 103 before the
+    handler runs, see early_hints.py.
+    """
     def decorator(handler_function):
+        # On the function, config.json routes find handlers by name
+        handler_function.etag = etag
+        handler_function.version = version
+        handler_function.bulkhead = Bulkhead(max_concurrency) if max_concurrency else None
+        handler_function.early_hints = compile_links(early_hints)
         handlers[path] = Route(path=path, handler_function=handler_function)
+        handlers_by_name[handler_function.__name__] = handler_function
         return handler_function
     return decorator
 
 
-def get_handler(path):
-    """Get the handler function by path."""
+def get_handler(path, config_routes=None):
+    """Get the handler function by path, config.json routes win over decorators."""
+    if config_routes:
+        name = config_routes.get(path)
+        if name in handlers_by_name:
+            return handlers_by_name[name]
     route = handlers.get(path)
     return route.handler_function if route else None
 
+
+def validate_routes(config_routes):
+    """Raise ValueError if config.json names a handler that doesn't exist."""
+    for path, name in config_routes.items():
+        if not isinstance(path, str) or not path.startswith("/"):
+            raise ValueError(f"Invalid route path {path!r}")
+        if name not in handlers_by_name:
+            raise ValueError(f"Unknown handler {name!r} for route {path}")
@@ -1,31 +1,235 @@
 import argparse
+import os
+import selectors
+import signal
 import socket
 import threading
+import time
 
-from connection import handle_request
+import http2
+import listeners
+import sockopts
+import tls
+from connection import drain_idle, handle_request, idle_count, reap_idle
+from profiler import profiler
+from response import canned_response
 from settings import settings
+from status_code import HttpResponseCode
 from handlers import _
 
-def start_server():
-    print(f"Starting server on {settings.HOST}:{settings.PORT}")
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_server:
-        tcp_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        tcp_server.bind((settings.HOST, settings.PORT))
-        tcp_server.listen(5)
-        settings.logger.info(
-            f"Server is running on http://{settings.HOST}:{settings.PORT}"
+
+def reload_config(signum, frame):
+    # kill -HUP <pid> re-reads config.json without dropping any connection
+    settings.reload()
+
+
+def start_profiler(signum, frame):
+    # kill -USR2 <pid> profiles the live server for PROFILE_SECONDS
+    profiler.start(settings.PROFILE_SECONDS)
+
+
+class GracefulExit(Exception):
+    """Raised from the SIGTERM handler to get the main thread out of accept()."""
+
+
+# Set by a SIGTERM while draining, stop waiting for the connections
+force_shutdown = threading.Event()
+shutdown_requested = False
+
+
+def request_shutdown(signum, frame):
+    global shutdown_requested
+    if shutdown_requested:
+        # Raising again could land anywhere in drain(), it checks the event instead
+        force_shutdown.set()
+        return
+    shutdown_requested = True
+    raise GracefulExit()
+
+
+# Seconds between progress lines while draining
+DRAIN_LOG_INTERVAL = 1
+# How long a second SIGTERM may wait to be noticed
+FORCE_CHECK_INTERVAL = 0.1
+
+# Threads currently serving a connection, so we can wait for them on shutdown
+connections = set()
+connections_lock = threading.Lock()
+
+
+def serve_connection(client_socket, addr, overrides=None):
+    me = threading.current_thread()
+    with connections_lock:
+        connections.add(me)
+    try:
+        sockopts.tune_connection(client_socket, settings.snapshot, overrides)
+        # The TLS handshake happens here, on the connection's thread, not in accept()
+        context = tls.server_context(settings.snapshot)
+        if context:
+            client_socket = tls.wrap(context, client_socket)
+            if client_socket is None:
+                return
+        handle_request(client_socket, addr)
+    finally:
+        with connections_lock:
+            connections.discard(me)
+
+
+def at_capacity():
+    """True if a new connection has to be turned away, closes an idle one first if it can."""
+    limit = settings.MAX_CONNECTIONS
+    if not limit:
+        return False
+    with connections_lock:
+        open_connections = len(connections)
+    if open_connections < limit:
+        return False
+    # Keep-alive connections waiting for their next request are the cheapest to give up
+    return reap_idle(open_connections - limit + 1) == 0
+
+
+def refuse(client_socket, addr):
+    settings.logger.warning(f"{settings.MAX_CONNECTIONS} connections open, refusing {addr[0]}")
+    try:
+        client_socket.setblocking(False)
+        # One non blocking send, the accept loop doesn't wait for anybody
+        response = canned_response(
+            HttpResponseCode.HTTP_503_SERVICE_UNAVAILABLE, keep_open=False, extra=b"Retry-After: 1\r\n"
         )
+        client_socket.send(bytes(response))
+    except OSError:
+        pass
+    client_socket.close()
+
+
+def drain(timeout):
+    """
+    Graceful shutdown once we stopped accepting: idle keep-alive connections
+    are closed right away, busy ones get "Connection: close" on their
+    response and HTTP/2 ones a GOAWAY, and we wait up to `timeout` seconds
+    for them to finish. Whatever is left after that is cut off on exit,
+    right away on a second SIGTERM.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    closed = drain_idle()
+    with connections_lock:
+        open_connections = len(connections)
+    settings.logger.info(
+        f"Draining {open_connections} connections ({closed} idle closed right away), up to {timeout:g}s"
+    )
+    next_log = start + DRAIN_LOG_INTERVAL
+    while True:
+        with connections_lock:
+            pending = list(connections)
+        if not pending:
+            settings.logger.info(f"Drained in {time.monotonic() - start:.1f}s")
+            return
+        if force_shutdown.is_set():
+            settings.logger.warning(f"SIGTERM received again, closing {len(pending)} connections now")
+            return
+        now = time.monotonic()
+        if now >= deadline:
+            settings.logger.warning(f"{len(pending)} connections still open after {timeout:g}s, closing them")
+            return
+        pending[0].join(min(deadline, next_log, now + FORCE_CHECK_INTERVAL) - now)
+        if time.monotonic() >= next_log:
+            next_log += DRAIN_LOG_INTERVAL
+            # Connections that finished a response since went idle, close them too
+            closed = drain_idle()
+            with connections_lock:
+                open_connections = len(connections)
+            settings.logger.info(
+                f"Draining: {open_connections} open, {idle_count()} idle, {len(http2.connections)} HTTP/2,"
+                f" {closed} idle closed, {max(0, deadline - time.monotonic()):.0f}s left"
+            )
+
+
+def get_listeners():
+    """[(listening socket, its Listener)], inherited from hot_reload.py if it handed us some."""
+    inherited = os.environ.get("NGINX_CLONE_LISTEN_FD")
+    if inherited:
+        # Already tuned by hot_reload.py, comma separated when there are several.
+        # Matched back to their listen entry by address for the per connection options
+        by_address = {listener.sockaddr: listener for listener in listeners.configured(settings.snapshot)}
+        opened = []
+        for fd in inherited.split(","):
+            sock = socket.socket(fileno=int(fd))
+            name = sock.getsockname()
+            opened.append((sock, by_address.get(name if isinstance(name, str) else name[:2])))
+        return opened
+    opened = []
+    try:
+        for listener in listeners.configured(settings.snapshot):
+            # Before listen(), fastopen and the buffer sizes have to be in place for the first SYN
+            tune = lambda sock: sockopts.tune_listener(sock, settings.snapshot, listener.options)  # noqa: E731
+            opened.append((listener.open(tune), listener))
+    except OSError:
+        for sock, _ in opened:
+            sock.close()
+        raise
+    return opened
+
+
+def notify_ready():
+    # Tell hot_reload.py we are accepting, it can retire the old generation now
+    ready_fd = os.environ.pop("NGINX_CLONE_READY_FD", None)
+    if ready_fd:
+        os.write(int(ready_fd), b"1")
+        os.close(int(ready_fd))
+
+
+def accept(tcp_server, listener):
+    try:
+        client_socket, addr = tcp_server.accept()
+    except BlockingIOError:
+        # Another generation sharing the socket was quicker
+        return
+    if tcp_server.family == socket.AF_UNIX:
+        # accept() gives no peer address for unix sockets, the logs still want addr[0]
+        addr = ("unix:", 0)
+    if at_capacity():
+        refuse(client_socket, addr)
+        return
+    # Run a single thread for single client
+    threading.Thread(
+        target=serve_connection,
+        args=(
+            client_socket,
+            addr,
+            listener.options if listener else None,
+        ),
+        daemon=True,  # To ensure thread exists when main thread exists
+    ).start()
+
+
+def start_server():
+    opened = get_listeners()
+    # Every listener feeds the same accept loop
+    selector = selectors.DefaultSelector()
+    for tcp_server, listener in opened:
+        tcp_server.setblocking(False)
+        selector.register(tcp_server, selectors.EVENT_READ, listener)
+        name = tcp_server.getsockname()
+        if tcp_server.family == socket.AF_UNIX:
+            settings.logger.info(f"Server is running on unix:{name}")
+        elif tcp_server.family == socket.AF_INET6:
+            settings.logger.info(f"Server is running on http://[{name[0]}]:{name[1]}")
+        else:
+            settings.logger.info(f"Server is running on http://{name[0]}:{name[1]}")
+    notify_ready()
+    try:
         while True:
-            client_socket, addr = tcp_server.accept()
-            # Run a single thread for single client
-            threading.Thread(
-                target=handle_request,
-                args=(
-                    client_socket,
-                    addr,
-                ),
-                daemon=True,  # To ensure thread exists when main thread exists
-            ).start()
+            for key, _ in selector.select():
+                accept(key.fileobj, key.data)
+    except GracefulExit:
+        settings.logger.info("SIGTERM received, no longer accepting connections")
+    finally:
+        # Only our copy of the listeners is closed, a new generation keeps accepting
+        selector.close()
+        for tcp_server, _ in opened:
+            tcp_server.close()
+    drain(settings.DRAIN_TIMEOUT)
 
 
 def main():
@@ -35,12 +239,18 @@ def main():
 
     args = parser.parse_args()
 
-    if args.port:
-        settings.configure(PORT=args.port)
-
-    if args.host:
-        settings.configure(HOST=args.host)
+    try:
+        if args.port:
+            settings.configure(PORT=args.port)
+        if args.host:
+            settings.configure(HOST=args.host)
+        settings.snapshot.validate()
+    except ValueError as e:
+        raise SystemExit(f"Invalid configuration: {e}")
 
+    signal.signal(signal.SIGHUP, reload_config)
+    signal.signal(signal.SIGUSR2, start_profiler)
+    signal.signal(signal.SIGTERM, request_shutdown)
     start_server()
 
 
@@ -1,79 +1,303 @@
 import logging
 import json
+import mimetypes
 from pathlib import Path
+from types import MappingProxyType
 
 # pip install rich
 import rich
 
+from routes import handlers_by_name, validate_routes
+from cache_policy import compile_cache_policy
+from early_hints import compile_early_hint_links
+from listeners import parse_keepalive, parse_listen
+from vhosts import compile_vhosts, parse_size as _size
+
+
+def _path(value):
+    return Path(value).resolve()
+
+
+def _optional_path(value):
+    return _path(value) if value else None
+
+
+def _buffers(value):
+    # nginx's large_client_header_buffers, "4 8k" or [4, "8k"]
+    count, size = value.split() if isinstance(value, str) else value
+    count, size = int(count), _size(size)
+    if count < 1 or size < 1:
+        raise ValueError("need at least one buffer of at least one byte")
+    return count, size
+
+
+def _concurrency_limit(value):
+    # min, initial and max, "16 64 1024" or [16, 64, 1024]
+    low, initial, high = (int(part) for part in (value.split() if isinstance(value, str) else value))
+    if not 1 <= low <= initial <= high:
+        raise ValueError("need 1 <= min <= initial <= max")
+    return low, initial, high
+
+
+def _level(value):
+    value = str(value).upper()
+    if not isinstance(logging.getLevelName(value), int):
+        raise ValueError(f"unknown log level {value}")
+    return value
+
+
+def _mapping(value):
+    if not isinstance(value, dict):
+        raise ValueError(f"expected an object, got {type(value).__name__}")
+    return MappingProxyType(dict(value))
+
+
+def _optional_mapping(value):
+    return _mapping(value) if value else None
+
+
+def _mime_types(value):
+    # The stdlib table plus ".ext": "type" overrides from config.json
+    mimetypes.init()
+    return MappingProxyType({**mimetypes.types_map, **_mapping(value)})
+
+
+class Snapshot:
+    """
+    One immutable, compiled generation of the configuration.
+
+    Every setting is converted and validated once when the snapshot is built
+    (paths resolved, mime table merged), so reading one on the hot path is a
+    plain slot access. Reloading builds a brand new Snapshot and swaps it in
+    with a single assignment, so a request that grabbed the old one keeps a
+    consistent view until it finishes.
+    """
+
+    # name -> (converter, default). config.json uses the lower case names.
+    SCHEMA = {
+        "HOST": (str, "localhost"),
+        "PORT": (int, 8000),
+        # Listening sockets (TCP, IPv6, unix:), host:port when empty, see listeners.py
+        "LISTEN": (parse_listen, []),
+        "ROOT": (_path, "."),
+        "LEVEL": (_level, "INFO"),
+        # path -> handler function name
+        "ROUTES": (_mapping, {}),
+        # nginx like server blocks selected by Host, see vhosts.py
+        "SERVERS": (list, []),
+        # TLS listener settings, see tls.py
+        "SSL": (_optional_mapping, None),
+        # extension -> mime type, on top of the mimetypes module
+        "MIME_TYPES": (_mime_types, {}),
+        # Emit a Server-Timing header with the per-phase breakdown
+        "SERVER_TIMING": (bool, False),
+        # Requests slower than this go to the slow log
+        "SLOW_REQUEST_MS": (float, 500),
+        # Optional file for the slow log, stderr otherwise
+        "SLOW_LOG": (_optional_path, None),
+        # How long the sampling profiler runs when triggered by SIGUSR2
+        "PROFILE_SECONDS": (float, 10),
+        "PROFILE_DIR": (_path, "."),
+        # Seconds in-flight connections get to finish on SIGTERM
+        "DRAIN_TIMEOUT": (float, 30),
+        # Expose the /__admin/* routes
+        "ADMIN_ENABLED": (bool, False),
+        # Largest request body accepted, 413 above it (0 means no limit)
+        "CLIENT_MAX_BODY_SIZE": (_size, "1m"),
+        # Bodies are spooled in memory up to this size, to a temp file above it
+        "CLIENT_BODY_BUFFER_SIZE": (_size, "16k"),
+        # Where those temp files go, the system temp dir by default
+        "CLIENT_BODY_TEMP_PATH": (_optional_path, None),
+        # Seconds a new or keep-alive connection may sit idle before the next request
+        "KEEPALIVE_TIMEOUT": (float, 5),
+        # Seconds to receive a whole request head, and a whole body, once they start
+        "CLIENT_HEADER_TIMEOUT": (float, 10),
+        "CLIENT_BODY_TIMEOUT": (float, 60),
+        # Request line / header lines must fit one buffer, the head all of them
+        "LARGE_CLIENT_HEADER_BUFFERS": (_buffers, "4 8k"),
+        # A response gets send_timeout seconds plus its size at send_min_rate bytes/s
+        "SEND_TIMEOUT": (float, 10),
+        "SEND_MIN_RATE": (_size, "8k"),
+        # Open connections before idle keep-alive ones get closed to make room (0 = no limit)
+        "MAX_CONNECTIONS": (int, 1024),
+        # Bytes/s per download from disk after the first limit_rate_after bytes (0 = unlimited),
+        # locations can override both
+        "LIMIT_RATE": (_size, 0),
+        "LIMIT_RATE_AFTER": (_size, 0),
+        # Bytes/s shared by all rate paced downloads, each gets a fair share of it (0 = unlimited)
+        "LIMIT_RATE_TOTAL": (_size, 0),
+        # Static files from mmap_min_size up are mmapped once and shared (0 = never),
+        # from sendfile_min_size up they are streamed with sendfile, below both read per request
+        "MMAP_MIN_SIZE": (_size, "64k"),
+        "SENDFILE_MIN_SIZE": (_size, "1m"),
+        # Most bytes kept mapped at once, least recently used files are unmapped first
+        "MMAP_CACHE_SIZE": (_size, "256m"),
+        # Cache-Control / Expires per path and extension, fingerprinted names immutable, see cache_policy.py
+        "CACHE_POLICY": (compile_cache_policy, {}),
+        # 103 Early Hints with preload links before the response, see early_hints.py
+        "EARLY_HINTS": (bool, False),
+        "EARLY_HINTS_AUTO": (bool, True),
+        "EARLY_HINTS_LINKS": (compile_early_hint_links, {}),
+        # Shed requests with a 503 once more are being dispatched than the latency
+        # driven limit allows, see concurrency.py
+        "ADAPTIVE_CONCURRENCY": (bool, False),
+        "CONCURRENCY_LIMIT": (_concurrency_limit, "8 64 1024"),
+        "CONCURRENCY_TOLERANCE": (float, 2),
+        # TCP options, see sockopts.py
+        "TCP_NODELAY": (bool, True),
+        "TCP_NOPUSH": (bool, False),
+        "DEFERRED_ACCEPT": (float, 0),
+        "FASTOPEN": (int, 0),
+        "RCVBUF": (_size, 0),
+        "SNDBUF": (_size, 0),
+        "SO_KEEPALIVE": (parse_keepalive, None),
+        # Speak HTTP/2 to clients that ask for h2c (prior knowledge or Upgrade), see http2.py
+        "HTTP2": (bool, False),
+    }
+
+    __slots__ = ("config", "generation", "VHOSTS", *SCHEMA)
+
+    def __init__(self, config, generation=0):
+        # configure() uses upper case keys, config.json lower case ones
+        normalized = {key.upper(): value for key, value in config.items() if not key.isupper()}
+        normalized.update((key, value) for key, value in config.items() if key.isupper())
+        unknown = normalized.keys() - self.SCHEMA.keys()
+        if unknown:
+            raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+
+        object.__setattr__(self, "config", MappingProxyType(dict(config)))
+        object.__setattr__(self, "generation", generation)
+        for name, (convert, default) in self.SCHEMA.items():
+            try:
+                value = convert(normalized.get(name, default))
+            except (TypeError, ValueError, AttributeError, KeyError) as e:
+                # Whatever a converter trips over in a bad config, it's a bad config
+                raise ValueError(f"Invalid setting {name}: {e}") from e
+            object.__setattr__(self, name, value)
+        # Compiled host -> server -> location lookup
+        try:
+            vhosts = compile_vhosts(self.SERVERS, self.ROOT)
+        except (TypeError, ValueError, AttributeError, KeyError) as e:
+            raise ValueError(f"Invalid setting SERVERS: {e}") from e
+        object.__setattr__(self, "VHOSTS", vhosts)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Snapshot is immutable, use settings.configure() or settings.reload()")
+
+    def mime_type(self, path):
+        return self.MIME_TYPES.get(Path(path).suffix.lower(), "application/octet-stream")
+
+    def validate(self):
+        """Raise ValueError if the configuration can't be served."""
+        if not 0 < self.PORT < 65536:
+            raise ValueError(f"Invalid port {self.PORT}")
+        if not self.ROOT.is_dir():
+            raise ValueError(f"Root {self.ROOT} is not a directory")
+        validate_routes(self.ROUTES)
+        for server in self.VHOSTS.servers:
+            if not server.root.is_dir():
+                raise ValueError(f"Root {server.root} of {server.names} is not a directory")
+        if self.SSL:
+            certfile = self.SSL.get("certfile")
+            if not isinstance(certfile, str) or not Path(certfile).is_file():
+                raise ValueError(f"ssl certfile {certfile!r} not found")
+            # Built now, a key that doesn't match or bad ciphers fail here and not on every connection
+            import tls  # noqa: E402  (tls imports settings)
+            tls.prepare(self.SSL)
+        for name in self.VHOSTS.handler_names():
+            if name not in handlers_by_name:
+                raise ValueError(f"Unknown handler {name!r} in a location block")
+
 
 class LazySettings:
     """A class to lazily load settings from a JSON file. Inspired from Django's settings."""
 
     def __init__(self, config_file="./config.json"):
         self._config_file = config_file
-        self._config = {}
-        self._loaded = False
+        # Values from configure() (e.g. --port) survive reloads
+        self._overrides = {}
+        self._snapshot = None
+
+    def _read_config(self, strict=False):
+        try:
+            with open(self._config_file, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            if strict:
+                raise ValueError(f"Configuration file {self._config_file} not found")
+            rich.print(
+                f"[red]Configuration file {self._config_file} not found. Using default settings.[/red]"
+            )
+        except json.JSONDecodeError as e:
+            if strict:
+                raise ValueError(f"Error decoding JSON from {self._config_file}: {e}")
+            rich.print(
+                f"[red]Error decoding JSON from {self._config_file}: {e}[/red]"
+            )
+        return {}
 
     def _load_config(self):
-        if not self._loaded:
+        if self._snapshot is None:
             try:
-                with open(self._config_file, "r") as f:
-                    self._config = json.load(f)
-                self._loaded = True
-            except FileNotFoundError:
-                rich.print(
-                    f"[red]Configuration file {self._config_file} not found. Using default settings.[/red]"
-                )
-                self._config = {}
-                self._loaded = True
-            except json.JSONDecodeError as e:
-                rich.print(
-                    f"[red]Error decoding JSON from {self._config_file}: {e}[/red]"
-                )
-                self._config = {}
-                self._loaded = True
-
-    def __getattr__(self, name):
-        self._load_config()
+                self._snapshot = Snapshot({**self._read_config(), **self._overrides})
+            except AttributeError as e:
+                # Out of a property an AttributeError would land in __getattr__ and recurse
+                raise ValueError(f"Invalid configuration: {e}") from e
+        return self._snapshot
 
-        default = {"PORT": 8000, "HOST": "localhost", "ROOT": "."}
-        if name == "ROOT":
-            value = self._config.get(name, default[name])
-            return Path(value).resolve()
-        elif name == "PORT":
-            return int(self._config.get(name, default[name]))
-        elif name == "HOST":
-            return self._config.get(name, default[name])
-        elif name == "LEVEL":
-            return self._config.get(name, "INFO").upper()
+    @property
+    def snapshot(self) -> Snapshot:
+        """The current configuration, grab it once per request. ValueError if it's broken."""
+        return self._snapshot or self._load_config()
 
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.snapshot, name)
 
     def __contains__(self, item):
-        self._load_config()
-        return item.lower() in self._config
+        return item.lower() in self.snapshot.config
 
     def get(self, key, default=None):
         try:
             return getattr(self, key.upper())
-        except KeyError:
+        except AttributeError:
             return default
 
     def reload(self):
-        self._loaded = False
-        self._config = {}
-        self._load_config()
+        """
+        Re-read config.json, validate it and swap it in atomically.
+
+        A broken config is logged and ignored, we keep serving the old one.
+        Returns True if the new config is active.
+        """
+        try:
+            snapshot = Snapshot(
+                {**self._read_config(strict=True), **self._overrides},
+                self.snapshot.generation + 1,
+            )
+            snapshot.validate()
+        except Exception as e:
+            # Whatever is wrong with it, the old config keeps serving
+            self.logger.error(f"Config reload failed, keeping generation {self.snapshot.generation}: {e}")
+            return False
+        self._snapshot = snapshot
+        self.logger.info(f"Config reloaded, generation {snapshot.generation}")
+        return True
 
-    
     @property
     def logger(self):
-        if not hasattr(self, "_logger") or self._logger is None:
+        if getattr(self, "_logger", None) is None:
             self._logger = self._setup_logger()
         return self._logger
 
     def _setup_logger(self) -> logging.Logger:
         """Sets up the logger with the appropriate level and handlers."""
-        self._load_config()
-        level = getattr(self, "LEVEL", "INFO")
+        try:
+            level = self.snapshot.LEVEL
+        except ValueError:
+            # Modules grab the logger at import, server.main() reports the broken config
+            level = "INFO"
         logging.basicConfig(level=level)
         logger = logging.getLogger("nginx_clone")
         formatter = logging.Formatter(
@@ -84,9 +308,33 @@ class LazySettings:
         logger.addHandler(handler)
         return logger
 
+    @property
+    def slow_logger(self):
+        if getattr(self, "_slow_logger", None) is None:
+            self._slow_logger = self._setup_slow_logger()
+        return self._slow_logger
+
+    def _setup_slow_logger(self) -> logging.Logger:
+        """Sets up the slow request logger, it goes to the main log unless SLOW_LOG is set."""
+        logger = logging.getLogger("nginx_clone.slow")
+        try:
+            slow_log = self.snapshot.SLOW_LOG
+        except ValueError:
+            slow_log = None
+        if slow_log:
+            handler = logging.FileHandler(slow_log)
+            handler.setFormatter(
+                logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+            )
+            logger.addHandler(handler)
+            # Don't duplicate slow requests into the main log
+            logger.propagate = False
+        return logger
+
     def configure(self, **kwargs):
-        self._load_config()
-        self._config.update(kwargs)
+        self._overrides.update(kwargs)
+        snapshot = self.snapshot
+        self._snapshot = Snapshot({**snapshot.config, **kwargs}, snapshot.generation)
 
 
 settings = LazySettings()
\ No newline at end of file
@@ -0,0 +1,155 @@
+"""
+Load shedding benchmark: static file latency while a slow handler is hammered.
+
+Runs the server in-process with a /report handler that burns --report-ms
+of CPU (so it competes with everything else for the GIL, like a real
+expensive handler would). --report-clients connections call it in a
+loop while --static-clients fetch a small static file, for --seconds,
+three times:
+
+    unprotected   adaptive_concurrency off, no bulkhead
+    adaptive      the adaptive limit only
+    bulkhead      the adaptive limit and max_concurrency=--bulkhead on /report
+
+Reports static and /report latency, how many requests got through and
+how many were shed with a 503.
+
+    python shed_bench.py --report-clients 32 --static-clients 4 --seconds 5
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import concurrency
+from routes import bind_handler
+from settings import settings
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def get(sock, buffer, request):
+    """Send one request, returns the status once the whole response is in."""
+    sock.sendall(request)
+    while b"\r\n\r\n" not in buffer:
+        data = sock.recv(64 * 1024)
+        if not data:
+            raise ConnectionError("closed")
+        buffer += data
+    head, _, rest = bytes(buffer).partition(b"\r\n\r\n")
+    length = 0
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    buffer[:] = rest
+    while len(buffer) < length:
+        buffer += sock.recv(64 * 1024)
+    del buffer[:length]
+    return head[9:12]
+
+
+def client(port, path, stop, results):
+    request = f"GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: keep-alive\r\n\r\n".encode()
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    buffer = bytearray()
+    with sock:
+        while not stop.is_set():
+            start = time.perf_counter()
+            status = get(sock, buffer, request)
+            elapsed = time.perf_counter() - start
+            if status == b"503":
+                results["shed"] += 1
+                # Like a client honouring Retry-After, but without waiting a whole second
+                time.sleep(0.01)
+            else:
+                results["latencies"].append(elapsed)
+
+
+def summarize(results, seconds):
+    latencies = sorted(results["latencies"])
+    summary = {"ok_per_s": round(len(latencies) / seconds, 1), "shed": results["shed"]}
+    if latencies:
+        summary["p50_ms"] = round(statistics.median(latencies) * 1000, 2)
+        summary["p99_ms"] = round(latencies[int(0.99 * (len(latencies) - 1))] * 1000, 2)
+    return summary
+
+
+def run(port, args):
+    stop = threading.Event()
+    static = {"latencies": [], "shed": 0}
+    report = {"latencies": [], "shed": 0}
+    threads = [
+        threading.Thread(target=client, args=(port, "/report", stop, report)) for _ in range(args.report_clients)
+    ] + [
+        threading.Thread(target=client, args=(port, "/small.html", stop, static)) for _ in range(args.static_clients)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return {"static": summarize(static, args.seconds), "report": summarize(report, args.seconds)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Static latency next to a slow handler, with and without shedding")
+    parser.add_argument("--report-clients", type=int, default=32)
+    parser.add_argument("--static-clients", type=int, default=4)
+    parser.add_argument("--report-ms", type=float, default=20, help="CPU time per /report request")
+    parser.add_argument("--bulkhead", type=int, default=2, help="max_concurrency for /report in the last run")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    sys.stdout, report_to = open(os.devnull, "w"), sys.stdout
+
+    def report_handler(request):
+        deadline = time.thread_time() + args.report_ms / 1000
+        while time.thread_time() < deadline:
+            pass
+        return http_response({"rows": 42})
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "small.html"), "wb") as f:
+            f.write(b"<html>" + b"x" * 2000 + b"</html>")
+        port = free_port()
+        settings.configure(HOST="127.0.0.1", PORT=port, ROOT=directory)
+        import server  # noqa: E402  (imports the handlers too)
+        from response import http_response  # noqa: E402
+
+        threading.Thread(target=server.start_server, daemon=True).start()
+        time.sleep(0.5)
+
+        for name, adaptive, bulkhead in (
+            ("unprotected", False, None),
+            ("adaptive", True, None),
+            ("bulkhead", True, args.bulkhead),
+        ):
+            settings.configure(ADAPTIVE_CONCURRENCY=adaptive)
+            bind_handler("/report", max_concurrency=bulkhead)(report_handler)
+            results[name] = run(port, args)
+            results[name]["limit"] = concurrency.stats(settings.snapshot)
+
+    print(json.dumps(results, indent=4), file=report_to)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Soak test: run the server for a long time under mixed traffic and fail if
+memory, file descriptors or threads keep growing.
+
+The server runs in this process (so /proc/self and tracemalloc see it) and
+the traffic comes from client.py in a subprocess, plus a chaos thread that
+opens connections and abandons them half way to exercise the error paths.
+
+    python soak.py --duration 3600 --interval 30 --output soak.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from client import write_fixtures
+from settings import settings
+
+SCENARIOS = ["small", "large", "range", "not_modified", "time"]
+
+# metric -> allowed growth between the start and the end of the run
+DEFAULT_TOLERANCE = {
+    "rss_kb": 20 * 1024,
+    "fds": 8,
+    "threads": 8,
+    "traced_kb": 5 * 1024,
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_kb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def sample():
+    traced, _ = tracemalloc.get_traced_memory()
+    return {
+        "t": round(time.monotonic(), 1),
+        "rss_kb": rss_kb(),
+        "fds": len(os.listdir("/proc/self/fd")),
+        "threads": threading.active_count(),
+        "traced_kb": traced // 1024,
+    }
+
+
+def top_allocators(baseline, limit=5):
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+    return [
+        {"where": str(stat.traceback), "size_diff_kb": stat.size_diff // 1024, "count_diff": stat.count_diff}
+        for stat in snapshot.compare_to(baseline, "lineno")[:limit]
+    ]
+
+
+def chaos(port, stop, path):
+    """Connections that misbehave: half sent requests, resets, idle sockets."""
+    while not stop.is_set():
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=2) as s:
+                kind = random.choice(("partial", "reset", "idle"))
+                if kind == "partial":
+                    s.sendall(b"GET /time HTTP/1.1\r\nHost: local")
+                elif kind == "reset":
+                    s.sendall(f"GET {path} HTTP/1.1\r\nConnection: keep-alive\r\n\r\n".encode())
+                    # RST instead of FIN while the server is still sending
+                    s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                else:
+                    time.sleep(1)
+        except OSError:
+            pass
+        stop.wait(0.2)
+
+
+def drive(port, args, stop):
+    """Keep client.py running with a rotating scenario until stopped."""
+    client = os.path.join(os.path.dirname(os.path.abspath(__file__)), "client.py")
+    while not stop.is_set():
+        scenario = random.choice(SCENARIOS)
+        proc = subprocess.Popen(
+            [
+                sys.executable, client,
+                "--port", str(port),
+                "--scenario", scenario,
+                "--duration", str(args.round),
+                "--concurrency", str(args.concurrency),
+                "--small-path", args.small_path,
+                "--large-path", args.large_path,
+                *([] if random.random() < 0.7 else ["--no-keep-alive"]),
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        while proc.poll() is None:
+            if stop.wait(0.5):
+                proc.kill()
+                proc.wait()
+
+
+def find_leaks(samples, tolerance):
+    """
+    A metric leaks when even the lowest value of the last third of the run is
+    above the highest value of the first third by more than the tolerance.
+    Comparing min against max keeps GC and traffic noise from tripping it.
+    """
+    third = max(1, len(samples) // 3)
+    head, tail = samples[:third], samples[-third:]
+    leaks = {}
+    for metric, allowed in tolerance.items():
+        growth = min(s[metric] for s in tail) - max(s[metric] for s in head)
+        if growth > allowed:
+            leaks[metric] = growth
+    return leaks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nginx Clone soak test")
+    parser.add_argument("--duration", type=float, default=3600, help="Total seconds to run")
+    parser.add_argument("--interval", type=float, default=30, help="Seconds between samples")
+    parser.add_argument("--warmup", type=float, default=60, help="Seconds before the first sample")
+    parser.add_argument("--round", type=float, default=20, help="Seconds per client.py run")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--root", help="Document root to serve (default: a temp dir with client.py's fixtures)")
+    parser.add_argument("--small-path", default="/small.html")
+    parser.add_argument("--large-path", default="/large.bin")
+    parser.add_argument("--output", help="Write samples and verdict as JSON")
+    for metric, allowed in DEFAULT_TOLERANCE.items():
+        parser.add_argument(f"--max-{metric.replace('_', '-')}", dest=metric, type=int, default=allowed)
+    args = parser.parse_args()
+    tolerance = {metric: getattr(args, metric) for metric in DEFAULT_TOLERANCE}
+
+    # The server logs and prints every request, hours of that is just noise
+    logging.disable(logging.WARNING)
+    report_to = sys.stderr
+    sys.stdout = open(os.devnull, "w")
+
+    tracemalloc.start(10)
+    port = free_port()
+    root = args.root
+    if not root:
+        root = tempfile.mkdtemp(prefix="soak-")
+        write_fixtures(root)
+    settings.configure(HOST="127.0.0.1", PORT=port, ROOT=root)
+    import server  # noqa: E402  (imports the handlers too)
+
+    threading.Thread(target=server.start_server, daemon=True, name="soak-server").start()
+    time.sleep(0.5)
+
+    stop = threading.Event()
+    traffic = [
+        threading.Thread(target=drive, args=(port, args, stop), daemon=True),
+        threading.Thread(target=chaos, args=(port, stop, args.large_path), daemon=True),
+    ]
+    for thread in traffic:
+        thread.start()
+
+    time.sleep(args.warmup)
+    baseline = tracemalloc.take_snapshot()
+    samples = []
+    deadline = time.monotonic() + args.duration
+    while time.monotonic() < deadline:
+        samples.append(sample())
+        print(json.dumps(samples[-1]), file=report_to)
+        time.sleep(min(args.interval, max(0, deadline - time.monotonic())))
+    samples.append(sample())
+    stop.set()
+    if not args.root:
+        # Only once nothing is fetching the fixtures anymore
+        for thread in traffic:
+            thread.join()
+        time.sleep(1)
+        shutil.rmtree(root, ignore_errors=True)
+
+    leaks = find_leaks(samples, tolerance)
+    report = {
+        "port": port,
+        "tolerance": tolerance,
+        "samples": samples,
+        "top_allocators": top_allocators(baseline),
+        "leaks": leaks,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    for entry in report["top_allocators"]:
+        print(f"{entry['size_diff_kb']:>8} KB {entry['count_diff']:>8} blocks  {entry['where']}", file=report_to)
+    if leaks:
+        print(f"LEAK: {leaks}", file=report_to)
+        sys.exit(1)
+    print("No leaks detected", file=report_to)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+TCP options benchmark: latency and packets per response with Nagle on,
+with tcp_nodelay, and with tcp_nodelay + tcp_nopush (cork).
+
+Runs the server in-process and switches the options through settings
+between runs (they apply to connections accepted afterwards). Each
+workload is fetched --requests times on one keep-alive connection:
+
+    small     a 2 KB file, head and body leave in one sendmsg()
+    range     4 KB out of a 2 MB file, head written before the streamed body
+    sendfile  a whole 1 MB file, head written before os.sendfile()
+
+Packets are the data segments the client received (tcpi_data_segs_in
+from TCP_INFO, Linux 4.6+), so they show whether the head left alone.
+
+    python sockopt_bench.py --requests 500
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import statistics
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from settings import settings
+
+CONFIGS = {
+    "nagle": {"TCP_NODELAY": False, "TCP_NOPUSH": False},
+    "nodelay": {"TCP_NODELAY": True, "TCP_NOPUSH": False},
+    "nodelay+nopush": {"TCP_NODELAY": True, "TCP_NOPUSH": True},
+}
+WORKLOADS = {
+    "small": ("/small.html", 2 * 1024, None),
+    "range": ("/big.bin", 2 * 1024 * 1024, "bytes=1000000-1004095"),
+    "sendfile": ("/medium.bin", 1024 * 1024, None),
+}
+# struct tcp_info: u32 tcpi_data_segs_in sits at byte 152
+DATA_SEGS_IN = 152
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def segments_in(sock):
+    info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 256)
+    if len(info) < DATA_SEGS_IN + 4:
+        return None
+    return struct.unpack_from("I", info, DATA_SEGS_IN)[0]
+
+
+def get(sock, buffer, request):
+    """Send one request, returns (status, body length) once the whole response is in."""
+    sock.sendall(request)
+    while b"\r\n\r\n" not in buffer:
+        buffer += sock.recv(256 * 1024)
+    head, _, rest = bytes(buffer).partition(b"\r\n\r\n")
+    length = 0
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    buffer[:] = rest
+    while len(buffer) < length:
+        buffer += sock.recv(256 * 1024)
+    del buffer[:length]
+    return head[9:12]
+
+
+def run(port, path, byte_range, requests):
+    request = f"GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: keep-alive\r\n"
+    if byte_range:
+        request += f"Range: {byte_range}\r\n"
+    request = (request + "\r\n").encode()
+
+    sock = socket.create_connection(("127.0.0.1", port))
+    # The client never holds its requests back, only the server side is measured
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    buffer = bytearray()
+    for _ in range(5):
+        get(sock, buffer, request)  # warm up
+
+    latencies = []
+    segments_before = segments_in(sock)
+    for _ in range(requests):
+        start = time.perf_counter()
+        status = get(sock, buffer, request)
+        latencies.append(time.perf_counter() - start)
+        if status not in (b"200", b"206"):
+            raise RuntimeError(f"{path} answered {status}")
+    segments_after = segments_in(sock)
+    sock.close()
+
+    latencies.sort()
+    result = {
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p99_ms": round(latencies[int(0.99 * (len(latencies) - 1))] * 1000, 3),
+        "requests_per_s": round(requests / sum(latencies), 1),
+    }
+    if segments_before is not None:
+        result["packets_per_response"] = round((segments_after - segments_before) / requests, 2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency and packets per response for the TCP options")
+    parser.add_argument("--requests", type=int, default=300, help="Requests per workload and config")
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    sys.stdout, report_to = open(os.devnull, "w"), sys.stdout
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for path, size, _ in WORKLOADS.values():
+            with open(os.path.join(directory, path.lstrip("/")), "wb") as f:
+                f.write(os.urandom(size))
+        port = free_port()
+        # The 2 KB file is read per request, the other two are sent with sendfile
+        settings.configure(HOST="127.0.0.1", PORT=port, ROOT=directory, MMAP_MIN_SIZE=0, SENDFILE_MIN_SIZE="1m")
+        import server  # noqa: E402  (imports the handlers too)
+
+        threading.Thread(target=server.start_server, daemon=True).start()
+        time.sleep(0.5)
+
+        for name, options in CONFIGS.items():
+            settings.configure(**options)
+            results[name] = {
+                workload: run(port, path, byte_range, args.requests)
+                for workload, (path, _, byte_range) in WORKLOADS.items()
+            }
+
+    print(json.dumps(results, indent=4), file=report_to)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+TCP options for the listener and the accepted connections.
+
+    "tcp_nodelay": true,        # no Nagle, small writes go out right away
+    "tcp_nopush": true,         # cork a streamed response's head and first body bytes together
+    "deferred_accept": 5,       # accept() only once the request's first bytes are in (seconds)
+    "fastopen": 256,            # TCP Fast Open queue, data in the SYN (0 = off)
+    "rcvbuf": "256k",           # SO_RCVBUF / SO_SNDBUF, 0 keeps the kernel's autotuning
+    "sndbuf": 0,
+    "so_keepalive": "60:10:5"   # idle:interval:count, like nginx's so_keepalive, true for the OS defaults
+
+tcp_nopush is off by default, as in nginx: the head of a streamed response
+then goes out on its own and a client sees it a little sooner, at the cost
+of one more small packet.
+
+Listener options are applied once when it is created, the per connection
+ones on every accept (so a reload changes them for new connections only).
+A listen entry can override deferred_accept, fastopen, rcvbuf, sndbuf and
+so_keepalive for its own socket, see listeners.py.
+Options the platform doesn't have are skipped, an option the kernel refuses
+is logged and skipped too, never fatal.
+"""
+import contextlib
+import socket
+
+from settings import settings
+
+logger = settings.logger
+
+# Linux only, TCP_NOPUSH on the BSDs isn't exposed by the socket module
+TCP_CORK = getattr(socket, "TCP_CORK", None)
+
+
+def set_option(sock, level, option, value, name):
+    try:
+        sock.setsockopt(level, option, value)
+    except OSError as e:
+        logger.warning(f"Can't set {name}={value}: {e}")
+
+
+def option(snapshot, overrides, name):
+    return overrides[name] if overrides and name in overrides else getattr(snapshot, name)
+
+
+def tune_listener(sock, snapshot, overrides=None):
+    # Set on the listener so the window scale negotiated in the handshake fits rcvbuf
+    set_buffers(sock, snapshot, overrides)
+    if sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return
+    deferred_accept = option(snapshot, overrides, "DEFERRED_ACCEPT")
+    if deferred_accept and hasattr(socket, "TCP_DEFER_ACCEPT"):
+        set_option(sock, socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT, int(deferred_accept), "deferred_accept")
+    fastopen = option(snapshot, overrides, "FASTOPEN")
+    if fastopen and hasattr(socket, "TCP_FASTOPEN"):
+        set_option(sock, socket.IPPROTO_TCP, socket.TCP_FASTOPEN, fastopen, "fastopen")
+
+
+def tune_connection(sock, snapshot, overrides=None):
+    set_buffers(sock, snapshot, overrides)
+    if sock.family not in (socket.AF_INET, socket.AF_INET6):
+        # Unix sockets have no Nagle or keepalive to tune
+        return
+    if snapshot.TCP_NODELAY:
+        set_option(sock, socket.IPPROTO_TCP, socket.TCP_NODELAY, 1, "tcp_nodelay")
+    keepalive = option(snapshot, overrides, "SO_KEEPALIVE")
+    if keepalive is not None:
+        set_option(sock, socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1, "so_keepalive")
+        for name, value in zip(("TCP_KEEPIDLE", "TCP_KEEPINTVL", "TCP_KEEPCNT"), keepalive):
+            if value and hasattr(socket, name):
+                set_option(sock, socket.IPPROTO_TCP, getattr(socket, name), value, "so_keepalive")
+
+
+def set_buffers(sock, snapshot, overrides=None):
+    rcvbuf = option(snapshot, overrides, "RCVBUF")
+    if rcvbuf:
+        set_option(sock, socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf, "rcvbuf")
+    sndbuf = option(snapshot, overrides, "SNDBUF")
+    if sndbuf:
+        set_option(sock, socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf, "sndbuf")
+
+
+@contextlib.contextmanager
+def corked(sock, snapshot):
+    """
+    Hold back partial packets until the block ends, so a response head sent
+    with its own write goes out in the same packet as the body behind it
+    instead of a tiny one of its own. Uncorking flushes whatever is left.
+    """
+    if not snapshot.TCP_NOPUSH or TCP_CORK is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        yield
+        return
+    sock.setsockopt(socket.IPPROTO_TCP, TCP_CORK, 1)
+    try:
+        yield
+    finally:
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, TCP_CORK, 0)
+        except OSError:
+            pass
@@ -7,10 +7,17 @@ class HttpResponseCode:
     HTTP_304_NOT_MODIFIED = 304
     HTTP_408_REQUEST_TIMEOUT = 408
     HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE = 416
-    HTTP_206_PARTIAL_CONTENT= 206
+    HTTP_206_PARTIAL_CONTENT = 206
+    HTTP_400_BAD_REQUEST = 400
+    HTTP_413_PAYLOAD_TOO_LARGE = 413
+    HTTP_501_NOT_IMPLEMENTED = 501
+    HTTP_414_URI_TOO_LONG = 414
+    HTTP_431_REQUEST_HEADER_FIELDS_TOO_LARGE = 431
+    HTTP_503_SERVICE_UNAVAILABLE = 503
 
     HTTP_RESPONSE_MESSAGES = {
         HTTP_200_OK: "OK",
+        HTTP_206_PARTIAL_CONTENT: "Partial Content",
         HTTP_404_NOT_FOUND: "Not Found",
         HTTP_405_METHOD_NOT_ALLOWED: "Method Not Allowed",
         HTTP_500_INTERNAL_SERVER_ERROR: "Internal Server Error",
@@ -18,4 +25,10 @@ class HttpResponseCode:
         HTTP_304_NOT_MODIFIED: "Not Modified",
         HTTP_408_REQUEST_TIMEOUT: "Request Timeout",
         HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE: "Requested Range Not Satisfiable",
+        HTTP_400_BAD_REQUEST: "Bad Request",
+        HTTP_413_PAYLOAD_TOO_LARGE: "Payload Too Large",
+        HTTP_501_NOT_IMPLEMENTED: "Not Implemented",
+        HTTP_414_URI_TOO_LONG: "URI Too Long",
+        HTTP_431_REQUEST_HEADER_FIELDS_TOO_LARGE: "Request Header Fields Too Large",
+        HTTP_503_SERVICE_UNAVAILABLE: "Service Unavailable",
     }
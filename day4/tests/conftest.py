@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules import each other flat, as when running from day4/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
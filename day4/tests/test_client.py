@@ -0,0 +1,61 @@
+import asyncio
+import threading
+
+from client import read_response
+from h2_bench import free_port
+from settings import settings
+
+PAGE = b'<html><head><link rel="stylesheet" href="/site.css"></head><body>hi</body></html>\n'
+
+
+def feed(data):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+def test_read_response_skips_early_hints():
+    reader = feed(
+        b"HTTP/1.1 103 Early Hints\r\nLink: </site.css>; rel=preload; as=style\r\n\r\n"
+        b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nhi"
+        b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n"
+    )
+
+    async def read_two():
+        return (await read_response(reader))[0], (await read_response(reader))[0]
+
+    assert asyncio.run(read_two()) == (200, 404)
+
+
+def test_keep_alive_with_early_hints_enabled(tmp_path):
+    (tmp_path / "index.html").write_bytes(PAGE)
+    (tmp_path / "site.css").write_bytes(b"body {}\n")
+    port = free_port()
+    settings.configure(HOST="127.0.0.1", PORT=port, ROOT=str(tmp_path), EARLY_HINTS=True)
+    import server  # noqa: E402  (binds the settings above)
+
+    threading.Thread(target=server.start_server, daemon=True).start()
+    request = f"GET /index.html HTTP/1.1\r\nHost: localhost:{port}\r\nConnection: keep-alive\r\n\r\n".encode()
+
+    async def load():
+        for _ in range(50):
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                break
+            except ConnectionRefusedError:
+                await asyncio.sleep(0.02)
+        # Both pipelined, the 103 before each 200 must not be taken for the answer
+        writer.write(request * 2)
+        await writer.drain()
+        first = await read_response(reader)
+        second = await read_response(reader)
+        writer.close()
+        return first, second
+
+    try:
+        (status, headers), (status2, headers2) = asyncio.run(load())
+    finally:
+        settings.configure(EARLY_HINTS=False)
+    assert (status, status2) == (200, 200)
+    assert int(headers["content-length"]) == int(headers2["content-length"]) == len(PAGE)
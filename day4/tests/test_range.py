@@ -0,0 +1,24 @@
+from request import Request
+from response import may_by_handle_range
+from settings import settings
+
+
+def range_request(path, value):
+    return Request("GET", "/" + path.name, headers={"Range": value}, settings=settings.snapshot)
+
+
+def test_partial_content_status_line(tmp_path):
+    path = tmp_path / "data.bin"
+    path.write_bytes(b"x" * 1000)
+    head, send = may_by_handle_range(path, range_request(path, "bytes=0-99"))
+    assert head.head.startswith(b"HTTP/1.1 206 Partial Content\r\n")
+    assert b"Content-Range: bytes 0-99/1000\r\n" in head.head
+
+
+def test_unsatisfiable_range_is_416(tmp_path):
+    path = tmp_path / "data.bin"
+    path.write_bytes(b"x" * 1000)
+    for value in ("bytes=5000-", "bytes=abc"):
+        response = may_by_handle_range(path, range_request(path, value))
+        assert response.head.startswith(b"HTTP/1.1 416 Requested Range Not Satisfiable\r\n")
+        assert b"Content-Range: bytes */1000\r\n" in response.head
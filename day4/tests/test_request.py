@@ -0,0 +1,23 @@
+import pytest
+
+from body import RequestError
+from request import parse_request
+
+ADDR = ("127.0.0.1", 50000)
+
+
+def test_headers_without_space_after_colon():
+    request = parse_request(b"GET /a?x=1 HTTP/1.1\r\nHost:example.com:8000\r\nX-Empty:\r\n\r\n", ADDR)
+    assert request.path == "/a"
+    assert request.query_params == {"x": ["1"]}
+    assert request.headers["Host"] == "example.com:8000"
+    assert request.headers["X-Empty"] == ""
+
+
+@pytest.mark.parametrize(
+    "raw", [b"GARBAGE\r\n\r\n", b"GET /\r\n\r\n", b"GET / HTTP/1.1 extra\r\n\r\n", b"GET foo HTTP/1.1\r\n\r\n", b"\r\n\r\n"]
+)
+def test_malformed_request_line_is_400(raw):
+    with pytest.raises(RequestError) as e:
+        parse_request(raw, ADDR)
+    assert e.value.status == 400
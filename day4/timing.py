@@ -0,0 +1,42 @@
+import time
+
+
+class RequestTimer:
+    """
+    Cheap per-request phase timing based on the monotonic clock.
+
+    Every call to `lap` charges the time since the previous lap to the
+    given phase, so the phases always add up to the total.
+    """
+
+    __slots__ = ("start", "phases", "_mark")
+
+    def __init__(self):
+        self.start = self._mark = time.perf_counter()
+        self.phases = {}
+
+    def restart(self, at):
+        """Start counting from `at` (a time.perf_counter() value) instead."""
+        self.start = self._mark = at
+        self.phases.clear()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + (now - self._mark)
+        self._mark = now
+
+    @property
+    def total_ms(self):
+        return (self._mark - self.start) * 1000
+
+    def server_timing(self):
+        # Server-Timing: recv;dur=0.051, parse;dur=0.020, total;dur=0.090
+        metrics = [f"{name};dur={secs * 1000:.3f}" for name, secs in self.phases.items()]
+        metrics.append(f"total;dur={self.total_ms:.3f}")
+        return ", ".join(metrics)
+
+    def summary(self):
+        # recv=0.051ms parse=0.020ms total=0.090ms
+        parts = [f"{name}={secs * 1000:.3f}ms" for name, secs in self.phases.items()]
+        parts.append(f"total={self.total_ms:.3f}ms")
+        return " ".join(parts)
@@ -0,0 +1,118 @@
+"""
+TLS termination with the stdlib ssl module.
+
+    "ssl": {
+        "certfile": "cert.pem",
+        "keyfile": "key.pem",
+        "ciphers": "ECDHE+AESGCM:ECDHE+CHACHA20",
+        "alpn": ["http/1.1"],
+        "session_tickets": true,
+        "num_tickets": 2,
+        "ktls": true
+    }
+
+All connections share one SSLContext, and with it OpenSSL's server side
+session cache (TLS 1.2 session ids) and ticket keys (TLS 1.3 tickets), so a
+returning client resumes instead of paying for a full handshake. The
+context is kept across config reloads as long as the "ssl" block doesn't
+change, otherwise every reload would throw the session cache away.
+
+A changed "ssl" block is built when the config is validated (a bad key or
+cipher string fails the reload) and that context is the one swapped in.
+Should building it still fail later, the previous context keeps serving.
+"""
+import ssl
+import threading
+
+from settings import settings
+
+logger = settings.logger
+
+SSL_KEYS = {"certfile", "keyfile", "password", "ciphers", "alpn", "session_tickets", "num_tickets", "ktls"}
+HANDSHAKE_TIMEOUT = 5  # seconds
+
+_lock = threading.Lock()
+_context = None
+_context_config = None
+# (config, context) built by prepare() for a config being validated
+_prepared = (None, None)
+
+
+def make_context(config) -> ssl.SSLContext:
+    unknown = config.keys() - SSL_KEYS
+    if unknown:
+        raise ValueError(f"Unknown ssl settings: {', '.join(sorted(unknown))}")
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    try:
+        context.load_cert_chain(config["certfile"], config.get("keyfile"), config.get("password"))
+        if config.get("ciphers"):
+            context.set_ciphers(config["ciphers"])
+        context.set_alpn_protocols(config.get("alpn", ["http/1.1"]))
+        if config.get("session_tickets", True):
+            # TLS 1.3 tickets sent after each full handshake
+            context.num_tickets = int(config.get("num_tickets", 2))
+        else:
+            context.options |= ssl.OP_NO_TICKET
+            context.num_tickets = 0
+    except (OSError, ssl.SSLError, KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid ssl settings: {e}") from e
+
+    # Let the kernel do the encryption so the static path can keep os.sendfile
+    # (Python 3.12+ with a kTLS enabled OpenSSL and kernel, ignored otherwise)
+    if config.get("ktls", True):
+        context.options |= getattr(ssl, "OP_ENABLE_KTLS", 0)
+    return context
+
+
+def prepare(config):
+    """Build the context for a config being validated, ValueError if it can't be."""
+    global _prepared
+    if not config or config == _context_config:
+        return
+    _prepared = (config, make_context(config))
+
+
+def server_context(snapshot):
+    """The shared SSLContext for this config, or None when TLS is off."""
+    global _context, _context_config, _prepared
+    config = snapshot.SSL
+    if not config:
+        return None
+    if config is not _context_config:
+        with _lock:
+            if config != _context_config:
+                prepared_config, context = _prepared
+                _prepared = (None, None)
+                if prepared_config != config:
+                    try:
+                        context = make_context(config)
+                    except ValueError as e:
+                        if _context is None:
+                            raise
+                        logger.error(f"Keeping the previous TLS context: {e}")
+                        # Not retried on every connection
+                        _context_config = config
+                        return _context
+                _context = context
+                logger.info(f"TLS enabled with {config['certfile']}")
+            _context_config = config
+    return _context
+
+
+def wrap(context, client_socket):
+    """Do the server side handshake, returns the SSLSocket or None if it failed."""
+    prev_timeout = client_socket.gettimeout()
+    client_socket.settimeout(HANDSHAKE_TIMEOUT)
+    try:
+        tls_socket = context.wrap_socket(client_socket, server_side=True)
+    except (ssl.SSLError, OSError) as e:
+        logger.info(f"TLS handshake failed: {e}")
+        client_socket.close()
+        return None
+    tls_socket.settimeout(prev_timeout)
+    return tls_socket
+
+
+def session_stats():
+    return _context.session_stats() if _context else {}
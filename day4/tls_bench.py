@@ -0,0 +1,131 @@
+"""
+Full vs resumed TLS handshake benchmark.
+
+Generates a throwaway self-signed certificate with the openssl CLI, runs the
+server in-process with TLS on a free port and opens --connections
+connections twice: once with a fresh session every time (full handshake)
+and once offering the session from the previous connection (resumption
+through the session cache for TLS 1.2, tickets for TLS 1.3).
+
+    python tls_bench.py --connections 500
+    python tls_bench.py --tls-version 1.2
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from settings import settings
+
+VERSIONS = {"1.2": ssl.TLSVersion.TLSv1_2, "1.3": ssl.TLSVersion.TLSv1_3}
+
+
+def make_certificate(directory):
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+            "-nodes", "-days", "1", "-subj", "/CN=localhost",
+            "-keyout", key, "-out", cert,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return cert, key
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def one_connection(context, port, session):
+    """Handshake + one request, returns (handshake seconds, session, reused)."""
+    with socket.create_connection(("127.0.0.1", port)) as raw:
+        # Like browsers do, otherwise Nagle delays the request after a resumed TLS 1.2 handshake
+        raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        start = time.perf_counter()
+        sock = context.wrap_socket(raw, server_hostname="localhost", session=session)
+        handshake = time.perf_counter() - start
+        sock.sendall(b"GET /time HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+        # Reading the response also picks up the TLS 1.3 tickets sent after the handshake
+        while sock.recv(64 * 1024):
+            pass
+        reused = sock.session_reused
+        session = sock.session
+        sock.close()
+    return handshake, session, reused
+
+
+def run(context, port, connections, resume):
+    handshakes, reused = [], 0
+    session = None
+    start = time.perf_counter()
+    for _ in range(connections):
+        handshake, new_session, was_reused = one_connection(context, port, session if resume else None)
+        handshakes.append(handshake)
+        reused += was_reused
+        session = new_session
+    elapsed = time.perf_counter() - start
+    handshakes.sort()
+    return {
+        "connections": connections,
+        "resumed": reused,
+        "connections_per_s": round(connections / elapsed, 1),
+        "handshake_ms": {
+            "p50": round(statistics.median(handshakes) * 1000, 3),
+            "p99": round(handshakes[int(0.99 * (len(handshakes) - 1))] * 1000, 3),
+            "mean": round(statistics.fmean(handshakes) * 1000, 3),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Full vs resumed TLS handshakes")
+    parser.add_argument("--connections", type=int, default=300)
+    parser.add_argument("--tls-version", choices=VERSIONS, default="1.3")
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    sys.stdout, report_to = open(os.devnull, "w"), sys.stdout
+
+    with tempfile.TemporaryDirectory() as directory:
+        cert, key = make_certificate(directory)
+        port = free_port()
+        settings.configure(HOST="127.0.0.1", PORT=port, SSL={"certfile": cert, "keyfile": key})
+        import server  # noqa: E402  (imports the handlers too)
+
+        threading.Thread(target=server.start_server, daemon=True).start()
+        time.sleep(0.5)
+
+        context = ssl.create_default_context(cafile=cert)
+        context.minimum_version = context.maximum_version = VERSIONS[args.tls_version]
+
+        run(context, port, 20, resume=False)  # warm up
+        results = {
+            "tls_version": args.tls_version,
+            "full": run(context, port, args.connections, resume=False),
+            "resumed": run(context, port, args.connections, resume=True),
+            "server_session_stats": server.tls.session_stats(),
+        }
+    results["speedup"] = round(
+        results["resumed"]["connections_per_s"] / results["full"]["connections_per_s"], 2
+    )
+    print(json.dumps(results, indent=4), file=report_to)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+TCP loopback vs Unix domain socket latency benchmark.
+
+Runs the server in-process with two listeners, 127.0.0.1 and a unix:
+socket in a temp dir, and fetches the same small file through both:
+
+    keepalive  --requests sequential requests on one connection
+    connect    a new connection per request (handshake + request + close)
+    parallel   --clients keep-alive connections at once, for throughput
+
+    python uds_bench.py --requests 2000 --size 1k
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from settings import settings
+from vhosts import parse_size
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def connect(address):
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    else:
+        sock = socket.create_connection(address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def get(sock, buffer, request):
+    """Send one request, returns the status once the whole response is in."""
+    sock.sendall(request)
+    while b"\r\n\r\n" not in buffer:
+        buffer += sock.recv(64 * 1024)
+    head, _, rest = bytes(buffer).partition(b"\r\n\r\n")
+    length = 0
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    buffer[:] = rest
+    while len(buffer) < length:
+        buffer += sock.recv(64 * 1024)
+    del buffer[:length]
+    return head[9:12]
+
+
+def keepalive(address, requests):
+    request = b"GET /small.bin HTTP/1.1\r\nHost: localhost\r\nConnection: keep-alive\r\n\r\n"
+    latencies = []
+    with connect(address) as sock:
+        buffer = bytearray()
+        for _ in range(requests):
+            start = time.perf_counter()
+            if get(sock, buffer, request) != b"200":
+                raise RuntimeError("keep-alive request failed")
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def new_connections(address, requests):
+    request = b"GET /small.bin HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n"
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        with connect(address) as sock:
+            if get(sock, bytearray(), request) != b"200":
+                raise RuntimeError("request failed")
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def parallel(address, requests, clients):
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.extend(keepalive(address, requests // clients)))
+        for _ in range(clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def summarize(latencies, elapsed=None):
+    latencies = sorted(latencies)
+    return {
+        "p50_us": round(statistics.median(latencies) * 1e6, 1),
+        "p99_us": round(latencies[int(0.99 * (len(latencies) - 1))] * 1e6, 1),
+        "requests_per_s": round(len(latencies) / (elapsed or sum(latencies)), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency over TCP loopback vs a Unix domain socket")
+    parser.add_argument("--requests", type=int, default=1000, help="Requests per mode and transport")
+    parser.add_argument("--clients", type=int, default=8, help="Connections for the parallel run")
+    parser.add_argument("--size", default="1k", help="Size of the file fetched")
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    sys.stdout, report_to = open(os.devnull, "w"), sys.stdout
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, "small.bin"), "wb") as f:
+            f.write(os.urandom(parse_size(args.size)))
+        port = free_port()
+        unix_path = os.path.join(directory, "bench.sock")
+        settings.configure(ROOT=directory, LISTEN=[f"127.0.0.1:{port}", f"unix:{unix_path}"])
+        import server  # noqa: E402  (imports the handlers too)
+
+        threading.Thread(target=server.start_server, daemon=True).start()
+        time.sleep(0.5)
+
+        for name, address in (("tcp", ("127.0.0.1", port)), ("unix", unix_path)):
+            keepalive(address, 50)  # warm up
+            results[name] = {
+                "keepalive": summarize(keepalive(address, args.requests)),
+                "connect": summarize(new_connections(address, args.requests)),
+                "parallel": summarize(*parallel(address, args.requests, args.clients)),
+            }
+
+    results["unix_speedup"] = {
+        mode: round(results["unix"][mode]["requests_per_s"] / results["tcp"][mode]["requests_per_s"], 2)
+        for mode in ("keepalive", "connect", "parallel")
+    }
+    print(json.dumps(results, indent=4), file=report_to)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
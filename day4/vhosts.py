@@ -0,0 +1,208 @@
+"""
+Name based virtual hosts and location blocks, nginx style.
+
+    "servers": [
+        {
+            "server_name": ["example.com", "*.example.com"],
+            "root": "./sites/example",
+            "gzip": true,
+            "locations": [
+                {"path": "/time", "match": "exact", "handler": "time_handler"},
+                {"path": "/assets/", "match": "prefix", "cache_control": "max-age=3600"},
+                {"path": "/downloads/", "limit_rate": "500k", "limit_rate_after": "1m"},
+                {"path": "\\.(jpg|png)$", "match": "regex", "gzip": false}
+            ]
+        }
+    ]
+
+Everything is compiled once per config snapshot: hosts are looked up in a
+dict (wildcards by suffix), exact locations in a dict and prefixes by
+length, so the cost per request doesn't grow with the number of vhosts.
+Location matching follows nginx: exact match, then the longest prefix,
+then the first regex in config order (unless the prefix says
+"skip_regex"), falling back to that longest prefix.
+"""
+import re
+from pathlib import Path
+from types import MappingProxyType
+
+MATCH_TYPES = ("exact", "prefix", "regex", "iregex")
+# Settings a location inherits from its server when it doesn't set them
+INHERITED = ("root", "gzip", "cache_control", "limit_rate", "limit_rate_after")
+
+
+def parse_size(value):
+    # Bytes, or nginx style "16k", "1m", "1g"
+    if isinstance(value, str):
+        text = value.strip().lower()
+        unit = {"k": 1024, "m": 1024**2, "g": 1024**3}.get(text[-1:], 1)
+        value = int(text[:-1] if unit != 1 else text) * unit
+    value = int(value)
+    if value < 0:
+        raise ValueError("size can't be negative")
+    return value
+
+
+def _optional_size(value):
+    return None if value is None else parse_size(value)
+
+
+def _check_types(what, spec, types):
+    # A config typo must be a ValueError (a reload keeps the old config), not an AttributeError
+    if not isinstance(spec, dict):
+        raise ValueError(f"{what} must be an object, got {type(spec).__name__}")
+    for key, expected in types.items():
+        if key in spec and spec[key] is not None and not isinstance(spec[key], expected):
+            names = " or ".join(t.__name__ for t in (expected if isinstance(expected, tuple) else (expected,)))
+            raise ValueError(f"{what}: {key} must be {names}, got {spec[key]!r}")
+
+
+# Settings that are strings, on servers and locations alike
+STRINGS = {"root": str, "cache_control": str}
+
+
+class Location:
+    __slots__ = (
+        "path", "match", "root", "handler", "gzip", "cache_control", "limit_rate", "limit_rate_after",
+        "skip_regex", "pattern",
+    )
+
+    def __init__(self, spec, server):
+        _check_types("Location", spec, {"path": str, "match": str, "handler": str, **STRINGS})
+        unknown = spec.keys() - {"path", "match", "handler", "skip_regex", *INHERITED}
+        if unknown:
+            raise ValueError(f"Unknown location settings: {', '.join(sorted(unknown))}")
+        self.path = spec["path"]
+        self.match = spec.get("match", "prefix")
+        if self.match not in MATCH_TYPES:
+            raise ValueError(f"Location {self.path}: match must be one of {', '.join(MATCH_TYPES)}")
+        self.root = Path(spec["root"]).resolve() if "root" in spec else server.get("root")
+        self.handler = spec.get("handler")
+        self.gzip = bool(spec.get("gzip", server.get("gzip", False)))
+        self.cache_control = spec.get("cache_control", server.get("cache_control"))
+        # None means the global limit_rate / limit_rate_after
+        try:
+            self.limit_rate = _optional_size(spec.get("limit_rate", server.get("limit_rate")))
+            self.limit_rate_after = _optional_size(spec.get("limit_rate_after", server.get("limit_rate_after")))
+        except ValueError as e:
+            raise ValueError(f"Location {self.path}: bad limit_rate: {e}") from e
+        self.skip_regex = bool(spec.get("skip_regex", False))
+        self.pattern = None
+        if self.match in ("regex", "iregex"):
+            try:
+                self.pattern = re.compile(self.path, re.IGNORECASE if self.match == "iregex" else 0)
+            except re.error as e:
+                raise ValueError(f"Location {self.path}: bad regex: {e}") from e
+
+    def __repr__(self):
+        return f"Location({self.match} {self.path!r})"
+
+
+class Server:
+    __slots__ = ("names", "root", "exact", "prefixes", "prefix_lengths", "regexes")
+
+    def __init__(self, spec, default_root):
+        _check_types("Server", spec, {"server_name": (str, list), "locations": list, **STRINGS})
+        unknown = spec.keys() - {"server_name", "locations", "default", *INHERITED}
+        if unknown:
+            raise ValueError(f"Unknown server settings: {', '.join(sorted(unknown))}")
+        names = spec.get("server_name", [])
+        self.names = [names] if isinstance(names, str) else list(names)
+        if not all(isinstance(name, str) for name in self.names):
+            raise ValueError(f"server_name must be names, got {names!r}")
+        self.root = Path(spec.get("root", default_root)).resolve()
+        inherited = {**spec, "root": self.root}
+
+        locations = [Location(loc, inherited) for loc in spec.get("locations", [])]
+        if not any(loc.match == "prefix" and loc.path == "/" for loc in locations):
+            # Anything unmatched is served from the server root
+            locations.append(Location({"path": "/"}, inherited))
+
+        self.exact = {loc.path: loc for loc in locations if loc.match == "exact"}
+        self.prefixes = {loc.path: loc for loc in locations if loc.match == "prefix"}
+        # Longest first, so the first hit is the longest matching prefix
+        self.prefix_lengths = sorted({len(path) for path in self.prefixes}, reverse=True)
+        self.regexes = [loc for loc in locations if loc.pattern is not None]
+
+    def match(self, path) -> Location:
+        location = self.exact.get(path)
+        if location is not None:
+            return location
+
+        prefix = None
+        for length in self.prefix_lengths:
+            prefix = self.prefixes.get(path[:length])
+            if prefix is not None:
+                break
+        if prefix is not None and prefix.skip_regex:
+            return prefix
+
+        for location in self.regexes:
+            if location.pattern.search(path):
+                return location
+        return prefix
+
+
+class VirtualHosts:
+    __slots__ = ("exact", "wildcards", "default", "servers")
+
+    def __init__(self, servers, default_root):
+        self.servers = [Server(spec, default_root) for spec in servers]
+        exact, wildcards = {}, {}
+        default = None
+        for server, spec in zip(self.servers, servers):
+            for name in server.names:
+                name = name.lower()
+                # "*.example.com" is stored as ".example.com"
+                table, key = (wildcards, name[1:]) if name.startswith("*.") else (exact, name)
+                if key in table:
+                    raise ValueError(f"Duplicate server_name {name}")
+                table[key] = server
+            if spec.get("default"):
+                if default is not None:
+                    raise ValueError("More than one default server")
+                default = server
+        self.exact = MappingProxyType(exact)
+        self.wildcards = MappingProxyType(wildcards)
+        # Like nginx, the first server is the default unless one says otherwise
+        self.default = default or self.servers[0]
+
+    def match(self, host) -> Server:
+        if not host:
+            return self.default
+        host = host.lower()
+        # Strip the port, keeping IPv6 literals like [::1]:8000 intact
+        if host.startswith("["):
+            host = host[: host.find("]") + 1]
+        else:
+            host = host.partition(":")[0]
+        server = self.exact.get(host)
+        if server is not None:
+            return server
+        if self.wildcards:
+            dot = host.find(".")
+            while dot != -1:
+                server = self.wildcards.get(host[dot:])
+                if server is not None:
+                    return server
+                dot = host.find(".", dot + 1)
+        return self.default
+
+    def handler_names(self):
+        return {
+            loc.handler
+            for server in self.servers
+            for loc in (*server.exact.values(), *server.prefixes.values(), *server.regexes)
+            if loc.handler
+        }
+
+
+def compile_vhosts(servers, root):
+    """Compile the "servers" config, without it everything is one default server on root."""
+    if not isinstance(servers, list):
+        raise ValueError("servers must be a list")
+    try:
+        # No servers, one default server on root
+        return VirtualHosts(servers or [{}], root)
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Invalid server block: {e!r}") from e